@@ -0,0 +1,158 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# 設置參數
+ANSWER_CACHE_THRESHOLD = 0.95  # 問題向量的餘弦相似度達到此值才視為同一個問題
+ANSWER_CACHE_TTL = 24 * 60 * 60  # 快取答案的存活秒數
+ANSWER_CACHE_MAX_ENTRIES = 1000  # 最多保留的答案數（超過時淘汰最久未使用的）
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = "?？!！。.；;"
+
+# 正規化問題文字：去除空白、統一小寫與結尾標點，完全相同的問題不必計算向量
+def normalize_question(question):
+    return _WHITESPACE_PATTERN.sub("", question).lower().rstrip(_TRAILING_PUNCTUATION)
+
+# 以問題向量查詢的答案快取
+class SemanticAnswerCache:
+    """
+    每筆資料包含正規化問題、單位化的問題向量、已去敏化的答案與來源文件。
+    查詢時先比對正規化文字，再以餘弦相似度比對所有未過期的問題向量。
+    提供 find_mentions 時，每筆資料另存問題提到的檔名，語意命中必須提到完全相同的檔案
+    （「A.pdf 的摘要」與「B.pdf 的摘要」的向量幾乎相同，但答案不同）。
+    所有資料都屬於同一個語料版本；版本改變（重新索引 KM_pool）時整個快取清空。
+    """
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_MAX_ENTRIES,
+                 find_mentions=None):
+        self.threshold = threshold
+        self.find_mentions = find_mentions
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.corpus_version = None
+        self.lock = threading.Lock()
+        self._matrix = None
+        self._matrix_keys = []
+        self._matrix_mentions = []
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def lookup(self, question, corpus_version, embed):
+        """
+        查詢快取的答案。
+        Args:
+            question (str): 使用者的問題。
+            corpus_version (str): 目前的語料版本。
+            embed (callable): 將問題轉成向量的函數，只有文字比對未命中時才會呼叫。
+        Returns:
+            dict | None: 命中時回傳 {"answer", "source_docs", "question", "similarity"}，否則為 None。
+        """
+        key = normalize_question(question)
+        with self.lock:
+            self._check_version(corpus_version)
+            self._expire()
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return dict(entry, similarity=1.0)
+            if not self.entries:
+                self.misses += 1
+                return None
+            matrix, keys, mentions = self._vectors()
+
+        vector = _unit_vector(embed(question))
+        similarities = matrix @ vector
+        # 只考慮提到相同檔案的問題
+        question_mentions = self._mentions(question)
+        similarities[np.array([entry_mentions != question_mentions for entry_mentions in mentions])] = -np.inf
+        best = int(np.argmax(similarities))
+        with self.lock:
+            entry = self.entries.get(keys[best])
+            if entry is None or similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(keys[best])
+            self.hits += 1
+            self.semantic_hits += 1
+            return dict(entry, similarity=float(similarities[best]))
+
+    def store(self, question, corpus_version, embed, answer, source_docs):
+        key = normalize_question(question)
+        vector = _unit_vector(embed(question))
+        with self.lock:
+            self._check_version(corpus_version)
+            self.entries.pop(key, None)
+            self.entries[key] = {
+                "question": question,
+                "vector": vector,
+                "mentions": self._mentions(question),
+                "answer": answer,
+                "source_docs": list(source_docs),
+                "created": time.time(),
+            }
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            self._matrix = None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self._matrix = None
+
+    def _check_version(self, corpus_version):
+        if corpus_version != self.corpus_version:
+            if self.entries:
+                self.invalidations += len(self.entries)
+                self.entries.clear()
+                self._matrix = None
+            self.corpus_version = corpus_version
+
+    def _expire(self):
+        deadline = time.time() - self.ttl
+        expired = [key for key, entry in self.entries.items() if entry["created"] < deadline]
+        for key in expired:
+            del self.entries[key]
+            self.expirations += 1
+        if expired:
+            self._matrix = None
+
+    # 問題提到的檔名（未提供 find_mentions 時為空集合）
+    def _mentions(self, question):
+        return frozenset(self.find_mentions(question)) if self.find_mentions else frozenset()
+
+    # 將所有問題向量堆疊成矩陣，快取內容改變時才重建
+    def _vectors(self):
+        if self._matrix is None:
+            self._matrix_keys = list(self.entries)
+            self._matrix = np.stack([self.entries[key]["vector"] for key in self._matrix_keys])
+            self._matrix_mentions = [self.entries[key]["mentions"] for key in self._matrix_keys]
+        return self._matrix, self._matrix_keys, self._matrix_mentions
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "entries": len(self.entries),
+            }
+
+def _unit_vector(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -1,9 +1,9 @@
 import streamlit as st
-from chatbot import create_rag_chain, ask_question, process_source_documents, load_api_key, API_KEY_FILE
-import os
+from chatbot import create_rag_chain, ask_question, stream_question, process_source_documents, load_api_key, API_KEY_FILE, filename_index, restore_memory
+from embedding import detect_index_changes, manifest_path_for
+from vector_store import VECTOR_BACKEND
 import subprocess
 import time
-import json
 import warnings
 import sys  # 導入 sys 模組
 
@@ -14,7 +14,6 @@ warnings.filterwarnings("ignore")
 PDF_DIR = "./KM_pool"
 CHROMA_PATH = "./chroma_db"
 EMBEDDING_SCRIPT = "embedding.py"  # embedding 腳本的名稱
-LAST_EMBEDDED_FILES_FILE = ".last_embedded_files.txt"
 
 # 主要藍色 (參考 KGI Bank 圖片)
 primary_blue = "#0047AB"
@@ -150,8 +149,6 @@ st.markdown(
 # 初始化會話狀態
 if "messages" not in st.session_state:
     st.session_state["messages"] = []
-if "chat_history" not in st.session_state:
-    st.session_state["chat_history"] = []
 if "current_chat_id" not in st.session_state:
     st.session_state["current_chat_id"] = None
 if "all_chat_history" not in st.session_state:
@@ -169,24 +166,9 @@ if "current_sources" not in st.session_state:
 if "show_reference" not in st.session_state:
     st.session_state["show_reference"] = False  # 用來控制是否顯示參考文件
 
-def get_current_file_list(directory):
-    """獲取目前目錄下所有 .pdf 和 .docx 檔案的排序列表。"""
-    return sorted([f for f in os.listdir(directory) if f.lower().endswith((".pdf", ".docx"))])
-
-def load_last_embedded_files():
-    """從檔案載入上次成功 embedding 的檔案列表。"""
-    try:
-        with open(LAST_EMBEDDED_FILES_FILE, "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
-    except json.JSONDecodeError:
-        return []
-
-def save_last_embedded_files(file_list):
-    """將目前成功 embedding 的檔案列表儲存到檔案。"""
-    with open(LAST_EMBEDDED_FILES_FILE, "w") as f:
-        json.dump(file_list, f)
+def get_current_file_list():
+    """獲取目前目錄下所有 .pdf 和 .docx 檔案的排序列表（由檔名索引提供，資料夾未變更時不重新列出）。"""
+    return filename_index.files()
 
 def run_embedding_script(changed_files_message=""):
     """執行 embedding.py 腳本，確保使用目前的 Python 環境。"""
@@ -206,9 +188,11 @@ def run_embedding_script(changed_files_message=""):
 with st.sidebar:
     st.markdown("<p class='sidebar-title'>對話記錄</p>", unsafe_allow_html=True)
     if st.button("💬  新增對話", key="new_chat", help="開始新的對話"):
+        # 對話記憶也要清空，否則新對話仍會帶著上一段對話的內容
+        if st.session_state["rag_chain"]:
+            st.session_state["rag_chain"].memory.clear()
         st.session_state.update(
             messages=[],
-            chat_history=[],
             current_chat_id=None,
             summary_button_clicked=False,
             show_suggestion_button=True,
@@ -220,10 +204,11 @@ with st.sidebar:
 
     for chat_id, chat_info in st.session_state["all_chat_history"].items():
         if st.button(chat_info.get("title", f"對話 {chat_id}"), key=f"chat_{chat_id}"):
+            if st.session_state["rag_chain"]:
+                restore_memory(st.session_state["rag_chain"], chat_info["messages"])
             st.session_state.update(
                 current_chat_id=chat_id,
-                messages=[{"role": m["type"].lower(), "content": m["content"]} for m in chat_info["history"]],
-                chat_history=chat_info["history"],
+                messages=list(chat_info["messages"]),
                 summary_button_clicked=False,
                 show_suggestion_button=True,
                 show_sources=False,
@@ -234,7 +219,7 @@ with st.sidebar:
 
     st.markdown("---")
     st.markdown("<p class='sidebar-title'>📂 文件列表：</p>", unsafe_allow_html=True)
-    all_files = get_current_file_list(PDF_DIR)
+    all_files = get_current_file_list()
     for i, file in enumerate(all_files):
         st.markdown(f"<p class='sidebar-content'>{i+1}. {file}</p>", unsafe_allow_html=True)
 
@@ -246,11 +231,11 @@ st.markdown("<p style='font-size: 1.1em; line-height: 1.5;'>檢索檔案內文
 api_key = load_api_key(API_KEY_FILE)
 
 if api_key:
-    current_files = get_current_file_list(PDF_DIR)
-    last_embedded_files = load_last_embedded_files()
-
-    added_files = [f for f in current_files if f not in last_embedded_files]
-    removed_files = [f for f in last_embedded_files if f not in current_files]
+    # 依據 embedding.py 維護的索引清單（大小、修改時間、內容雜湊）偵測變更，原地修改的檔案也能被發現
+    index_changes = detect_index_changes(PDF_DIR, manifest_path=manifest_path_for(VECTOR_BACKEND))
+    added_files = index_changes["added"]
+    modified_files = index_changes["modified"]
+    removed_files = index_changes["removed"]
 
     changed = False
     change_messages = []
@@ -258,9 +243,18 @@ if api_key:
     if added_files:
         change_messages.append(f"新增文件：{', '.join(added_files)}")
         changed = True
+    if modified_files:
+        change_messages.append(f"修改文件：{', '.join(modified_files)}")
+        changed = True
     if removed_files:
         change_messages.append(f"刪除文件：{', '.join(removed_files)}")
         changed = True
+    if index_changes["redaction_stale"]:
+        change_messages.append("去敏化模型或規則已更新")
+        changed = True
+    if index_changes["failed"]:
+        # 讀取失敗且未變更的檔案不需要重新建立索引，只提示使用者
+        st.warning(f"⚠️ 以下文件無法讀取，已略過：{', '.join(index_changes['failed'])}")
 
     if changed:
         changes_description = "；".join(change_messages)
@@ -272,7 +266,6 @@ if api_key:
 
         if run_embedding_script(changes_description):
             processing_placeholder.success("✅ 知識庫更新完成") # 將成功訊息顯示在佔位符中
-            save_last_embedded_files(current_files)
             time.sleep(3) # 讓成功訊息停留一會兒
             st.session_state["rag_chain"] = None  # 重新載入 RAG 鏈
         else:
@@ -308,9 +301,9 @@ if api_key:
 
                 with st.spinner("思考中..."):
                     try:
-                        answer, source_docs, chat_history = ask_question(st.session_state["rag_chain"], prompt)
+                        # 固定的建議問題，由答案快取直接回答
+                        answer, source_docs, chat_history = ask_question(st.session_state["rag_chain"], prompt, use_cache=True)
                         st.session_state["messages"].append({"role": "assistant", "content": answer})
-                        st.session_state["chat_history"].extend([{"type": "human", "content": prompt}, {"type": "ai", "content": answer}])
                         # 確保 current_sources 被正確儲存
                         st.session_state["current_sources"] = source_docs[:3] if source_docs else []
                         st.session_state["show_sources"] = True
@@ -320,17 +313,16 @@ if api_key:
                             st.session_state["current_chat_id"] = new_chat_id
                             st.session_state["all_chat_history"][new_chat_id] = {
                                 "title": prompt[:10] if len(prompt) > 10 else prompt,
-                                "history": list(st.session_state["chat_history"])
+                                "messages": list(st.session_state["messages"])
                             }
                         else:
-                            st.session_state["all_chat_history"][st.session_state["current_chat_id"]]["history"] = list(st.session_state["chat_history"])
+                            st.session_state["all_chat_history"][st.session_state["current_chat_id"]]["messages"] = list(st.session_state["messages"])
                             if not st.session_state["all_chat_history"][st.session_state["current_chat_id"]].get("title"):
                                 st.session_state["all_chat_history"][st.session_state["current_chat_id"]]["title"] = prompt[:10] if len(prompt) > 10 else prompt
                     except Exception as e:
                         st.error(f"錯誤：處理問題時發生錯誤：{str(e)}")
                         answer = "抱歉，無法生成回答，請稍後再試。"
                         st.session_state["messages"].append({"role": "assistant", "content": answer})
-                        st.session_state["chat_history"].extend([{"type": "human", "content": prompt}, {"type": "ai", "content": answer}])
                         st.session_state["current_sources"] = []
                     st.rerun()
 
@@ -352,11 +344,13 @@ if api_key:
             with st.chat_message("user"):
                 st.markdown(prompt)
 
-            with st.spinner("思考中..."):
+            with st.chat_message("assistant"):
                 try:
-                    answer, source_docs, chat_history = ask_question(st.session_state["rag_chain"], prompt)
+                    with st.spinner("思考中..."):
+                        answer_stream, source_docs = stream_question(st.session_state["rag_chain"], prompt)
+                    # 逐段顯示已去敏化的回答
+                    answer = st.write_stream(answer_stream)
                     st.session_state["messages"].append({"role": "assistant", "content": answer})
-                    st.session_state["chat_history"].extend([{"type": "human", "content": prompt}, {"type": "ai", "content": answer}])
                     # 確保 current_sources 被正確儲存
                     st.session_state["current_sources"] = source_docs[:3] if source_docs else []
                     st.session_state["show_sources"] = True
@@ -367,17 +361,16 @@ if api_key:
                         st.session_state["current_chat_id"] = new_chat_id
                         st.session_state["all_chat_history"][new_chat_id] = {
                             "title": prompt[:10] if len(prompt) > 10 else prompt,
-                            "history": list(st.session_state["chat_history"])
+                            "messages": list(st.session_state["messages"])
                         }
                     else:
-                        st.session_state["all_chat_history"][st.session_state["current_chat_id"]]["history"] = list(st.session_state["chat_history"])
+                        st.session_state["all_chat_history"][st.session_state["current_chat_id"]]["messages"] = list(st.session_state["messages"])
                         if not st.session_state["all_chat_history"][st.session_state["current_chat_id"]].get("title"):
                             st.session_state["all_chat_history"][st.session_state["current_chat_id"]]["title"] = prompt[:10] if len(prompt) > 10 else prompt
                 except Exception as e:
                     st.error(f"錯誤：處理問題時發生錯誤：{str(e)}")
                     answer = "抱歉，無法生成回答，請稍後再試。"
                     st.session_state["messages"].append({"role": "assistant", "content": answer})
-                    st.session_state["chat_history"].extend([{"type": "human", "content": prompt}, {"type": "ai", "content": answer}])
                     st.session_state["current_sources"] = []
                 st.rerun()
 
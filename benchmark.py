@@ -0,0 +1,786 @@
+import os
+import json
+import asyncio
+import argparse
+import itertools
+import statistics
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import embedding
+
+# 產生測試用的中文文本
+# 不混入英文：舊版 split_text 在重疊區內遇到空白或英文標點時 start 會倒退，可能無法結束
+def make_sample_text(size_chars, seed=0):
+    rng = random.Random(seed)
+    parts = []
+    total = 0
+    while total < size_chars:
+        sentence = "".join(chr(rng.randint(0x4E00, 0x4E00 + 3000)) for _ in range(rng.randint(8, 60)))
+        sentence += rng.choice("。！？；")
+        parts.append(sentence)
+        total += len(sentence)
+    return "".join(parts)
+
+# 計算多次執行的最短耗時（秒）
+def best_of(func, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+# 舊版 split_text，僅作為效能比較的基準
+def legacy_split_text(text, chunk_size=embedding.CHUNK_SIZE, overlap=embedding.CHUNK_OVERLAP):
+    if not text:
+        return []
+
+    chunks = []
+    start = 0
+    text_length = len(text)
+
+    while start < text_length:
+        end = min(start + chunk_size, text_length)
+        # 確保不切斷單詞
+        if end < text_length:
+            while end > start and text[end] not in " .!?":
+                end -= 1
+            if end == start:
+                end = min(start + chunk_size, text_length)
+
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        start = end - overlap if end < text_length else text_length
+
+    return chunks
+
+# 比較新舊 chunker 的速度與句中切斷的比例
+def bench_chunker(args):
+    text = make_sample_text(int(args.size_mb * 1024 * 1024))
+    print(f"測試文本長度：{len(text)} 字元")
+    for name, func in (("legacy split_text", legacy_split_text), ("split_text", embedding.split_text)):
+        seconds, chunks = best_of(lambda: func(text, embedding.CHUNK_SIZE, embedding.CHUNK_OVERLAP), args.repeat)
+        mid_sentence = sum(1 for chunk in chunks[:-1] if not embedding.SENTENCE_BOUNDARY_PATTERN.search(chunk[-1:]))
+        print(f"{name:>20}：{seconds * 1000:8.1f} ms，{len(chunks)} 個 chunk，"
+              f"{len(text) / seconds / 1e6:.1f} M 字元/秒，句中切斷 {mid_sentence / max(len(chunks), 1):.1%}")
+
+# 比較逐篇與批次 NER 的延遲
+def bench_ner(args):
+    import ner_guardrails
+
+    if ner_guardrails.ner_pipeline is None:
+        print("NER 模型未載入，無法測試")
+        return
+    rng = random.Random(0)
+    texts = [make_sample_text(args.chars, seed=rng.random()) + "聯絡電話 0223148800，email example@gmail.com。"
+             for _ in range(args.docs)]
+    ner_guardrails.extract_entities_batch(texts[:1])  # 預熱
+    per_doc, single = best_of(lambda: [ner_guardrails.extract_entities_with_regex(t) for t in texts], args.repeat)
+    batched, batch = best_of(lambda: ner_guardrails.extract_entities_batch(texts, args.batch_size), args.repeat)
+    same = all(sorted((e["start"], e["end"]) for e in a) == sorted((e["start"], e["end"]) for e in b)
+               for a, b in zip(single, batch))
+    print(f"{args.docs} 篇 × {args.chars} 字元")
+    print(f"  逐篇：{per_doc * 1000:8.1f} ms（每篇 {per_doc / args.docs * 1000:.1f} ms）")
+    print(f"  批次：{batched * 1000:8.1f} ms（每篇 {batched / args.docs * 1000:.1f} ms，batch_size={args.batch_size}）")
+    print(f"  加速 {per_doc / batched:.2f} 倍，實體位置一致：{same}")
+    regex_only, _ = best_of(lambda: ner_guardrails.redact_texts(texts, use_ner=False), args.repeat)
+    print(f"  只用正則表達式去敏化：{regex_only * 1000:8.1f} ms")
+
+# 模擬 Gemini API 的本機 HTTP 伺服器：前 fail_first 次請求回傳 503（附 Retry-After），之後正常回應
+class FakeGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.05, fail_first=0, retry_after="0.1", answer="這是測試回答。"):
+        super().__init__(("127.0.0.1", 0), FakeGeminiHandler)
+        self.latency = latency
+        self.fail_first = fail_first
+        self.retry_after = retry_after
+        self.answer = answer
+        self.requests = 0
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1beta/models/fake:generateContent"
+
+    @property
+    def stream_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1beta/models/fake:streamGenerateContent?alt=sse"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支援 keep-alive
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with server.lock:
+            server.requests += 1
+            count = server.requests
+            server.connections.add(self.client_address)
+        time.sleep(server.latency)
+        if count <= server.fail_first:
+            self._send(503, b"{}", "application/json", {"Retry-After": server.retry_after})
+            return
+        if "streamGenerateContent" in self.path:
+            events = [f"data: {json.dumps({'candidates': [{'content': {'parts': [{'text': part}]}}]}, ensure_ascii=False)}\n\n"
+                      for part in (server.answer[:2], server.answer[2:])]
+            self._send(200, "".join(events).encode("utf-8"), "text/event-stream")
+        else:
+            body = {"candidates": [{"content": {"parts": [{"text": server.answer}]}}]}
+            self._send(200, json.dumps(body, ensure_ascii=False).encode("utf-8"), "application/json")
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+# 對本機模擬伺服器測試 GeminiAPI 的連線重用、重試與延遲
+def bench_gemini(args):
+    from chatbot import GeminiAPI
+
+    with FakeGeminiServer(latency=args.latency, fail_first=args.fail_first) as server:
+        llm = GeminiAPI(api_key="test", api_url=server.url, stream_api_url=server.stream_url,
+                        max_new_tokens=100, temperature=0.5)
+        started = time.perf_counter()
+        answers = [llm.invoke("測試問題") for _ in range(args.requests)]
+        elapsed = time.perf_counter() - started
+        streamed = "".join(llm.stream("測試問題"))
+        print(f"{args.requests} 次請求：總計 {elapsed * 1000:.1f} ms，平均 {elapsed / args.requests * 1000:.1f} ms")
+        print(f"伺服器收到 {server.requests} 次請求（含 {args.fail_first} 次 503），使用 {len(server.connections)} 條連線")
+        print(f"回答正確：{all(a == server.answer for a in answers)}，串流回答正確：{streamed == server.answer}")
+
+# 統計延遲分佈（毫秒）
+def latency_summary(latencies):
+    ordered = sorted(latencies)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return f"p50 {statistics.median(ordered) * 1000:.1f} ms，p95 {p95 * 1000:.1f} ms"
+
+# 比較執行緒池同步呼叫與 asyncio 並行呼叫 GeminiAPI 的吞吐量
+def bench_concurrency(args):
+    from concurrent.futures import ThreadPoolExecutor
+    from chatbot import GeminiAPI
+
+    def timed_invoke(llm):
+        started = time.perf_counter()
+        llm.invoke("測試問題")
+        return time.perf_counter() - started
+
+    async def timed_ainvoke(llm):
+        started = time.perf_counter()
+        await llm.ainvoke("測試問題")
+        return time.perf_counter() - started
+
+    async def run_async(llm):
+        try:
+            return await asyncio.gather(*(timed_ainvoke(llm) for _ in range(args.requests)))
+        finally:
+            await llm.aclose()
+
+    with FakeGeminiServer(latency=args.latency) as server:
+        llm = GeminiAPI(api_key="test", api_url=server.url, stream_api_url=server.stream_url,
+                        max_new_tokens=100, temperature=0.5)
+        print(f"{args.requests} 個並行請求，模擬伺服器延遲 {args.latency * 1000:.0f} ms")
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            latencies = list(pool.map(lambda _: timed_invoke(llm), range(args.requests)))
+        elapsed = time.perf_counter() - started
+        print(f"  同步（{args.threads} 執行緒）：{elapsed:6.2f} 秒，{args.requests / elapsed:7.1f} 請求/秒，{latency_summary(latencies)}")
+
+        started = time.perf_counter()
+        latencies = asyncio.run(run_async(llm))
+        elapsed = time.perf_counter() - started
+        print(f"  非同步（asyncio）：{elapsed:6.2f} 秒，{args.requests / elapsed:7.1f} 請求/秒，{latency_summary(latencies)}")
+
+# 預設的多輪對話：追問中省略檔名，用來比較各改寫模式的檢索結果
+def default_conversation():
+    from chatbot import get_available_filenames
+
+    files = get_available_filenames()
+    if not files:
+        return []
+    turns = []
+    for file_name in files[:3]:
+        base_name = os.path.splitext(file_name)[0]
+        turns.append({"question": f"{base_name} 的摘要", "expected_file": file_name})
+        turns.append({"question": "它的重點是什麼？", "expected_file": file_name})
+        turns.append({"question": "有提到哪些數字？", "expected_file": file_name})
+    return turns
+
+# 比較各問題改寫模式的每步耗時與檢索命中率（需要 API 金鑰與向量資料庫）
+def bench_rewrite(args):
+    from chatbot import create_rag_chain, ask_question, load_api_key, API_KEY_FILE, REWRITE_MODES
+
+    if args.conversation:
+        with open(args.conversation, "r", encoding="utf-8") as f:
+            turns = json.load(f)
+    else:
+        turns = default_conversation()
+    if not turns:
+        print("沒有可用的對話，請以 --conversation 指定 JSON 檔（[{\"question\": ..., \"expected_file\": ...}]）")
+        return
+    rag_chain = create_rag_chain(load_api_key(API_KEY_FILE))
+    if rag_chain is None:
+        return
+    for mode in args.modes or REWRITE_MODES:
+        rag_chain.memory.clear()
+        totals = {}
+        hits = 0
+        expected = 0
+        for turn in turns:
+            timings = {}
+            _, source_docs, _ = ask_question(rag_chain, turn["question"], use_cache=False, rewrite_mode=mode, timings=timings)
+            for name, seconds in timings.items():
+                if isinstance(seconds, float):
+                    totals[name] = totals.get(name, 0.0) + seconds
+            if turn.get("expected_file"):
+                expected += 1
+                hits += any(doc.metadata.get("file_name") == turn["expected_file"] for doc in source_docs)
+        averages = "、".join(f"{name} {seconds / len(turns) * 1000:.0f} ms" for name, seconds in totals.items())
+        print(f"{mode:>10}：平均 {averages}")
+        if expected:
+            print(f"{'':>10}  檢索到預期檔案：{hits}/{expected}（{hits / expected:.0%}）")
+
+# 比較完整保留與有 token 預算的對話記憶在長對話中的提示詞大小與延遲
+def bench_memory(args):
+    from langchain.memory import ConversationBufferMemory
+    from chatbot import GeminiAPI
+    from conversation_memory import TokenBudgetMemory
+    from token_counter import estimate_tokens
+
+    answer = make_sample_text(args.answer_chars, seed=1)
+    checkpoints = sorted({1, 10, args.turns // 4, args.turns // 2, args.turns})
+    with FakeGeminiServer(latency=args.latency, answer=answer) as server:
+        llm = GeminiAPI(api_key="test", api_url=server.url, stream_api_url=server.stream_url,
+                        max_new_tokens=args.answer_chars, temperature=0.5)
+        memories = {
+            "ConversationBufferMemory": ConversationBufferMemory(memory_key="chat_history", input_key="question",
+                                                                 output_key="answer", return_messages=True),
+            "TokenBudgetMemory": TokenBudgetMemory(llm=llm, memory_key="chat_history", input_key="question",
+                                                   output_key="answer", return_messages=True),
+        }
+        for name, memory in memories.items():
+            print(name)
+            for turn in range(1, args.turns + 1):
+                question = f"第 {turn} 個問題：{make_sample_text(30, seed=turn)}"
+                started = time.perf_counter()
+                history = memory.load_memory_variables({})["chat_history"]
+                _, payload = llm._build_request(question, chat_history=history)
+                llm.invoke(question, chat_history=history)
+                elapsed = time.perf_counter() - started
+                memory.save_context({"question": question}, {"answer": answer})
+                if turn in checkpoints:
+                    prompt_tokens = estimate_tokens(payload["contents"][0]["parts"][0]["text"])
+                    print(f"  第 {turn:>3} 輪：提示詞約 {prompt_tokens:>6} tokens，延遲 {elapsed * 1000:7.1f} ms")
+            if isinstance(memory, TokenBudgetMemory):
+                memory.wait_for_summary()
+
+# 產生含產品代碼的合成語料，以及查詢代碼與查詢內文片段的問題
+# 內文從依 Zipf 分布抽樣的詞彙組成，詞彙與二元組的分布比隨機字元更接近真實文件
+def make_hybrid_corpus(num_docs, chars, vocabulary_size=8000, seed=0):
+    rng = random.Random(seed)
+    vocabulary = ["".join(chr(rng.randint(0x4E00, 0x4E00 + 3000)) for _ in range(rng.randint(1, 3)))
+                  for _ in range(vocabulary_size)]
+    cumulative_weights = list(itertools.accumulate(1.0 / rank for rank in range(1, vocabulary_size + 1)))
+    letters = "ABCDEFGHJKLMNPQRSTUVWXYZ"
+    ids, documents, metadatas, queries = [], [], [], []
+    for i in range(num_docs):
+        code = f"{rng.choice(letters)}{rng.choice(letters)}-{rng.randint(1000, 9999)}"
+        words = []
+        total = 0
+        while total < chars:
+            sentence = "".join(rng.choices(vocabulary, cum_weights=cumulative_weights, k=rng.randint(4, 20))) + rng.choice("。！？；")
+            words.append(sentence)
+            total += len(sentence)
+        text = "".join(words)
+        position = rng.randint(0, len(text))
+        ids.append(f"doc{i}")
+        documents.append(f"{text[:position]}產品代碼 {code}。{text[position:]}")
+        metadatas.append({"file_name": f"file{i // 20}.pdf"})
+        if i % 2 == 0:
+            queries.append((f"{code} 的規定是什麼？", f"doc{i}"))
+        else:
+            start = rng.randint(0, max(0, len(text) - 16))
+            queries.append((text[start:start + 16], f"doc{i}"))
+    return ids, documents, metadatas, queries
+
+# 比較向量、BM25 與混合（RRF）檢索的 recall@k 與延遲；向量部分需要嵌入模型
+def bench_hybrid(args):
+    import tempfile
+    import numpy as np
+    from lexical_index import LexicalIndex, reciprocal_rank_fusion
+
+    ids, documents, metadatas, queries = make_hybrid_corpus(args.docs, args.chars)
+    queries = queries[:args.queries]
+    with tempfile.TemporaryDirectory() as directory:
+        index = LexicalIndex(os.path.join(directory, "lexical.sqlite3"))
+        started = time.perf_counter()
+        for start in range(0, len(ids), embedding.EMBED_BATCH_SIZE):
+            end = start + embedding.EMBED_BATCH_SIZE
+            index.add(ids[start:end], documents[start:end], metadatas[start:end])
+        index.commit()
+        print(f"建立文字索引：{len(ids)} 個 chunk，{time.perf_counter() - started:.2f} 秒，"
+              f"{os.path.getsize(index.path) / 1024 / 1024:.1f} MB")
+
+        searches = {"BM25": lambda query: [chunk_id for chunk_id, _ in index.search(query, args.candidates)]}
+        if os.path.exists(embedding.MODEL_PATH):
+            model = embedding.load_sentence_model()
+            started = time.perf_counter()
+            vectors = np.asarray(model.encode(documents, batch_size=64, normalize_embeddings=True), dtype=np.float32)
+            print(f"嵌入語料：{time.perf_counter() - started:.2f} 秒")
+
+            def dense(query):
+                scores = vectors @ np.asarray(model.encode([query], normalize_embeddings=True)[0], dtype=np.float32)
+                top = np.argpartition(-scores, args.candidates - 1)[:args.candidates]
+                return [ids[i] for i in top[np.argsort(-scores[top])]]
+
+            searches = {
+                "向量": dense,
+                "BM25": searches["BM25"],
+                "混合（RRF）": lambda query: reciprocal_rank_fusion([dense(query), searches["BM25"](query)]),
+            }
+        else:
+            print(f"找不到嵌入模型 {embedding.MODEL_PATH}，只測試 BM25")
+
+        for name, search in searches.items():
+            hits = {k: 0 for k in args.k}
+            latencies = []
+            for query, expected in queries:
+                started = time.perf_counter()
+                ranked = search(query)
+                latencies.append(time.perf_counter() - started)
+                for k in args.k:
+                    hits[k] += expected in ranked[:k]
+            recalls = "、".join(f"recall@{k} {hits[k] / len(queries):.0%}" for k in args.k)
+            print(f"{name:>8}：{recalls}，{latency_summary(latencies)}")
+        index.close()
+
+# 比較一般 top-k 與 MMR 的檢索結果重複程度與延遲
+# 合成資料：每段文字切成 neighbours 個重疊 chunk，向量彼此非常接近；有向量資料庫時另測 ChromaRetriever 的實際延遲
+def bench_mmr(args):
+    import numpy as np
+    from mmr import maximal_marginal_relevance, normalize_rows
+
+    rng = np.random.default_rng(0)
+    passages = normalize_rows(rng.normal(size=(args.passages, args.dim)))
+    vectors = normalize_rows(np.repeat(passages, args.neighbours, axis=0)
+                             + rng.normal(scale=0.05, size=(args.passages * args.neighbours, args.dim)))
+    passage_of = np.repeat(np.arange(args.passages), args.neighbours)
+    queries = normalize_rows(passages[rng.integers(0, args.passages, args.queries)]
+                             + rng.normal(scale=0.15, size=(args.queries, args.dim)))
+    print(f"{len(vectors)} 個 chunk（每段 {args.neighbours} 個相鄰 chunk），{args.queries} 個查詢，k={args.k}")
+    for fetch_k in [None] + args.fetch_k:
+        distinct = []
+        latencies = []
+        for query in queries:
+            scores = vectors @ query
+            pool = fetch_k or args.k
+            candidates = np.argpartition(-scores, pool - 1)[:pool]
+            candidates = candidates[np.argsort(-scores[candidates])]
+            started = time.perf_counter()
+            if fetch_k:
+                candidates = candidates[maximal_marginal_relevance(query, vectors[candidates], args.k, args.mmr_lambda)]
+            latencies.append(time.perf_counter() - started)
+            distinct.append(len(set(passage_of[candidates[:args.k]])))
+        name = f"MMR fetch_k={fetch_k}" if fetch_k else "top-k"
+        print(f"{name:>16}：平均 {statistics.mean(distinct):.2f} 個不同段落，MMR 計算 {latency_summary(latencies)}")
+
+    if not (os.path.exists(embedding.MODEL_PATH) and os.path.exists(embedding.CHROMA_PATH)):
+        print("找不到嵌入模型或向量資料庫，略過 ChromaRetriever 的實際延遲測試")
+        return
+    from chatbot import setup_vectorstore, ChromaRetriever
+
+    collection = setup_vectorstore()
+    questions = [turn["question"] for turn in default_conversation() if "摘要" in turn["question"]] or ["摘要"]
+    for use_mmr in (False, True):
+        retriever = ChromaRetriever(collection=collection, k=args.k, use_mmr=use_mmr,
+                                    mmr_lambda=args.mmr_lambda, fetch_k=max(args.fetch_k))
+        retriever.invoke(questions[0])  # 暖機：載入模型與查詢向量快取
+        latencies = []
+        for question in questions * 5:
+            started = time.perf_counter()
+            retriever.invoke(question)
+            latencies.append(time.perf_counter() - started)
+        print(f"ChromaRetriever（{'MMR' if use_mmr else 'top-k'}）：{latency_summary(latencies)}")
+
+# 目前行程的常駐記憶體 (MB)；ru_maxrss 會沿用 fork 前父行程的高水位，這裡讀取 /proc（僅 Linux）
+def current_rss_mb():
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+# 在新的行程中開啟向量資料庫並查詢，回傳載入時間、查詢延遲與常駐記憶體（避免彼此的快取影響結果）
+def probe_vector_store(backend, path, dim, queries, k, seed=1):
+    import numpy as np
+    from vector_store import open_vector_store
+
+    rss_before = current_rss_mb()
+    started = time.perf_counter()
+    store = open_vector_store(backend, chroma_path=path, collection_name="benchmark", flat_path=path)
+    store.count()
+    load_seconds = time.perf_counter() - started
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(queries, dim)).astype(np.float32)
+    latencies = {}
+    for name, where in (("全部", None), ("file_name", {"file_name": "file7.pdf"}), ("$ne", {"file_name": {"$ne": "file7.pdf"}})):
+        # 第一次查詢另外計時：Chroma 載入 HNSW 索引、flat 映射並轉換矩陣都發生在第一次查詢
+        started = time.perf_counter()
+        store.query(query_embeddings=[vectors[0].tolist()], n_results=k, where=where, include=["metadatas", "documents"])
+        first = time.perf_counter() - started
+        timings = []
+        for vector in vectors[1:]:
+            started = time.perf_counter()
+            store.query(query_embeddings=[vector.tolist()], n_results=k, where=where, include=["metadatas", "documents"])
+            timings.append(time.perf_counter() - started)
+        latencies[name] = (first, timings)
+    return {"load": load_seconds, "latencies": latencies, "rss": current_rss_mb() - rss_before}
+
+# 比較 Chroma 與 flat 後端在不同語料大小下的冷啟動、查詢延遲與記憶體
+def bench_vectorstore(args):
+    import tempfile
+    import multiprocessing
+    import numpy as np
+    from vector_store import open_vector_store
+
+    context = multiprocessing.get_context("spawn")
+    for size in args.sizes:
+        print(f"{size} 個 chunk，{args.dim} 維")
+        with tempfile.TemporaryDirectory() as directory:
+            for backend in args.backends:
+                path = os.path.join(directory, backend)
+                try:
+                    store = open_vector_store(backend, chroma_path=path, collection_name="benchmark", flat_path=path)
+                except ImportError as e:
+                    print(f"  {backend}：無法載入（{e}）")
+                    continue
+                rng = np.random.default_rng(0)
+                started = time.perf_counter()
+                for start in range(0, size, args.batch_size):
+                    count = min(args.batch_size, size - start)
+                    store.upsert(ids=[f"chunk{i}" for i in range(start, start + count)],
+                                 documents=[f"第 {i} 個文本片段" for i in range(start, start + count)],
+                                 metadatas=[{"file_name": f"file{i // 100}.pdf", "chunk_id": i} for i in range(start, start + count)],
+                                 embeddings=rng.normal(size=(count, args.dim)).astype(np.float32).tolist())
+                build_seconds = time.perf_counter() - started
+                del store
+                with context.Pool(1) as pool:
+                    result = pool.apply(probe_vector_store, (backend, path, args.dim, args.queries, args.k))
+                print(f"  {backend:>6}：寫入 {build_seconds:7.1f} 秒，載入 {result['load'] * 1000:7.1f} ms，"
+                      f"開啟並查詢後常駐記憶體增加 {result['rss']:6.0f} MB")
+                for name, (first, timings) in result["latencies"].items():
+                    print(f"  {'':>6}  {name:>9}：第一次 {first * 1000:7.1f} ms，之後 {latency_summary(timings)}")
+
+# 比較 flat 後端的 float16 / int8 矩陣與 float32 重新排序的 recall@k、延遲、磁碟與記憶體用量
+def bench_quantization(args):
+    import tempfile
+    import numpy as np
+    from mmr import normalize_rows
+    from vector_store import FlatVectorStore
+
+    # flat 後端以 cosine 排序，測試向量先正規化，真值即為內積排序；相近的 chunk 聚成群，讓量化誤差足以改變鄰近結果的排序
+    rng = np.random.default_rng(0)
+    centers = normalize_rows(rng.normal(size=(max(1, args.size // 50), args.dim)))
+    vectors = normalize_rows(centers[rng.integers(0, len(centers), args.size)]
+                             + rng.normal(scale=0.5 / np.sqrt(args.dim), size=(args.size, args.dim))).astype(np.float32)
+    queries = normalize_rows(vectors[rng.integers(0, args.size, args.queries)]
+                             + rng.normal(scale=0.5 / np.sqrt(args.dim), size=(args.queries, args.dim))).astype(np.float32)
+    exact = np.argsort(-(queries @ vectors.T), axis=1)[:, :args.k]  # 正規化向量的內積即 cosine
+    print(f"{args.size} 個 chunk，{args.dim} 維，{args.queries} 個查詢，k={args.k}；"
+          f"float32 矩陣 {vectors.nbytes / 1024 / 1024:.1f} MB")
+    for quantization in args.quantizations:
+        for full_precision in (False, True):
+            with tempfile.TemporaryDirectory() as directory:
+                store = FlatVectorStore(directory, quantization=quantization, full_precision=full_precision,
+                                        float32_cache_mb=args.float32_cache_mb, rescore_factor=args.rescore_factor)
+                for start in range(0, args.size, 10000):
+                    batch = vectors[start:start + 10000]
+                    store.upsert(ids=[str(i) for i in range(start, start + len(batch))],
+                                 metadatas=[{"file_name": f"file{i // 100}.pdf"} for i in range(start, start + len(batch))],
+                                 embeddings=batch)
+                store.query([queries[0]], n_results=args.k, include=[])  # 暖機：映射矩陣並建立 float32 快取
+                recalls = []
+                latencies = []
+                for query, truth in zip(queries, exact):
+                    started = time.perf_counter()
+                    ids = store.query([query], n_results=args.k, include=[])["ids"][0]
+                    latencies.append(time.perf_counter() - started)
+                    recalls.append(len(set(map(int, ids)) & set(truth.tolist())) / args.k)
+                disk = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+                           if not name.startswith("chunks.sqlite3"))
+                if store._float32 is not None:
+                    resident = store._float32.nbytes + store._norms.nbytes
+                else:
+                    resident = sum(store._arrays[name].nbytes for name in ("vectors", "scales") if name in store._arrays)
+                cache_mb = store.float32_cache_mb
+                store.close()
+            name = f"{quantization}{' + float32 重新排序' if full_precision else ''}"
+            print(f"  {name:>24}：recall@{args.k} {statistics.mean(recalls):.4f}，{latency_summary(latencies)}，"
+                  f"磁碟 {disk / 1024 / 1024:7.1f} MB，搜尋矩陣常駐 {resident / 1024 / 1024:7.1f} MB（float32 快取上限 {cache_mb} MB）")
+
+# 比較嵌入模型與 NER 模型在 PyTorch 與 ONNX Runtime（float32 / 動態 int8）下的一致性、延遲與吞吐量
+def bench_onnx(args):
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+    from transformers import AutoModelForTokenClassification, AutoTokenizer, pipeline
+    import onnx_inference
+    from ner_guardrails import local_model_path
+
+    rng = random.Random(0)
+    chunks = [make_sample_text(args.chars, seed=rng.random())[:args.chars] + "聯絡人王小明，電話 0223148800，email example@gmail.com。"
+              for _ in range(args.docs)]
+    queries = [make_sample_text(20, seed=rng.random()) for _ in range(args.queries)]
+
+    def measure(encode, recognize):
+        encode(chunks[:2])  # 預熱
+        recognize(chunks[:2])
+        embed_seconds, vectors = best_of(lambda: encode(chunks), args.repeat)
+        ner_seconds, entities = best_of(lambda: recognize(chunks), args.repeat)
+        query_latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            encode([query])
+            query_latencies.append(time.perf_counter() - started)
+        chunk_latencies = []
+        for chunk in chunks[:args.queries]:
+            started = time.perf_counter()
+            recognize([chunk])
+            chunk_latencies.append(time.perf_counter() - started)
+        print(f"    嵌入：{args.docs / embed_seconds:7.1f} chunks/秒，單一查詢 {latency_summary(query_latencies)}")
+        print(f"    NER ：{args.docs / ner_seconds:7.1f} chunks/秒，單一 chunk {latency_summary(chunk_latencies)}")
+        return np.asarray(vectors, dtype=np.float32), [{(e["entity_group"], int(e["start"]), int(e["end"])) for e in found}
+                                                      for found in entities]
+
+    print(f"{args.docs} 個 chunk × {args.chars} 字元，{args.queries} 個查詢")
+    print("  PyTorch")
+    sentence_model = SentenceTransformer(embedding.MODEL_PATH, device="cpu")
+    ner = pipeline("ner", model=AutoModelForTokenClassification.from_pretrained(local_model_path),
+                   tokenizer=AutoTokenizer.from_pretrained(local_model_path), aggregation_strategy="simple")
+    expected_vectors, expected_entities = measure(
+        lambda texts: sentence_model.encode(texts, batch_size=args.batch_size, show_progress_bar=False),
+        lambda texts: ner(texts, batch_size=args.ner_batch_size))
+    del sentence_model, ner
+
+    for quantized in (False, True):
+        name = "ONNX Runtime int8" if quantized else "ONNX Runtime float32"
+        if not (os.path.exists(onnx_inference.onnx_model_file(embedding.MODEL_PATH, quantized))
+                and os.path.exists(onnx_inference.onnx_model_file(local_model_path, quantized))):
+            print(f"  {name}：尚未匯出，請執行 python onnx_inference.py{' --quantize' if quantized else ''}")
+            continue
+        print(f"  {name}")
+        encoder = onnx_inference.OnnxSentenceEncoder(embedding.MODEL_PATH, quantized=quantized)
+        recognizer = onnx_inference.OnnxTokenClassificationPipeline(local_model_path, quantized=quantized)
+        vectors, entities = measure(lambda texts: encoder.encode(texts, batch_size=args.batch_size),
+                                    lambda texts: recognizer(texts, batch_size=args.ner_batch_size))
+        cosine = (vectors * expected_vectors).sum(axis=1) / (
+            np.linalg.norm(vectors, axis=1) * np.linalg.norm(expected_vectors, axis=1))
+        matched = sum(len(a & b) for a, b in zip(entities, expected_entities))
+        found = sum(len(a) for a in entities)
+        expected = sum(len(b) for b in expected_entities)
+        print(f"    與 PyTorch 一致性：cosine 最小 {cosine.min():.6f}，平均 {cosine.mean():.6f}；"
+              f"實體 precision {matched / max(1, found):.3f}，recall {matched / max(1, expected):.3f}，"
+              f"完全相同的 chunk {statistics.mean(a == b for a, b in zip(entities, expected_entities)):.0%}")
+
+# 比較直接搜尋全部 chunk 與先以中心向量挑出 M 個檔案再搜尋的 recall@k 與延遲
+def bench_routing(args):
+    import tempfile
+    import numpy as np
+    from mmr import normalize_rows
+    from centroid_index import CentroidIndex
+    from vector_store import open_vector_store
+
+    # 每個檔案一個主題，每頁在主題附近有子主題，chunk 再加上雜訊；查詢取自某個 chunk 附近
+    rng = np.random.default_rng(0)
+    files = normalize_rows(rng.normal(size=(args.files, args.dim)))
+    pages = normalize_rows(np.repeat(files, args.pages, axis=0)
+                           + args.page_spread * normalize_rows(rng.normal(size=(args.files * args.pages, args.dim))))
+    vectors = normalize_rows(np.repeat(pages, args.chunks_per_page, axis=0)
+                             + args.chunk_spread * normalize_rows(rng.normal(size=(len(pages) * args.chunks_per_page, args.dim))))
+    vectors = vectors.astype(np.float32)
+    size = len(vectors)
+    chunk_file = np.arange(size) // (args.pages * args.chunks_per_page)
+    chunk_page = np.arange(size) // args.chunks_per_page % args.pages + 1
+    queries = normalize_rows(vectors[rng.integers(0, size, args.queries)]
+                             + args.query_spread * normalize_rows(rng.normal(size=(args.queries, args.dim)))).astype(np.float32)
+    exact = np.argsort(-(queries @ vectors.T), axis=1)[:, :args.k]
+    ids = [str(i) for i in range(size)]
+    metadatas = [{"file_name": f"file{chunk_file[i]}.pdf", "page_num": int(chunk_page[i])} for i in range(size)]
+    print(f"{args.files} 個檔案 × {args.pages} 頁 × {args.chunks_per_page} 個 chunk = {size} 個 chunk，"
+          f"{args.queries} 個查詢，k={args.k}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        centroids = CentroidIndex(os.path.join(directory, "centroids.sqlite3"))
+        started = time.perf_counter()
+        for start in range(0, size, 5000):
+            centroids.add(ids[start:start + 5000], vectors[start:start + 5000], metadatas[start:start + 5000])
+        print(f"  中心向量索引：建立 {time.perf_counter() - started:.1f} 秒，{centroids.file_count()} 個檔案")
+        for backend in args.backends:
+            path = os.path.join(directory, backend)
+            try:
+                store = open_vector_store(backend, chroma_path=path, collection_name="benchmark", flat_path=path)
+            except ImportError as e:
+                print(f"  {backend}：無法載入（{e}）")
+                continue
+            for start in range(0, size, 5000):
+                store.upsert(ids=ids[start:start + 5000], metadatas=metadatas[start:start + 5000],
+                             documents=ids[start:start + 5000], embeddings=vectors[start:start + 5000].tolist())
+            print(f"  {backend}")
+            for route_files in [0] + args.route_files:
+                store.query(query_embeddings=[queries[0].tolist()], n_results=args.k, include=["metadatas"])  # 預熱
+                recalls = []
+                file_hits = []
+                route_latencies = []
+                latencies = []
+                for query, truth in zip(queries, exact):
+                    started = time.perf_counter()
+                    where = None
+                    if route_files:
+                        routed = centroids.route(query, route_files)
+                        route_latencies.append(time.perf_counter() - started)
+                        where = {"file_name": {"$in": routed}}
+                        file_hits.append(len(set(routed) & {metadatas[i]["file_name"] for i in truth})
+                                         / len({metadatas[i]["file_name"] for i in truth}))
+                    found = store.query(query_embeddings=[query.tolist()], n_results=args.k, where=where,
+                                        include=["metadatas"])["ids"][0]
+                    latencies.append(time.perf_counter() - started)
+                    recalls.append(len(set(map(int, found)) & set(truth.tolist())) / args.k)
+                if route_files:
+                    name = f"前 {route_files} 個檔案"
+                    detail = f"，正確檔案命中 {statistics.mean(file_hits):.3f}，分流 {latency_summary(route_latencies)}"
+                else:
+                    name = "全部 chunk"
+                    detail = ""
+                print(f"    {name:>10}：recall@{args.k} {statistics.mean(recalls):.3f}，{latency_summary(latencies)}{detail}")
+            del store
+        centroids.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG Chatbot 效能測試")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    chunker = subparsers.add_parser("chunker", help="比較 split_text 與舊版 chunker")
+    chunker.add_argument("--size-mb", type=float, default=4.0, help="測試文本大小（MB 字元）")
+    chunker.add_argument("--repeat", type=int, default=3)
+    chunker.set_defaults(func=bench_chunker)
+
+    ner = subparsers.add_parser("ner", help="比較逐篇與批次 NER 延遲")
+    ner.add_argument("--docs", type=int, default=8, help="文本數（相當於檢索的 k）")
+    ner.add_argument("--chars", type=int, default=500, help="每篇文本的字元數")
+    ner.add_argument("--batch-size", type=int, default=16)
+    ner.add_argument("--repeat", type=int, default=3)
+    ner.set_defaults(func=bench_ner)
+
+    gemini = subparsers.add_parser("gemini", help="以本機模擬伺服器測試 GeminiAPI 的連線池與重試")
+    gemini.add_argument("--requests", type=int, default=20)
+    gemini.add_argument("--latency", type=float, default=0.05, help="模擬伺服器每次回應的延遲（秒）")
+    gemini.add_argument("--fail-first", type=int, default=2, help="前幾次請求回傳 503")
+    gemini.set_defaults(func=bench_gemini)
+
+    concurrency = subparsers.add_parser("concurrency", help="比較同步與非同步 GeminiAPI 的並行吞吐量")
+    concurrency.add_argument("--requests", type=int, default=300)
+    concurrency.add_argument("--latency", type=float, default=0.5, help="模擬伺服器每次回應的延遲（秒）")
+    concurrency.add_argument("--threads", type=int, default=16, help="同步基準使用的執行緒數")
+    concurrency.set_defaults(func=bench_concurrency)
+
+    rewrite = subparsers.add_parser("rewrite", help="比較問題改寫模式的耗時與檢索品質")
+    rewrite.add_argument("--conversation", help="對話 JSON 檔，預設以 KM_pool 的檔名產生追問")
+    rewrite.add_argument("--modes", nargs="+", choices=("off", "heuristic", "llm"))
+    rewrite.set_defaults(func=bench_rewrite)
+
+    memory = subparsers.add_parser("memory", help="比較長對話中對話記憶的提示詞大小與延遲")
+    memory.add_argument("--turns", type=int, default=100)
+    memory.add_argument("--answer-chars", type=int, default=300, help="模擬回答的字元數")
+    memory.add_argument("--latency", type=float, default=0.01, help="模擬伺服器每次回應的延遲（秒）")
+    memory.set_defaults(func=bench_memory)
+
+    hybrid = subparsers.add_parser("hybrid", help="比較向量、BM25 與混合檢索的 recall@k 與延遲")
+    hybrid.add_argument("--docs", type=int, default=20000, help="合成語料的 chunk 數")
+    hybrid.add_argument("--chars", type=int, default=embedding.CHUNK_SIZE, help="每個 chunk 的字元數")
+    hybrid.add_argument("--queries", type=int, default=200)
+    hybrid.add_argument("--candidates", type=int, default=20, help="每種檢索取的候選數")
+    hybrid.add_argument("--k", type=int, nargs="+", default=[1, 3, 10])
+    hybrid.set_defaults(func=bench_hybrid)
+
+    mmr = subparsers.add_parser("mmr", help="比較一般 top-k 與 MMR 的結果重複程度與延遲")
+    mmr.add_argument("--passages", type=int, default=5000, help="合成語料的段落數")
+    mmr.add_argument("--neighbours", type=int, default=3, help="每段切成的相鄰 chunk 數")
+    mmr.add_argument("--dim", type=int, default=384, help="向量維度（MiniLM 為 384）")
+    mmr.add_argument("--queries", type=int, default=200)
+    mmr.add_argument("--k", type=int, default=3)
+    mmr.add_argument("--fetch-k", type=int, nargs="+", default=[10, 20, 50])
+    mmr.add_argument("--mmr-lambda", type=float, default=0.5)
+    mmr.set_defaults(func=bench_mmr)
+
+    vectorstore = subparsers.add_parser("vectorstore", help="比較 Chroma 與 flat 向量資料庫的載入時間、查詢延遲與記憶體")
+    vectorstore.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="chunk 數")
+    vectorstore.add_argument("--backends", nargs="+", choices=("chroma", "flat"), default=["chroma", "flat"])
+    vectorstore.add_argument("--dim", type=int, default=384, help="向量維度（MiniLM 為 384）")
+    vectorstore.add_argument("--queries", type=int, default=50)
+    vectorstore.add_argument("--k", type=int, default=20, help="每次查詢的筆數（MMR 的候選數）")
+    vectorstore.add_argument("--batch-size", type=int, default=5000, help="每次寫入的 chunk 數（Chroma 單次上限約 5461）")
+    vectorstore.set_defaults(func=bench_vectorstore)
+
+    quantization = subparsers.add_parser("quantization", help="比較 flat 後端 float16 / int8 矩陣與 float32 重新排序的 recall@k 與記憶體")
+    quantization.add_argument("--size", type=int, default=200000, help="chunk 數")
+    quantization.add_argument("--dim", type=int, default=384, help="向量維度（MiniLM 為 384）")
+    quantization.add_argument("--queries", type=int, default=200)
+    quantization.add_argument("--k", type=int, default=10)
+    quantization.add_argument("--quantizations", nargs="+", choices=("float16", "int8"), default=["float16", "int8"])
+    quantization.add_argument("--rescore-factor", type=int, default=4, help="重新排序的候選數倍數")
+    quantization.add_argument("--float32-cache-mb", type=int, default=None,
+                              help="float32 快取上限（0 表示每次查詢逐塊還原；預設依格式使用 vector_store.py 的設定）")
+    quantization.set_defaults(func=bench_quantization)
+
+    onnx = subparsers.add_parser("onnx", help="比較嵌入與 NER 模型在 PyTorch 與 ONNX Runtime 下的一致性、延遲與吞吐量")
+    onnx.add_argument("--docs", type=int, default=256, help="chunk 數")
+    onnx.add_argument("--chars", type=int, default=450, help="每個 chunk 的字元數（加上聯絡資訊後不超過 BERT 的長度上限）")
+    onnx.add_argument("--queries", type=int, default=50)
+    onnx.add_argument("--batch-size", type=int, default=embedding.EMBED_BATCH_SIZE, help="嵌入模型的批次大小")
+    onnx.add_argument("--ner-batch-size", type=int, default=16, help="NER 模型的批次大小")
+    onnx.add_argument("--repeat", type=int, default=2)
+    onnx.set_defaults(func=bench_onnx)
+
+    routing = subparsers.add_parser("routing", help="比較搜尋全部 chunk 與先以中心向量挑選檔案的 recall@k 與延遲")
+    routing.add_argument("--files", type=int, default=1000)
+    routing.add_argument("--pages", type=int, default=25, help="每個檔案的頁數")
+    routing.add_argument("--chunks-per-page", type=int, default=4)
+    routing.add_argument("--dim", type=int, default=384, help="向量維度（MiniLM 為 384）")
+    routing.add_argument("--page-spread", type=float, default=1.0, help="頁面主題偏離檔案主題的程度")
+    routing.add_argument("--chunk-spread", type=float, default=1.5, help="chunk 偏離頁面主題的程度")
+    routing.add_argument("--query-spread", type=float, default=1.5, help="查詢偏離所取 chunk 的程度")
+    routing.add_argument("--queries", type=int, default=200)
+    routing.add_argument("--k", type=int, default=3)
+    routing.add_argument("--route-files", type=int, nargs="+", default=[1, 3, 5, 10, 20], help="分流的檔案數 M")
+    routing.add_argument("--backends", nargs="+", choices=("chroma", "flat"), default=["flat", "chroma"])
+    routing.set_defaults(func=bench_routing)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+# 設置參數
+CENTROID_INDEX_PATH = "./chroma_db/centroid_index.sqlite3"  # 放在 chroma_db 內，--rebuild 時一併刪除
+ROUTE_TOP_FILES = 10  # 先挑出中心向量最接近的檔案數，再只在這些檔案中搜尋 chunk（0 表示不分流）
+ROUTE_MIN_FILES = 50  # 檔案數超過此數才分流；檔案少時直接搜尋全部 chunk
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    chunk_id TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    page INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS units (
+    file_name TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    chunks INTEGER NOT NULL,
+    vector_sum BLOB NOT NULL,
+    stale INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (file_name, page)
+) WITHOUT ROWID;
+"""
+_SQL_BATCH = 900  # SQLite 單一語句的參數數量上限以內
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.clip(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12, None)
+
+# 檔案與頁面的中心向量索引，用來在搜尋 chunk 之前先挑出相關的檔案
+class CentroidIndex:
+    """
+    每個 (檔案, 頁) 保存 chunk 正規化向量的總和與 chunk 數（DOCX 沒有頁碼，整份檔案算一頁），
+    新增 chunk 時直接累加；刪除時無法扣回向量，該頁標記為過期，由 embedding.rebuild_centroid_index 重建。
+    查詢時把全部中心向量載入記憶體（每頁一個向量），檔案的分數取檔案中心與各頁中心 cosine 相似度的最大值。
+    """
+    def __init__(self, path=CENTROID_INDEX_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        self.lock = threading.Lock()
+        self._data_version = None
+        self._file_names = []
+        self._file_vectors = np.zeros((0, 0), dtype=np.float32)
+        self._page_vectors = np.zeros((0, 0), dtype=np.float32)
+        self._page_files = np.zeros(0, dtype=np.int64)
+        self._file_starts = np.zeros(0, dtype=np.int64)
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def stale_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM units WHERE stale = 1").fetchone()[0]
+
+    # 新增（或取代同 id 的）chunk 向量
+    def add(self, ids, embeddings, metadatas):
+        if not ids:
+            return
+        vectors = _normalize(embeddings).reshape(len(ids), -1)
+        sums = {}
+        rows = []
+        for chunk_id, vector, metadata in zip(ids, vectors, metadatas):
+            unit = (metadata.get("file_name") or "", int(metadata.get("page_num") or 0))
+            total = sums.get(unit)
+            sums[unit] = (vector.copy(), 1) if total is None else (total[0] + vector, total[1] + 1)
+            rows.append((chunk_id,) + unit)
+        with self.lock, self.conn:
+            self._delete(list(ids))
+            self.conn.executemany("INSERT INTO chunks (chunk_id, file_name, page) VALUES (?, ?, ?)", rows)
+            for (file_name, page), (vector_sum, count) in sums.items():
+                row = self.conn.execute("SELECT chunks, vector_sum FROM units WHERE file_name = ? AND page = ?",
+                                        (file_name, page)).fetchone()
+                if row:
+                    vector_sum = vector_sum + np.frombuffer(row[1], dtype=np.float32)
+                    self.conn.execute("UPDATE units SET chunks = ?, vector_sum = ? WHERE file_name = ? AND page = ?",
+                                      (row[0] + count, vector_sum.tobytes(), file_name, page))
+                else:
+                    self.conn.execute("INSERT INTO units (file_name, page, chunks, vector_sum) VALUES (?, ?, ?, ?)",
+                                      (file_name, page, count, vector_sum.tobytes()))
+            self._data_version = None  # 同一連線的寫入不會改變 data_version
+
+    def delete(self, ids):
+        with self.lock, self.conn:
+            self._delete(list(ids))
+            self._data_version = None
+
+    def _delete(self, ids):
+        units = set()
+        for start in range(0, len(ids), _SQL_BATCH):
+            batch = ids[start:start + _SQL_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            units.update(self.conn.execute(f"SELECT file_name, page FROM chunks WHERE chunk_id IN ({placeholders})", batch))
+            self.conn.execute(f"DELETE FROM chunks WHERE chunk_id IN ({placeholders})", batch)
+        for file_name, page in units:
+            remaining = self.conn.execute("SELECT COUNT(*) FROM chunks WHERE file_name = ? AND page = ?",
+                                          (file_name, page)).fetchone()[0]
+            if remaining:
+                # 無法從總和中扣除已刪除的向量，等待重建
+                self.conn.execute("UPDATE units SET stale = 1 WHERE file_name = ? AND page = ?", (file_name, page))
+            else:
+                self.conn.execute("DELETE FROM units WHERE file_name = ? AND page = ?", (file_name, page))
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM chunks")
+            self.conn.execute("DELETE FROM units")
+            self._data_version = None
+
+    # 其他行程（例如 embedding.py）更新後，重新載入中心向量
+    def _refresh(self):
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        file_ids = {}
+        page_files = []
+        sums = []
+        for file_name, _, vector_sum in self.conn.execute(
+                "SELECT file_name, page, vector_sum FROM units ORDER BY file_name, page"):
+            page_files.append(file_ids.setdefault(file_name, len(file_ids)))
+            sums.append(np.frombuffer(vector_sum, dtype=np.float32))
+        self._file_names = list(file_ids)
+        self._page_files = np.array(page_files, dtype=np.int64)
+        self._file_starts = np.flatnonzero(np.r_[True, np.diff(self._page_files) != 0])
+        if sums:
+            sums = np.vstack(sums)
+            file_sums = np.zeros((len(file_ids), sums.shape[1]), dtype=np.float32)
+            np.add.at(file_sums, self._page_files, sums)
+            self._page_vectors = _normalize(sums)
+            self._file_vectors = _normalize(file_sums)
+        else:
+            self._page_vectors = self._file_vectors = np.zeros((0, 0), dtype=np.float32)
+        self._data_version = data_version
+
+    def file_count(self):
+        with self.lock:
+            self._refresh()
+            return len(self._file_names)
+
+    def route(self, query_embedding, m=ROUTE_TOP_FILES):
+        """
+        挑出與查詢最接近的檔案。
+        Args:
+            query_embedding (list): 查詢向量。
+            m (int): 回傳的檔案數。
+        Returns:
+            list: 依分數排序的檔名。
+        """
+        with self.lock:
+            self._refresh()
+            if not self._file_names:
+                return []
+            query = _normalize(query_embedding).reshape(-1)
+            scores = self._file_vectors @ query
+            # 只有一頁相關的長文件，檔案中心會被其他頁稀釋，因此也取各頁中心的最大值（各頁依檔案排序）
+            scores = np.maximum(scores, np.maximum.reduceat(self._page_vectors @ query, self._file_starts))
+            m = min(m, len(scores))
+            top = np.argpartition(-scores, m - 1)[:m]
+            return [self._file_names[index] for index in top[np.argsort(-scores[top], kind="stable")]]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
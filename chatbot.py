@@ -1,33 +1,87 @@
 import os
+import json
+import time
+import re
+import random
+import asyncio
+import threading
+import httpx
 import requests
 import warnings
-import chromadb
-from requests.exceptions import SSLError, RequestException
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from requests.exceptions import SSLError, RequestException, ConnectionError, Timeout
 from langchain.chains import ConversationalRetrievalChain
-from langchain.memory import ConversationBufferMemory
 from langchain_core.runnables import Runnable
 from langchain_core.retrievers import BaseRetriever
 from langchain_core.documents import Document
-from typing import List, Any, Dict
-from chromadb.utils import embedding_functions
+from langchain_core.messages import AIMessage, HumanMessage, get_buffer_string
+from typing import List, Any, Dict, Iterator, AsyncIterator, Tuple
 
 # 引入 Guardrails 相關功能
 import ner_guardrails
+# 與 embedding.py 共用串流式的解析、分割與嵌入流程
+import embedding
+# 相同或語意相近問題的答案快取
+from answer_cache import SemanticAnswerCache
+# 資料夾檔名索引（Aho–Corasick），取代每次查詢都列出資料夾
+from filename_index import FilenameIndex
+# 有 token 預算、舊對話自動摘要的對話記憶
+from conversation_memory import TokenBudgetMemory
+# 合併重疊片段並控制上下文 token 數
+from context_packer import pack_context, CONTEXT_TOKEN_BUDGET
+# BM25 文字索引（中日韓文字二元組），與向量檢索以 reciprocal rank fusion 合併
+from lexical_index import LexicalIndex, RRF_K, reciprocal_rank_fusion
+# 以儲存的向量做 maximal marginal relevance，避免回傳相鄰重疊的 chunk
+from mmr import maximal_marginal_relevance, MMR_LAMBDA, MMR_FETCH_K
+# 可替換的向量資料庫後端（Chroma 或記憶體映射的 flat 索引）
+from vector_store import open_vector_store, VectorStore, VECTOR_BACKEND
+# 以檔案與頁面的中心向量先挑出相關檔案
+from centroid_index import CentroidIndex, ROUTE_TOP_FILES, ROUTE_MIN_FILES
 
 # 隱藏 InsecureRequestWarning
 warnings.filterwarnings("ignore", category=requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
 # API 參數
 API_URL = 'https://generativelanguage.googleapis.com/v1/models/gemini-1.5-flash:generateContent'
+STREAM_API_URL = 'https://generativelanguage.googleapis.com/v1/models/gemini-1.5-flash:streamGenerateContent?alt=sse'
 MAX_NEW_TOKENS = 800
 TEMPERATURE = 0.8
 TOP_K = 60
 TOP_P = 0.9
 
+# HTTP 連線參數
+HTTP_POOL_SIZE = 10  # 每個主機保留的 keep-alive 連線數
+CONNECT_TIMEOUT = 5  # 建立連線逾時（秒）
+READ_TIMEOUT = 60  # 讀取回應逾時（秒）
+MAX_RETRIES = 3  # 429/5xx 或連線失敗時的重試次數
+BACKOFF_BASE = 0.5  # 指數退避的基準秒數
+BACKOFF_MAX = 8.0  # 單次退避的上限秒數
+RETRY_AFTER_MAX = 30.0  # 伺服器 Retry-After 的採用上限秒數
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+ASYNC_MAX_CONNECTIONS = 200  # 非同步路徑同時進行的 HTTP 連線上限
+
+# 非同步路徑中，Chroma 查詢、嵌入與去敏化等阻塞工作交給固定大小的執行緒池
+BLOCKING_WORKERS = 8
+_blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="chatbot-blocking")
+
 # 嵌入模型和 Chroma 參數
 MODEL_PATH = "./paraphrase-multilingual-MiniLM-L12-v2"
 PDF_DIR = "./KM_pool"
 CHROMA_PATH = "./chroma_db"
+QUERY_EMBEDDING_CACHE_SIZE = 1024  # 查詢向量 LRU 快取的最大筆數
+HYBRID_CANDIDATE_K = 20  # 混合檢索時，向量與 BM25 各取的候選數
+USE_MMR = True  # 以 MMR 從 MMR_FETCH_K 個候選中挑出彼此不重複的結果
+
+# 問題改寫策略："off"（不改寫）、"heuristic"（本地規則，帶入先前提到的檔名或問題）、"llm"（呼叫 Gemini 改寫成獨立問題）
+QUESTION_REWRITE_MODE = "heuristic"
+REWRITE_MODES = ("off", "heuristic", "llm")
+FOLLOW_UP_MAX_CHARS = 12  # 不超過此長度的問題視為追問
+FOLLOW_UP_MARKERS = ("它", "他", "她", "這份", "那份", "這個", "那個", "這篇", "那篇", "上述", "前面", "剛才", "該文件")
+REWRITE_LOOKBACK_TURNS = 3  # heuristic 模式往前尋找檔名的問題數
 
 API_KEY_FILE = os.path.join(os.path.dirname(__file__), "apikey.txt")
 
@@ -40,31 +94,170 @@ def load_api_key(api_key_file):
             return None
         return api_key
 
+# 建立共用連線池的 HTTP session（重試由 GeminiAPI 自行處理，才能回報延遲並遵循 Retry-After）
+def create_http_session(pool_size: int = HTTP_POOL_SIZE, verify: bool = False) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.verify = verify
+    return session
+
+# 計算重試前的等待秒數：有 Retry-After 時遵循伺服器指示，否則使用帶隨機抖動的指數退避
+def retry_delay(attempt: int, retry_after: str = None) -> float:
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_AFTER_MAX)
+        except ValueError:
+            try:
+                return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0), RETRY_AFTER_MAX)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+# 在有界執行緒池中執行阻塞函數，避免卡住事件迴圈
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_blocking_executor, func, *args)
+
 # 自定義 Gemini LLM 類
 class GeminiAPI(Runnable):
-    def __init__(self, api_key: str, api_url: str, max_new_tokens: int, temperature: float, top_k: int = None, top_p: int = None):
+    def __init__(self, api_key: str, api_url: str, max_new_tokens: int, temperature: float, top_k: int = None, top_p: int = None,
+                 stream_api_url: str = STREAM_API_URL, pool_size: int = HTTP_POOL_SIZE,
+                 connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT,
+                 max_retries: int = MAX_RETRIES, verify: bool = False,
+                 async_max_connections: int = ASYNC_MAX_CONNECTIONS, context_token_budget: int = CONTEXT_TOKEN_BUDGET):
         super().__init__()
         self.api_key = api_key
         self.api_url = api_url
+        self.stream_api_url = stream_api_url
         self.max_new_tokens = max_new_tokens
         self.temperature = temperature
         self.top_k = top_k
         self.top_p = top_p
-
-    def invoke(self, input: Any, config: Dict = None, **kwargs) -> str:
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.session = create_http_session(pool_size, verify)
+        self.verify = verify
+        self.async_max_connections = async_max_connections
+        self._async_client = None
+        self._async_client_loop = None
+        self._async_client_closer = None
+        self.context_token_budget = context_token_budget
+        self.last_latency = None
+        self.last_time_to_first_token = None
+        self.last_context_stats = None
+
+    # 發送請求，遇到 429/5xx 或連線失敗時退避重試，並記錄每次請求的延遲
+    def _post(self, url: str, headers: Dict, payload: Dict, stream: bool = False) -> requests.Response:
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                response = self.session.post(url, headers=headers, json=payload, timeout=self.timeout, stream=stream)
+            except (ConnectionError, Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_delay(attempt)
+                print(f"Gemini 連線失敗（{type(e).__name__}），{delay:.1f} 秒後重試（第 {attempt + 1} 次）")
+                time.sleep(delay)
+                continue
+            self.last_latency = time.perf_counter() - started
+            print(f"Gemini 請求延遲：{self.last_latency:.2f} 秒（HTTP {response.status_code}）")
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                delay = retry_delay(attempt, response.headers.get("Retry-After"))
+                response.close()
+                print(f"Gemini 回應 HTTP {response.status_code}，{delay:.1f} 秒後重試（第 {attempt + 1} 次）")
+                time.sleep(delay)
+                continue
+            response.raise_for_status()
+            return response
+
+    # httpx.AsyncClient 綁定建立它的事件迴圈，換了迴圈（例如每次 asyncio.run）就重新建立
+    # 連線只能在原本的迴圈上關閉（迴圈關閉後再關閉會失敗並留下 socket），因此由 _close_with_loop 負責關閉舊 client
+    async def _get_async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._async_client is not None and self._async_client_loop is not loop:
+            closer, closer_loop = self._async_client_closer, self._async_client_loop
+            self._async_client = self._async_client_loop = self._async_client_closer = None
+            # 舊迴圈仍在其他執行緒執行時，排入該迴圈關閉；已結束的迴圈在關閉前已經關閉了 client
+            if closer is not None and closer_loop.is_running():
+                asyncio.run_coroutine_threadsafe(closer.aclose(), closer_loop)
+        if self._async_client is None:
+            connect_timeout, read_timeout = self.timeout
+            self._async_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=self.async_max_connections,
+                                    max_keepalive_connections=self.async_max_connections),
+                verify=self.verify
+            )
+            self._async_client_loop = loop
+            self._async_client_closer = self._close_with_loop(self._async_client)
+            await self._async_client_closer.__anext__()
+        return self._async_client
+
+    # 停在 yield 直到被關閉：asyncio.run 在關閉迴圈前會結束所有未完成的 async generator，client 因此在原迴圈上關閉
+    @staticmethod
+    async def _close_with_loop(client: httpx.AsyncClient):
+        try:
+            yield
+        finally:
+            await client.aclose()
+
+    # _post 的非同步版本，重試與延遲記錄規則相同
+    async def _apost(self, url: str, headers: Dict, payload: Dict, stream: bool = False) -> httpx.Response:
+        client = await self._get_async_client()
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                request = client.build_request("POST", url, headers=headers, json=payload)
+                response = await client.send(request, stream=stream)
+            except httpx.TransportError as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_delay(attempt)
+                print(f"Gemini 連線失敗（{type(e).__name__}），{delay:.1f} 秒後重試（第 {attempt + 1} 次）")
+                await asyncio.sleep(delay)
+                continue
+            self.last_latency = time.perf_counter() - started
+            print(f"Gemini 請求延遲：{self.last_latency:.2f} 秒（HTTP {response.status_code}）")
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                delay = retry_delay(attempt, response.headers.get("Retry-After"))
+                await response.aclose()
+                print(f"Gemini 回應 HTTP {response.status_code}，{delay:.1f} 秒後重試（第 {attempt + 1} 次）")
+                await asyncio.sleep(delay)
+                continue
+            if response.is_error:
+                await response.aclose()
+            response.raise_for_status()
+            return response
+
+    async def aclose(self):
+        closer = self._async_client_closer
+        self._async_client = self._async_client_loop = self._async_client_closer = None
+        if closer is not None:
+            await closer.aclose()
+
+    # 從 generateContent 的回應取出文字，超過 max_new_tokens 時截斷
+    def _parse_answer(self, result: Dict) -> str:
+        generated_text = result["candidates"][0]["content"]["parts"][0]["text"]
+        tokens = generated_text.split()
+        if len(tokens) > self.max_new_tokens:
+            generated_text = " ".join(tokens[:self.max_new_tokens]) + "..."
+        return generated_text
+
+    # 組合提示詞與請求內容
+    def _build_request(self, input: Any, **kwargs):
         prompt = str(input)
         context_str = ""
         history_str = ""
 
         if "context" in kwargs and kwargs["context"]:
-            # 對檢索到的上下文進行脫敏處理
-            desensitized_context = []
-            for doc in kwargs["context"]:
-                entities = ner_guardrails.extract_entities_with_regex(doc.page_content)
-                desensitized_content = ner_guardrails.desensitize_text_with_entities(doc.page_content, entities)
-                desensitized_context.append(Document(page_content=desensitized_content, metadata=doc.metadata))
-            context = "\n".join([doc.page_content for doc in desensitized_context])
-            context_str = f"上下文：\n{context}\n\n"
+            # 對檢索到的上下文進行脫敏處理（優先使用 ingest 時預先計算的結果），再合併重疊片段並控制在預算內
+            packed = pack_context(kwargs["context"], redacted_page_contents(kwargs["context"]), self.context_token_budget)
+            stats = {key: value for key, value in packed.items() if key != "text"}
+            self.last_context_stats = stats
+            print(f"上下文：{stats['chunks']} 個片段合併為 {stats['units']} 段，約 {stats['original_tokens']} → "
+                  f"{stats['tokens']} tokens（節省 {stats['saved_tokens']}，預算外捨棄 {stats['dropped']} 段）")
+            context_str = f"上下文：\n{packed['text']}\n\n"
 
         if "chat_history" in kwargs and kwargs["chat_history"]:
             history_str = "之前的對話：\n"
@@ -85,149 +278,361 @@ class GeminiAPI(Runnable):
                 "topP": self.top_p
             }
         }
+        return headers, payload
+
+    def invoke(self, input: Any, config: Dict = None, **kwargs) -> str:
+        headers, payload = self._build_request(input, **kwargs)
 
         try:
-            response = requests.post(self.api_url, headers=headers, json=payload, verify=False)
-            response.raise_for_status()
-            result = response.json()
-            generated_text = result["candidates"][0]["content"]["parts"][0]["text"]
-            tokens = generated_text.split()
-            if len(tokens) > self.max_new_tokens:
-                generated_text = " ".join(tokens[:self.max_new_tokens]) + "..."
-            return generated_text
+            response = self._post(self.api_url, headers, payload)
+            return self._parse_answer(response.json())
         except (SSLError, RequestException, KeyError, IndexError) as e:
             print(f"API 請求或解析失敗: {e}")
             return "無法生成回答"
 
+    # 非同步版本：去敏化在執行緒池中進行，HTTP 請求使用共用的 httpx.AsyncClient
+    async def ainvoke(self, input: Any, config: Dict = None, **kwargs) -> str:
+        headers, payload = await run_blocking(lambda: self._build_request(input, **kwargs))
+
+        try:
+            response = await self._apost(self.api_url, headers, payload)
+            return self._parse_answer(response.json())
+        except (httpx.HTTPError, KeyError, IndexError, ValueError) as e:
+            print(f"API 請求或解析失敗: {e}")
+            return "無法生成回答"
+
+    # 以 streamGenerateContent (SSE) 逐段產出回答
+    def stream(self, input: Any, config: Dict = None, **kwargs) -> Iterator[str]:
+        headers, payload = self._build_request(input, **kwargs)
+        started = time.perf_counter()
+        self.last_time_to_first_token = None
+        produced = False
+
+        try:
+            with self._post(self.stream_api_url, headers, payload, stream=True) as response:
+                for text in iter_sse_texts(response.iter_lines(decode_unicode=True)):
+                    if self.last_time_to_first_token is None:
+                        self.last_time_to_first_token = time.perf_counter() - started
+                        print(f"Gemini 首個 token 延遲：{self.last_time_to_first_token:.2f} 秒")
+                    produced = True
+                    yield text
+        except (SSLError, RequestException, KeyError, IndexError, ValueError) as e:
+            print(f"API 串流請求或解析失敗: {e}")
+            if not produced:
+                yield "無法生成回答"
+
+    async def astream(self, input: Any, config: Dict = None, **kwargs) -> AsyncIterator[str]:
+        headers, payload = await run_blocking(lambda: self._build_request(input, **kwargs))
+        started = time.perf_counter()
+        self.last_time_to_first_token = None
+        produced = False
+
+        try:
+            response = await self._apost(self.stream_api_url, headers, payload, stream=True)
+            try:
+                async for line in response.aiter_lines():
+                    for text in iter_sse_texts([line]):
+                        if self.last_time_to_first_token is None:
+                            self.last_time_to_first_token = time.perf_counter() - started
+                            print(f"Gemini 首個 token 延遲：{self.last_time_to_first_token:.2f} 秒")
+                        produced = True
+                        yield text
+            finally:
+                await response.aclose()
+        except (httpx.HTTPError, KeyError, IndexError, ValueError) as e:
+            print(f"API 串流請求或解析失敗: {e}")
+            if not produced:
+                yield "無法生成回答"
+
     def _get_input_schema(self, config=None):
         return str
 
     def _get_output_schema(self, config=None):
         return str
 
-# 初始化嵌入函數
+# 解析 SSE 串流：每個 "data:" 行是一個 GenerateContentResponse，取出其中的文字片段
+def iter_sse_texts(lines) -> Iterator[str]:
+    for line in lines:
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if not data or data == "[DONE]":
+            continue
+        chunk = json.loads(data)
+        for candidate in chunk.get("candidates", [])[:1]:
+            for part in candidate.get("content", {}).get("parts", []):
+                if part.get("text"):
+                    yield part["text"]
+
+# 取得文件去敏化後的內容：ingest 時已計算且 guardrail 未變更則直接使用，其餘文件一次批次計算
+def redacted_page_contents(docs: List[Document]) -> List[str]:
+    version = ner_guardrails.guardrail_fingerprint()
+    contents = []
+    pending = []
+    for idx, doc in enumerate(docs):
+        metadata = doc.metadata or {}
+        if metadata.get("guardrail_version") == version and "redacted_content" in metadata:
+            contents.append(metadata["redacted_content"])
+        else:
+            contents.append(None)
+            pending.append(idx)
+    if pending:
+        redacted = ner_guardrails.redact_texts([docs[idx].page_content for idx in pending])
+        for idx, content in zip(pending, redacted):
+            contents[idx] = content
+    return contents
+
+# 初始化嵌入函數（與 embedding.py 相同，依設定使用 PyTorch 或 ONNX Runtime）
 def init_embedding_function():
-    return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=MODEL_PATH)
+    return embedding.init_embedding_function()
+
+# 行程共用的嵌入函數（向量資料庫與答案快取共用同一個模型）
+_embedding_function = None
+
+def get_embedding_function():
+    global _embedding_function
+    if _embedding_function is None:
+        _embedding_function = init_embedding_function()
+    return _embedding_function
+
+# 查詢向量的 LRU 快取：鍵為去除多餘空白後的查詢文字
+_query_embeddings = OrderedDict()
+_query_embeddings_lock = threading.Lock()
+_query_embedding_stats = {"hits": 0, "misses": 0}
+_QUERY_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+def normalize_query(text: str) -> str:
+    return _QUERY_WHITESPACE_PATTERN.sub(" ", text).strip()
+
+# 計算多個查詢的向量：先查 LRU 快取，未命中的查詢一次批次編碼
+def embed_queries(texts: List[str]) -> List[Any]:
+    keys = [normalize_query(text) for text in texts]
+    vectors = {}
+    with _query_embeddings_lock:
+        for key in keys:
+            if key in _query_embeddings:
+                _query_embeddings.move_to_end(key)
+                vectors[key] = _query_embeddings[key]
+        _query_embedding_stats["hits"] += sum(1 for key in keys if key in vectors)
+    missing = list(dict.fromkeys(key for key in keys if key not in vectors))
+    if missing:
+        encoded = get_embedding_function()(missing)
+        with _query_embeddings_lock:
+            _query_embedding_stats["misses"] += len(missing)
+            for key, vector in zip(missing, encoded):
+                vectors[key] = vector
+                _query_embeddings[key] = vector
+                _query_embeddings.move_to_end(key)
+            while len(_query_embeddings) > QUERY_EMBEDDING_CACHE_SIZE:
+                _query_embeddings.popitem(last=False)
+    return [vectors[key] for key in keys]
+
+# 計算單一問題的向量
+def embed_query(text: str):
+    return embed_queries([text])[0]
+
+def query_embedding_stats() -> Dict:
+    with _query_embeddings_lock:
+        lookups = _query_embedding_stats["hits"] + _query_embedding_stats["misses"]
+        return dict(_query_embedding_stats, entries=len(_query_embeddings),
+                    hit_rate=_query_embedding_stats["hits"] / lookups if lookups else 0.0)
+
+# 目前向量資料庫後端的語料版本（索引清單改變時答案快取失效）
+def corpus_version() -> str:
+    return embedding.corpus_version(embedding.manifest_path_for(VECTOR_BACKEND))
+
+# 答案快取只適用於不依賴對話歷史的問題：預設只在對話的第一個問題使用，use_cache=True 可強制使用
+def should_use_answer_cache(rag_chain, use_cache: bool = None) -> bool:
+    if use_cache is None:
+        return not rag_chain.memory.chat_memory.messages
+    return use_cache
+
+# 查詢答案快取；命中時把問答寫入對話記憶，讓後續問題仍能參考
+def lookup_cached_answer(rag_chain, question: str):
+    cached = answer_cache.lookup(question, corpus_version(), embed_query)
+    if cached is None:
+        return None
+    rag_chain.memory.save_context({"question": question}, {"answer": cached["answer"]})
+    stats = answer_cache.stats()
+    print(f"答案快取命中（相似度 {cached['similarity']:.3f}，命中率 {stats['hit_rate']:.1%}）")
+    return cached
 
-# 載入或建立 Chroma 資料庫
+# 只快取成功產生的答案
+def store_cached_answer(question: str, answer: str, source_docs: List[Document]):
+    if answer and not answer.startswith("無法生成回答"):
+        answer_cache.store(question, corpus_version(), embed_query, answer, source_docs)
+
+# 載入或建立向量資料庫（依 VECTOR_BACKEND 使用 Chroma 或 flat 索引）
 def setup_vectorstore():
     if not os.path.exists(MODEL_PATH):
         raise FileNotFoundError(f"嵌入模型路徑 {MODEL_PATH} 不存在")
     if not os.path.exists(PDF_DIR):
         raise FileNotFoundError(f"檔案目錄 {PDF_DIR} 不存在")
 
-    client = chromadb.PersistentClient(path=CHROMA_PATH)
     collection_name = "pdf_docx_collection"
-    embedding_function = init_embedding_function()
+    embedding_function = get_embedding_function()
+    collection = open_vector_store(VECTOR_BACKEND, CHROMA_PATH, collection_name, embedding_function)
 
-    try:
-        collection = client.get_collection(name=collection_name, embedding_function=embedding_function)
-        print(f"成功載入現有集合：{collection.name}，來自 {CHROMA_PATH}")
-        return collection
-    except Exception as e:
-        print(f"集合 {collection_name} 不存在，將創建新集合。")
-        collection = client.create_collection(name=collection_name, embedding_function=embedding_function)
-        # 在這裡直接處理檔案並添加到集合
-        all_files = [os.path.join(PDF_DIR, f) for f in os.listdir(PDF_DIR) if f.lower().endswith((".pdf", ".docx"))]
-        if not all_files:
-            print(f"警告：目錄 {PDF_DIR} 中找不到 PDF 或 DOCX 檔案")
-            return collection
-        all_documents = []
-        all_metadatas = []
-        all_ids = []
-        for file_path in all_files:
-            file_name = os.path.basename(file_path)
-            print(f"處理檔案：{file_name}")
-            if file_path.lower().endswith(".pdf"):
-                from PyPDF2 import PdfReader
-                try:
-                    reader = PdfReader(file_path)
-                    for page_num, page in enumerate(reader.pages, 1):
-                        text = page.extract_text() or ""
-                        text = " ".join(text.split())
-                        if text:
-                            all_documents.append(f"檔案名稱：{file_name}\n頁碼：{page_num}\n內容：{text}")
-                            all_metadatas.append({"source": file_name, "page_num": page_num, "file_name": file_name})
-                            all_ids.append(f"{file_name}_page{page_num}")
-                except Exception as e:
-                    print(f"讀取 PDF {file_name} 時發生錯誤：{e}")
-            elif file_path.lower().endswith(".docx"):
-                from docx import Document as DocxReader
-                try:
-                    document = DocxReader(file_path)
-                    full_text = "\n".join([p.text for p in document.paragraphs])
-                    if full_text:
-                        all_documents.append(f"檔案名稱：{file_name}\n內容：{full_text}")
-                        all_metadatas.append({"source": file_name, "file_name": file_name})
-                        all_ids.append(f"{file_name}_docx")
-                except Exception as e:
-                    print(f"讀取 DOCX {file_name} 時發生錯誤：{e}")
-        if all_documents:
-            collection.add(documents=all_documents, metadatas=all_metadatas, ids=all_ids)
-            print(f"已將 {len(all_files)} 個檔案的內容添加到集合：{collection_name}")
-        else:
-            print("警告：沒有找到可添加到集合的內容。")
+    if collection.count() > 0:
+        print(f"成功載入現有集合：{collection.name}（{VECTOR_BACKEND}），來自 {CHROMA_PATH}")
         return collection
+    print(f"集合 {collection_name}（{VECTOR_BACKEND}）是空的，將建立索引。")
+    # 以 embedding.py 的串流流程逐頁處理檔案並添加到集合，記憶體用量不隨語料大小增加
+    writer = embedding.EmbeddingWriter(collection, embedding.load_sentence_model(embedding_function))
+    try:
+        changes = embedding.sync_index(collection, PDF_DIR, embedding.manifest_path_for(VECTOR_BACKEND), writer=writer,
+                                       lexical_index_path=embedding.lexical_index_path_for(VECTOR_BACKEND),
+                                       centroid_index_path=embedding.centroid_index_path_for(VECTOR_BACKEND))
+    finally:
+        writer.close()
+    if not changes["added"] and not changes["modified"]:
+        print(f"警告：目錄 {PDF_DIR} 中找不到 PDF 或 DOCX 檔案")
+    else:
+        print(f"已將 {len(changes['added']) + len(changes['modified'])} 個檔案的內容添加到集合：{collection_name}")
+    return collection
+
+# 行程共用的檔名索引，資料夾內容改變時才重新建立
+filename_index = FilenameIndex(PDF_DIR)
+
+# 行程共用的答案快取（Streamlit 的所有對話共用），語意命中須提到相同的檔案
+answer_cache = SemanticAnswerCache(find_mentions=filename_index.find_mentions)
 
 # 獲取資料夾中的文件名
 def get_available_filenames():
-    return [f for f in os.listdir(PDF_DIR) if f.lower().endswith((".pdf", ".docx"))]
+    return filename_index.files()
 
 # 改進的檢索器
 class ChromaRetriever(BaseRetriever):
-    collection: Any
+    collection: VectorStore
     k: int = 3
+    lexical_index: Any = None
+    candidate_k: int = HYBRID_CANDIDATE_K
+    rrf_k: int = RRF_K
+    use_mmr: bool = USE_MMR
+    mmr_lambda: float = MMR_LAMBDA
+    fetch_k: int = MMR_FETCH_K
+    centroid_index: Any = None
+    route_files: int = ROUTE_TOP_FILES
+    route_min_files: int = ROUTE_MIN_FILES
+
+    def _search(self, query_embedding: List[float], query: str, n: int, where: Dict = None) -> List[Document]:
+        """
+        向量檢索；有文字索引時，向量與 BM25 各取 candidate_k 個候選，以 reciprocal rank fusion 合併排序。
+        use_mmr 時候選至少取 fetch_k 個（連同 Chroma 中儲存的向量），再以 MMR 挑出 n 個彼此不重複的結果。
+        Args:
+            query_embedding (list): 查詢向量。
+            query (str): BM25 使用的查詢文字。
+            n (int): 回傳筆數。
+            where (dict): Chroma 的 metadata 條件（文字索引支援 file_name 條件）。
+        Returns:
+            list: Document 列表。
+        """
+        pool = n
+        if self.lexical_index is not None:
+            pool = max(pool, self.candidate_k)
+        if self.use_mmr:
+            pool = max(pool, self.fetch_k)
+        include = ["metadatas", "documents", "embeddings"] if self.use_mmr else ["metadatas", "documents"]
+        results = self.collection.query(
+            query_embeddings=[query_embedding],
+            n_results=pool,
+            where=where,
+            include=include
+        )
+        dense_ids = results["ids"][0] or []
+        found = {chunk_id: Document(page_content=doc, metadata=metadata)
+                 for chunk_id, doc, metadata in zip(dense_ids, results["documents"][0] or [],
+                                                    results["metadatas"][0] or [])}
+        vectors = dict(zip(dense_ids, results["embeddings"][0])) if self.use_mmr else {}
+
+        # 排序後的 (chunk id, 融合分數)；只有向量檢索時分數為 None，MMR 改用與查詢向量的相似度
+        ranked = [(chunk_id, None) for chunk_id in dense_ids]
+        if self.lexical_index is not None:
+            try:
+                lexical_ids = [chunk_id for chunk_id, _ in self.lexical_index.search(query, pool, where)]
+                ranked = reciprocal_rank_fusion([dense_ids, lexical_ids], self.rrf_k, with_scores=True)
+            except Exception as e:
+                print(f"文字索引查詢失敗，只使用向量檢索：{e}")
+        ranked = ranked[:pool] if self.use_mmr else ranked[:n]
+
+        # 只有 BM25 找到的 chunk 再向 Chroma 取回內容
+        missing = [chunk_id for chunk_id, _ in ranked if chunk_id not in found]
+        if missing:
+            extra = self.collection.get(ids=missing, include=include)
+            found.update((chunk_id, Document(page_content=doc, metadata=metadata))
+                         for chunk_id, doc, metadata in zip(extra["ids"], extra["documents"], extra["metadatas"]))
+            if self.use_mmr:
+                vectors.update(zip(extra["ids"], extra["embeddings"]))
+        ranked = [(chunk_id, score) for chunk_id, score in ranked if chunk_id in found]
+
+        if self.use_mmr and len(ranked) > n:
+            relevance = None
+            if ranked[0][1] is not None:
+                scores = np.array([score for _, score in ranked], dtype=np.float32)
+                # RRF 分數集中在很窄的範圍，縮放到 0～1 才能與向量相似度的懲罰項相比
+                spread = scores.max() - scores.min()
+                relevance = (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+            selected = maximal_marginal_relevance(query_embedding, [vectors[chunk_id] for chunk_id, _ in ranked],
+                                                  n, self.mmr_lambda, relevance)
+            ranked = [ranked[index] for index in selected]
+        return [found[chunk_id] for chunk_id, _ in ranked[:n]]
 
     def _get_relevant_documents(self, query: str) -> List[Document]:
-        target_file_name = None
-        query_lower = query.lower().replace("的摘要", "").strip()
-        available_files = get_available_filenames()
-
-        # 更積極地尋找問題中包含的文件名（不包含副檔名）
-        for file in available_files:
-            file_base = os.path.splitext(file)[0].lower()
-            if file_base in query_lower:
-                target_file_name = file
-                break
-        # 如果沒有找到不含副檔名的匹配，再嘗試完整文件名匹配
-        if not target_file_name:
-            for file in available_files:
-                if file.lower() == query_lower:
-                    target_file_name = file
-                    break
+        # 一次掃描找出問題中包含的文件名（不包含副檔名），找不到時再嘗試完整文件名匹配
+        target_file_name = filename_index.match(query.replace("的摘要", ""))
 
         if target_file_name:
-            results_with_filename = self.collection.query(
-                query_texts=[f"{target_file_name} {query}"],
-                n_results=self.k * 2,
-                where={"file_name": target_file_name},
-                include=["metadatas", "documents"]
-            )
-            docs = [Document(page_content=doc, metadata=metadata)
-                    for doc, metadata in zip(results_with_filename["documents"][0] or [],
-                                                results_with_filename["metadatas"][0] or [])]
+            # 指定檔案的查詢與其他檔案的補充查詢一次批次編碼（經過查詢向量快取）
+            targeted_embedding, broader_embedding = embed_queries([f"{target_file_name} {query}", query])
+            docs = self._search(targeted_embedding, query, self.k * 2, where={"file_name": target_file_name})
 
             if len(docs) < self.k:
                 remaining = self.k - len(docs)
-                broader_results = self.collection.query(
-                    query_texts=[query],
-                    n_results=remaining,
-                    where={"file_name": {"$ne": target_file_name}},
-                    include=["metadatas", "documents"]
-                )
-                docs.extend(Document(page_content=doc, metadata=metadata)
-                            for doc, metadata in zip(broader_results["documents"][0] or [],
-                                                        broader_results["metadatas"][0] or []))
+                docs.extend(self._search(broader_embedding, query, remaining,
+                                         where={"file_name": {"$ne": target_file_name}}))
             return docs[:self.k]
-        else:
-            results = self.collection.query(
-                query_texts=[query],
-                n_results=self.k,
-                include=["metadatas", "documents"]
-            )
-            return [Document(page_content=doc, metadata=metadata)
-                    for doc, metadata in zip(results["documents"][0] or [],
-                                                results["metadatas"][0] or [])]
+        query_embedding = embed_query(query)
+        routed = self._route(query_embedding)
+        if routed:
+            # 問題沒有提到檔名時，只在中心向量最接近的檔案中搜尋，結果不足再搜尋其他檔案
+            docs = self._search(query_embedding, query, self.k, where={"file_name": {"$in": routed}})
+            if len(docs) < self.k:
+                docs.extend(self._search(query_embedding, query, self.k - len(docs),
+                                         where={"file_name": {"$nin": routed}}))
+            return docs[:self.k]
+        return self._search(query_embedding, query, self.k)
+
+    # 挑出要搜尋的檔案；沒有中心向量索引、停用（route_files 為 0）或檔案不多時回傳空列表，搜尋全部 chunk
+    def _route(self, query_embedding: List[float]) -> List[str]:
+        if self.centroid_index is None or self.route_files <= 0:
+            return []
+        try:
+            if self.centroid_index.file_count() <= max(self.route_min_files, self.route_files):
+                return []
+            return self.centroid_index.route(query_embedding, self.route_files)
+        except Exception as e:
+            print(f"中心向量索引查詢失敗，搜尋全部檔案：{e}")
+            return []
+
+    # Chroma 查詢與查詢嵌入都是阻塞呼叫，交給有界執行緒池，避免大量並行請求卡住事件迴圈
+    async def _aget_relevant_documents(self, query: str) -> List[Document]:
+        return await run_blocking(self._get_relevant_documents, query)
+
+# 載入 embedding.py 建立的文字索引；不存在時只使用向量檢索
+def load_lexical_index():
+    path = embedding.lexical_index_path_for(VECTOR_BACKEND)
+    if not os.path.exists(path):
+        print(f"找不到文字索引 {path}，只使用向量檢索。執行 embedding.py 即可建立。")
+        return None
+    return LexicalIndex(path)
+
+# 載入 embedding.py 建立的中心向量索引；不存在時搜尋全部檔案
+def load_centroid_index():
+    path = embedding.centroid_index_path_for(VECTOR_BACKEND)
+    if not os.path.exists(path):
+        print(f"找不到中心向量索引 {path}，每次查詢搜尋全部檔案。執行 embedding.py 即可建立。")
+        return None
+    return CentroidIndex(path)
 
 def create_rag_chain(api_key: str):
     llm = GeminiAPI(api_key, API_URL, MAX_NEW_TOKENS, TEMPERATURE, TOP_K, TOP_P)
@@ -235,35 +640,219 @@ def create_rag_chain(api_key: str):
     if collection is None:
         print("無法建立 RAG 鏈，因為向量資料庫未成功載入。請檢查是否已運行 embedding.py 建立資料庫。")
         return None
-    retriever = ChromaRetriever(collection=collection, k=3)
-    memory = ConversationBufferMemory(memory_key="chat_history", input_key="question", output_key="answer", return_messages=True)
+    # Chroma 加上 $in 條件的查詢比不加條件的 HNSW 搜尋慢（見 benchmark.py routing），只在 flat 後端分流
+    centroid_index = load_centroid_index() if VECTOR_BACKEND == "flat" else None
+    retriever = ChromaRetriever(collection=collection, k=3, lexical_index=load_lexical_index(),
+                                centroid_index=centroid_index)
+    memory = TokenBudgetMemory(llm=llm, memory_key="chat_history", input_key="question", output_key="answer", return_messages=True)
     rag_chain = ConversationalRetrievalChain.from_llm(llm=llm, retriever=retriever, memory=memory, return_source_documents=True, output_key="answer")
     return rag_chain
 
+# 判斷問題是否為依賴上文的追問（簡短或包含指代詞）
+def is_follow_up(question: str) -> bool:
+    question = question.strip()
+    return len(question) <= FOLLOW_UP_MAX_CHARS or any(marker in question for marker in FOLLOW_UP_MARKERS)
+
+# 本地規則改寫：追問未提到檔名時，帶入最近問題中提到的檔名；找不到檔名則併入上一個問題
+def heuristic_rewrite(question: str, chat_history: List[Any]) -> str:
+    if not chat_history or not is_follow_up(question) or filename_index.find_mentions(question):
+        return question
+    recent = [message.content for message in reversed(chat_history) if message.type == "human"][:REWRITE_LOOKBACK_TURNS]
+    for previous in recent:
+        mentions = filename_index.find_mentions(previous)
+        if mentions:
+            return f"{os.path.splitext(mentions[0])[0]} {question}"
+    return f"{recent[0]} {question}" if recent else question
+
+def _check_rewrite_mode(rewrite_mode: str = None) -> str:
+    rewrite_mode = rewrite_mode or QUESTION_REWRITE_MODE
+    if rewrite_mode not in REWRITE_MODES:
+        raise ValueError(f"未知的問題改寫模式：{rewrite_mode}，可用模式：{', '.join(REWRITE_MODES)}")
+    return rewrite_mode
+
+# 依改寫策略產生檢索用的問題；llm 模式時回答也使用改寫後的獨立問題（與 ConversationalRetrievalChain 相同）
+def rewrite_question(rag_chain, question: str, chat_history: List[Any], rewrite_mode: str = None) -> Tuple[str, str]:
+    rewrite_mode = _check_rewrite_mode(rewrite_mode)
+    if not chat_history or rewrite_mode == "off":
+        return question, question
+    if rewrite_mode == "heuristic":
+        return heuristic_rewrite(question, chat_history), question
+    standalone = rag_chain.question_generator.invoke(
+        {"question": question, "chat_history": get_buffer_string(chat_history)})["text"]
+    return standalone, standalone
+
+async def arewrite_question(rag_chain, question: str, chat_history: List[Any], rewrite_mode: str = None) -> Tuple[str, str]:
+    rewrite_mode = _check_rewrite_mode(rewrite_mode)
+    if rewrite_mode != "llm" or not chat_history:
+        return rewrite_question(rag_chain, question, chat_history, rewrite_mode)
+    standalone = (await rag_chain.question_generator.ainvoke(
+        {"question": question, "chat_history": get_buffer_string(chat_history)}))["text"]
+    return standalone, standalone
+
+# 記錄並輸出各步驟耗時（秒）
+def log_timings(timings: Dict):
+    print("各步驟耗時：" + "、".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in timings.items()
+                                 if isinstance(seconds, float)))
+
+# 問答前置步驟：讀取對話記憶、改寫問題、檢索文件，並把耗時寫入 timings
+def prepare_question(rag_chain, question: str, rewrite_mode: str = None, timings: Dict = None):
+    """
+    Returns:
+        tuple: (對話歷史, 檢索用問題, 回答用問題, 來源文件)
+    """
+    timings = {} if timings is None else timings
+    chat_history = rag_chain.memory.load_memory_variables({})["chat_history"]
+    started = time.perf_counter()
+    search_question, answer_question = rewrite_question(rag_chain, question, chat_history, rewrite_mode)
+    timings["rewrite"] = time.perf_counter() - started
+    started = time.perf_counter()
+    source_docs = rag_chain.retriever.invoke(search_question)
+    timings["retrieve"] = time.perf_counter() - started
+    timings["rewrite_mode"] = _check_rewrite_mode(rewrite_mode)
+    timings["search_question"] = search_question
+    return chat_history, search_question, answer_question, source_docs
+
+async def aprepare_question(rag_chain, question: str, rewrite_mode: str = None, timings: Dict = None):
+    timings = {} if timings is None else timings
+    chat_history = rag_chain.memory.load_memory_variables({})["chat_history"]
+    started = time.perf_counter()
+    search_question, answer_question = await arewrite_question(rag_chain, question, chat_history, rewrite_mode)
+    timings["rewrite"] = time.perf_counter() - started
+    started = time.perf_counter()
+    source_docs = await rag_chain.retriever.ainvoke(search_question)
+    timings["retrieve"] = time.perf_counter() - started
+    timings["rewrite_mode"] = _check_rewrite_mode(rewrite_mode)
+    timings["search_question"] = search_question
+    return chat_history, search_question, answer_question, source_docs
+
+# 以介面保存的訊息（{"role": "user"/"assistant", "content": ...}）重建對話記憶
+def restore_memory(rag_chain, messages: List[Dict]):
+    rag_chain.memory.load_history([
+        HumanMessage(content=message["content"]) if message["role"] == "user" else AIMessage(content=message["content"])
+        for message in messages
+    ])
+
 # 問答函數
-def ask_question(rag_chain, question: str, chat_history: List[Any] = None):
+def ask_question(rag_chain, question: str, *, use_cache: bool = None, rewrite_mode: str = None, timings: Dict = None):
+    """
+    對話歷史只來自 rag_chain.memory（切換對話時以 restore_memory 載入），回傳值中的 history 即為其內容。
+    Args:
+        rewrite_mode (str): 問題改寫策略，預設為 QUESTION_REWRITE_MODE。
+        timings (dict): 傳入時會填入各步驟耗時（rewrite、retrieve、generate、redact、total，單位秒），
+                        以及實際使用的 rewrite_mode 與 search_question。
+    """
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
     try:
-        inputs = {"question": question}
-        if chat_history:
-            inputs["chat_history"] = chat_history
-        result = rag_chain.invoke(inputs)
-        answer = result["answer"]
-        source_docs = result["source_documents"]
-        updated_chat_history = result["chat_history"]
+        use_cache = should_use_answer_cache(rag_chain, use_cache)
+        if use_cache:
+            history = rag_chain.memory.load_memory_variables({})["chat_history"]
+            cached = lookup_cached_answer(rag_chain, question)
+            if cached is not None:
+                timings["total"] = time.perf_counter() - started
+                return cached["answer"], cached["source_docs"], history
+
+        history, _, answer_question, source_docs = prepare_question(rag_chain, question, rewrite_mode, timings)
+        step_started = time.perf_counter()
+        llm = rag_chain.combine_docs_chain.llm_chain.llm
+        answer = llm.invoke(answer_question, context=source_docs, chat_history=history)
+        timings["generate"] = time.perf_counter() - step_started
+        rag_chain.memory.save_context({"question": question}, {"answer": answer})
 
         # 對 LLM 的回答進行脫敏處理
-        entities_answer = ner_guardrails.extract_entities_with_regex(answer)
-        desensitized_answer = ner_guardrails.desensitize_text_with_entities(answer, entities_answer)
+        step_started = time.perf_counter()
+        desensitized_answer = ner_guardrails.redact_texts([answer])[0]
+        timings["redact"] = time.perf_counter() - step_started
 
         # 如果沒有檢索到文件且問題包含「摘要」，提供更具體的建議
-        if not source_docs and "摘要" in question.lower():
-            available_files = get_available_filenames()
-            desensitized_answer += f"\n\n⚠️ 無法找到與問題直接相關的文件片段。請嘗試更明確地指定您想查詢的文件名稱，例如：「{available_files[0] if available_files else '文件名' } 的摘要」。可用文件：{', '.join(available_files)}"
+        desensitized_answer += missing_source_hint(question, source_docs)
+
+        if use_cache:
+            store_cached_answer(question, desensitized_answer, source_docs)
+        timings["total"] = time.perf_counter() - started
+        log_timings(timings)
+        return desensitized_answer, source_docs, history
+    except Exception as e:
+        print(f"問答過程中發生錯誤：{e}")
+        return "無法生成回答，請檢查問題或向量資料庫。", [], []
 
-        return desensitized_answer, source_docs, updated_chat_history
+# 非同步問答函數：一個行程可同時服務多個對話（每個對話使用各自的 rag_chain）
+async def aask_question(rag_chain, question: str, *, rewrite_mode: str = None, timings: Dict = None):
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+    try:
+        history, _, answer_question, source_docs = await aprepare_question(rag_chain, question, rewrite_mode, timings)
+        step_started = time.perf_counter()
+        llm = rag_chain.combine_docs_chain.llm_chain.llm
+        answer = await llm.ainvoke(answer_question, context=source_docs, chat_history=history)
+        timings["generate"] = time.perf_counter() - step_started
+        rag_chain.memory.save_context({"question": question}, {"answer": answer})
+
+        step_started = time.perf_counter()
+        desensitized_answer = (await run_blocking(ner_guardrails.redact_texts, [answer]))[0]
+        timings["redact"] = time.perf_counter() - step_started
+        desensitized_answer += missing_source_hint(question, source_docs)
+
+        timings["total"] = time.perf_counter() - started
+        log_timings(timings)
+        return desensitized_answer, source_docs, history
     except Exception as e:
         print(f"問答過程中發生錯誤：{e}")
-        return "無法生成回答，請檢查問題或向量資料庫。", [], chat_history if chat_history else []
+        return "無法生成回答，請檢查問題或向量資料庫。", [], []
+
+# 沒有檢索到文件且問題包含「摘要」時，提示可用的文件名稱
+def missing_source_hint(question: str, source_docs: List[Document]) -> str:
+    if source_docs or "摘要" not in question.lower():
+        return ""
+    available_files = get_available_filenames()
+    return f"\n\n⚠️ 無法找到與問題直接相關的文件片段。請嘗試更明確地指定您想查詢的文件名稱，例如：「{available_files[0] if available_files else '文件名' } 的摘要」。可用文件：{', '.join(available_files)}"
+
+# 串流問答：先完成改寫問題與檢索，回傳 (逐段產出去敏化回答的迭代器, 來源文件)
+def stream_question(rag_chain, question: str, use_cache: bool = None, rewrite_mode: str = None,
+                    timings: Dict = None) -> Tuple[Iterator[str], List[Document]]:
+    """
+    與 ask_question 相同的流程（依改寫策略處理追問，再檢索），
+    但回答以 GeminiAPI.stream 逐段取得，經 StreamingRedactor 增量去敏化後輸出。
+    迭代器結束時才把問答寫入 rag_chain.memory，timings 也在此時補上 first_token、generate 與 total。
+    答案快取命中時直接回傳快取的答案。
+    """
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+    use_cache = should_use_answer_cache(rag_chain, use_cache)
+    if use_cache:
+        cached = lookup_cached_answer(rag_chain, question)
+        if cached is not None:
+            timings["total"] = time.perf_counter() - started
+            return iter([cached["answer"]]), cached["source_docs"]
+    chat_history, _, answer_question, source_docs = prepare_question(rag_chain, question, rewrite_mode, timings)
+    llm = rag_chain.combine_docs_chain.llm_chain.llm
+
+    def generate() -> Iterator[str]:
+        redactor = ner_guardrails.StreamingRedactor()
+        answer_parts = []
+        safe_parts = []
+        generate_started = time.perf_counter()
+        for text in llm.stream(answer_question, context=source_docs, chat_history=chat_history):
+            answer_parts.append(text)
+            safe_text = redactor.feed(text)
+            if safe_text:
+                if "first_token" not in timings:
+                    timings["first_token"] = time.perf_counter() - started
+                    print(f"首個 token 端到端延遲：{timings['first_token']:.2f} 秒")
+                safe_parts.append(safe_text)
+                yield safe_text
+        remaining = redactor.flush() + missing_source_hint(question, source_docs)
+        if remaining:
+            safe_parts.append(remaining)
+            yield remaining
+        timings["generate"] = time.perf_counter() - generate_started
+        rag_chain.memory.save_context({"question": question}, {"answer": "".join(answer_parts)})
+        if use_cache:
+            store_cached_answer(question, "".join(safe_parts), source_docs)
+        timings["total"] = time.perf_counter() - started
+        log_timings(timings)
+
+    return generate(), source_docs
 
 # 顯示來源並去重複，現在包含檔案名稱
 def process_source_documents(source_docs: List[Any], query: str = "") -> List[str]:
@@ -282,12 +871,11 @@ if __name__ == "__main__":
     if api_key:
         rag_chain = create_rag_chain(api_key)
         if rag_chain:
-            chat_history = []  # 初始化對話歷史
             while True:
                 question = input("請輸入您的問題 (輸入 'quit' 結束)：")
                 if question.lower() == 'quit':
                     break
-                answer, source_docs, chat_history = ask_question(rag_chain, question, chat_history)
+                answer, source_docs, chat_history = ask_question(rag_chain, question)  # 對話歷史保存在 rag_chain.memory
                 print(f"問題：{question}")
                 print(f"答案：{answer}")
                 print("\n來源文件：")
@@ -0,0 +1,120 @@
+import re
+
+from token_counter import estimate_tokens, head_within_tokens
+
+# 設置參數
+CONTEXT_TOKEN_BUDGET = 1500  # 放入提示詞的上下文 token 上限
+CONTEXT_MAX_OVERLAP = 300  # 比對相鄰 chunk 重疊文字的最大長度（CHUNK_OVERLAP 加上餘裕）
+CONTEXT_MIN_PARTIAL_TOKENS = 50  # 剩餘預算至少這麼多時，才放入截斷後的片段
+
+# embedding.py 為每個 chunk 加上的標頭（PDF："**檔案名稱：X**\n\n內容："，DOCX："檔案名稱：X\n內容："）
+CHUNK_HEADER_PATTERN = re.compile(r"^\s*(?:\*\*)?檔案名稱：.*?(?:\*\*)?\s*\n\s*內容：", re.DOTALL)
+
+def strip_chunk_header(text):
+    return CHUNK_HEADER_PATTERN.sub("", text, count=1).strip()
+
+# 合併同一頁中相鄰的兩個 chunk：去掉後者開頭與前者結尾重複的文字
+def merge_overlapping(first, second, max_overlap=CONTEXT_MAX_OVERLAP):
+    for size in range(min(len(first), len(second), max_overlap), 0, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return f"{first}\n{second}"
+
+def _unit_of(metadata):
+    if metadata.get("page_num") is not None:
+        return "page", metadata["page_num"]
+    if metadata.get("paragraph") is not None:
+        return "paragraph", metadata["paragraph"]
+    return "chunk", metadata.get("chunk_id")
+
+def _unit_label(unit):
+    kind, number = unit
+    if kind == "page":
+        return f"第 {number} 頁"
+    if kind == "paragraph":
+        return f"第 {number} 段"
+    return None
+
+def pack_context(docs, contents, budget=CONTEXT_TOKEN_BUDGET):
+    """
+    將檢索結果整理成提示詞用的上下文。
+    同一檔案同一頁（或段落）的 chunk 依 chunk_id 排序後合併，相鄰 chunk 的重疊文字只保留一次，
+    去掉每個 chunk 重複的檔名標頭，依最相關 chunk 的名次放入預算，最後依檔案分組輸出。
+    Args:
+        docs (list): 依相關度排序的 Document。
+        contents (list): 與 docs 對應、已去敏化的文字。
+        budget (int): 上下文的 token 上限。
+    Returns:
+        dict: text（上下文）、tokens、original_tokens（逐段串接時的 token 數）、saved_tokens、
+              chunks（輸入 chunk 數）、units（合併後的段數）、dropped（因預算捨棄的段數）。
+    """
+    original_tokens = estimate_tokens("\n".join(contents))
+    units = {}
+    for rank, (doc, content) in enumerate(zip(docs, contents)):
+        metadata = doc.metadata or {}
+        source = metadata.get("source") or metadata.get("file_name") or "未知文件"
+        key = (source, _unit_of(metadata))
+        unit = units.setdefault(key, {"rank": rank, "chunks": {}})
+        chunk_id = metadata.get("chunk_id", rank)
+        unit["chunks"].setdefault(chunk_id, strip_chunk_header(content))
+
+    # 合併每一段的 chunk：相鄰 chunk 去除重疊，不相鄰的以省略號分隔
+    merged = []
+    for (source, unit_key), unit in units.items():
+        text = ""
+        previous_id = None
+        for chunk_id in sorted(unit["chunks"]):
+            chunk = unit["chunks"][chunk_id]
+            if not text:
+                text = chunk
+            elif previous_id == chunk_id - 1:
+                text = merge_overlapping(text, chunk)
+            else:
+                text = f"{text}\n…\n{chunk}"
+            previous_id = chunk_id
+        merged.append({"source": source, "unit": unit_key, "rank": unit["rank"], "text": text})
+
+    # 依相關度放入預算，超出時截斷最後一段
+    selected = []
+    selected_sources = set()
+    remaining = budget
+    dropped = 0
+    for item in sorted(merged, key=lambda value: value["rank"]):
+        label = _unit_label(item["unit"])
+        label_cost = estimate_tokens(label) + 2 if label else 0
+        if item["source"] not in selected_sources:
+            label_cost += estimate_tokens(f"檔案名稱：{item['source']}") + 2
+        cost = estimate_tokens(item["text"]) + label_cost
+        if cost <= remaining:
+            selected.append(item)
+            selected_sources.add(item["source"])
+            remaining -= cost
+        elif remaining - label_cost >= CONTEXT_MIN_PARTIAL_TOKENS:
+            selected.append(dict(item, text=head_within_tokens(item["text"], remaining - label_cost - 1) + "…"))
+            selected_sources.add(item["source"])
+            remaining = 0
+        else:
+            dropped += 1
+
+    # 依檔案分組（檔案依最相關段落的名次排序），同檔案內依頁碼或段落順序輸出
+    files = {}
+    for item in sorted(selected, key=lambda value: value["rank"]):
+        files.setdefault(item["source"], []).append(item)
+    sections = []
+    for source, items in files.items():
+        lines = [f"檔案名稱：{source}"]
+        for item in sorted(items, key=lambda value: (value["unit"][0], value["unit"][1] if isinstance(value["unit"][1], int) else -1)):
+            label = _unit_label(item["unit"])
+            lines.append(f"[{label}]\n{item['text']}" if label else item["text"])
+        sections.append("\n".join(lines))
+    text = "\n\n".join(sections)
+    tokens = estimate_tokens(text)
+    return {
+        "text": text,
+        "tokens": tokens,
+        "original_tokens": original_tokens,
+        "saved_tokens": original_tokens - tokens,
+        "chunks": len(docs),
+        "units": len(selected),
+        "dropped": dropped,
+    }
@@ -0,0 +1,143 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain_core.messages import BaseMessage, SystemMessage, get_buffer_string
+from pydantic import PrivateAttr
+
+from token_counter import estimate_tokens, tail_within_tokens
+
+# 設置參數
+MEMORY_TOKEN_BUDGET = 1500  # 載入的對話歷史（摘要 + 逐字保留的對話）的 token 上限
+MEMORY_KEEP_TURNS = 4  # 逐字保留的最近對話輪數
+MEMORY_SUMMARY_MAX_TOKENS = 400  # 滾動摘要的 token 上限
+
+SUMMARY_PROMPT = (
+    "請將以下對話濃縮成不超過 {max_tokens} 字的摘要，保留提到的檔案名稱、人名與關鍵數字，只輸出摘要本身。\n\n"
+    "既有摘要：\n{summary}\n\n新的對話：\n{lines}"
+)
+
+# 摘要在單一背景執行緒中依序計算，不佔用回答問題的時間
+_summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-summary")
+
+def _message_tokens(message: BaseMessage) -> int:
+    return estimate_tokens(message.content) + 2
+
+# 有 token 預算的對話記憶：最近幾輪逐字保留，較舊的對話併入滾動摘要
+class TokenBudgetMemory(BaseChatMemory):
+    """
+    save_context 把超出 keep_turns 輪或超出預算的舊訊息移到待摘要列表，交給背景執行緒併入摘要。
+    load_memory_variables 回傳 [摘要] + 尚未摘要但放得下的舊訊息 + 最近對話，總量不超過 max_token_limit。
+    llm 為 None 或摘要失敗時，改為保留舊對話的最後 summary_max_tokens 個 token。
+    """
+    llm: Any = None
+    memory_key: str = "chat_history"
+    max_token_limit: int = MEMORY_TOKEN_BUDGET
+    keep_turns: int = MEMORY_KEEP_TURNS
+    summary_max_tokens: int = MEMORY_SUMMARY_MAX_TOKENS
+    summary: str = ""
+
+    _pending: List[BaseMessage] = PrivateAttr(default_factory=list)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _future: Any = PrivateAttr(default=None)
+    _generation: int = PrivateAttr(default=0)
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            summary = self.summary
+            pending = list(self._pending)
+        messages = list(self.chat_memory.messages)
+        budget = self.max_token_limit - sum(_message_tokens(message) for message in messages)
+        history = []
+        if summary:
+            history.append(SystemMessage(content=f"先前對話摘要：{summary}"))
+            budget -= _message_tokens(history[0])
+        # 背景摘要尚未完成時，舊訊息在預算內仍然放入，避免剛移出的對話暫時消失
+        visible = []
+        for message in reversed(pending):
+            budget -= _message_tokens(message)
+            if budget < 0:
+                break
+            visible.append(message)
+        history.extend(reversed(visible))
+        history.extend(messages)
+        if not self.return_messages:
+            history = get_buffer_string(history)
+        return {self.memory_key: history}
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        super().save_context(inputs, outputs)
+        self._fold_old_messages()
+
+    # 以既有的訊息重建記憶（例如切換到另一個對話）
+    def load_history(self, messages: List[BaseMessage]) -> None:
+        self.clear()
+        self.chat_memory.add_messages(messages)
+        self._fold_old_messages()
+
+    def clear(self) -> None:
+        super().clear()
+        with self._lock:
+            self.summary = ""
+            self._pending = []
+            self._future = None
+            self._generation += 1  # 進行中的摘要結果作廢
+
+    # 等待背景摘要完成（效能測試或需要確定摘要內容時使用）
+    def wait_for_summary(self, timeout: float = None) -> None:
+        future = self._future
+        if future is not None:
+            future.result(timeout)
+
+    def _fold_old_messages(self) -> None:
+        messages = list(self.chat_memory.messages)
+        limit = self.max_token_limit - self.summary_max_tokens
+        tokens = sum(_message_tokens(message) for message in messages)
+        cut = 0
+        # 至少保留最後一輪（兩則訊息）
+        while len(messages) - cut > 2 and (len(messages) - cut > self.keep_turns * 2 or tokens > limit):
+            tokens -= _message_tokens(messages[cut])
+            cut += 1
+        if not cut:
+            return
+        self.chat_memory.clear()
+        self.chat_memory.add_messages(messages[cut:])
+        with self._lock:
+            self._pending.extend(messages[:cut])
+            if self._future is None:
+                self._future = _summary_executor.submit(self._summarize_pending, self._generation)
+
+    def _summarize_pending(self, generation: int) -> None:
+        while True:
+            with self._lock:
+                if generation != self._generation:
+                    return
+                if not self._pending:
+                    self._future = None
+                    return
+                pending = list(self._pending)
+                summary = self.summary
+            new_summary = self._summarize(summary, pending)
+            with self._lock:
+                if generation != self._generation:
+                    return
+                self.summary = new_summary
+                del self._pending[:len(pending)]
+
+    def _summarize(self, summary: str, messages: List[BaseMessage]) -> str:
+        lines = get_buffer_string(messages)
+        if self.llm is not None:
+            try:
+                result = self.llm.invoke(SUMMARY_PROMPT.format(max_tokens=self.summary_max_tokens,
+                                                               summary=summary or "（無）", lines=lines))
+                text = result if isinstance(result, str) else getattr(result, "content", str(result))
+                if text and not text.startswith("無法生成回答"):
+                    return tail_within_tokens(text.strip(), self.summary_max_tokens)
+            except Exception as e:
+                print(f"對話摘要失敗，改為截斷舊對話：{e}")
+        return tail_within_tokens(f"{summary}\n{lines}".strip(), self.summary_max_tokens)
@@ -1,10 +1,27 @@
 import os
+import re
+import sys
+import json
+import time
 import shutil
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from sentence_transformers import SentenceTransformer
-import chromadb
 from chromadb.utils import embedding_functions
 from PyPDF2 import PdfReader
 from docx import Document as DocxReader  # 導入讀取 docx 的庫
+from text_cache import ExtractedTextCache, TEXT_CACHE_PATH, TEXT_CACHE_MAX_MB
+from lexical_index import LexicalIndex, LEXICAL_INDEX_PATH
+from centroid_index import CentroidIndex, CENTROID_INDEX_PATH
+from vector_store import open_vector_store, VECTOR_BACKEND, VECTOR_BACKENDS, FLAT_INDEX_PATH
+from onnx_inference import OnnxSentenceEncoder, use_onnx
+
+try:
+    import resource  # 僅 Unix 提供，用於回報記憶體高水位
+except ImportError:
+    resource = None
 
 # 設置參數
 MODEL_PATH = "./paraphrase-multilingual-MiniLM-L12-v2"  # 本地嵌入模型路徑
@@ -12,23 +29,204 @@ PDF_DIR = "./KM_pool"  # PDF 和 DOCX 檔案目錄
 CHROMA_PATH = "./chroma_db"  # Chroma 儲存路徑
 CHUNK_SIZE = 500  # 每個 chunk 的目標字符數
 CHUNK_OVERLAP = 100  # chunk 間的重疊字符數
+COLLECTION_NAME = "pdf_docx_collection"  # Chroma 集合名稱
+MANIFEST_PATH = os.path.join(CHROMA_PATH, "index_manifest.json")  # 增量索引清單
+SUPPORTED_EXTENSIONS = (".pdf", ".docx")
+HASH_BLOCK_SIZE = 1 << 20  # 計算雜湊時每次讀取的位元組數
+DELETE_BATCH_SIZE = 5000  # 每次從集合刪除的 id 數量上限
+EXTRACT_WORKERS = max(1, (os.cpu_count() or 1) - 1)  # 平行解析檔案的行程數（保留一核給寫入端）
+EMBED_BATCH_SIZE = 64  # 每次送入模型編碼的 chunk 數（跨檔案累積）
+ENCODE_WORKERS = 1  # 大於 1 時使用 SentenceTransformer 多行程池編碼
+# 句子邊界：中文全形標點（可接引號、括號）、後接空白或結尾的英文標點、換行
+# 開頭的 lookahead 讓 re 先以字元集合快速略過非標點字元，再嘗試各分支
+SENTENCE_BOUNDARY_PATTERN = re.compile(r"(?=[。！？；….!?;\n])(?:[。！？；…]+[」』”’）)]*|[.!?;]+(?=\s|$)|\n+)")
+REDACT_PAGE_SIZE = 256  # 重新計算去敏化結果時每次讀取的 chunk 數
+PAGES_PER_TASK = 16  # 每個解析工作處理的 PDF 頁數（大型 PDF 會被切成多個工作）
+MAX_PENDING_TASKS_PER_WORKER = 2  # 每個行程最多排隊的工作數，限制尚未寫入的結果佔用的記憶體
+
+# 回傳目前行程與已結束子行程的最大常駐記憶體 (MB)，不支援的平台回傳 None
+def peak_memory_mb():
+    if resource is None:
+        return None
+    # ru_maxrss 在 macOS 以位元組為單位，在 Linux 以 KB 為單位
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+    }
+
+# 以 ONNX Runtime 執行嵌入模型的 Chroma 嵌入函數
+# 模型與設定都和 SentenceTransformerEmbeddingFunction 相同，沿用其名稱與設定，既有集合不會被判定為換了嵌入函數
+class OnnxEmbeddingFunction(embedding_functions.SentenceTransformerEmbeddingFunction):
+    def __init__(self, model_name=MODEL_PATH, device="cpu", normalize_embeddings=False, **kwargs):
+        self.model_name = model_name
+        self.device = device
+        self.normalize_embeddings = normalize_embeddings
+        self.kwargs = kwargs
+        self._model = OnnxSentenceEncoder(model_name)
 
-# 初始化嵌入函數
+# 初始化嵌入函數（onnx_inference.INFERENCE_BACKEND 為 "onnx" 且模型已匯出時使用 ONNX Runtime）
 def init_embedding_function():
+    if use_onnx(MODEL_PATH):
+        return OnnxEmbeddingFunction(model_name=MODEL_PATH)
     return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=MODEL_PATH)
 
+# 取得 SentenceTransformer 模型，優先共用嵌入函數已載入的權重，避免同一模型載入兩次
+def load_sentence_model(embedding_function=None):
+    model = getattr(embedding_function, "_model", None)
+    if model is not None:
+        return model
+    return OnnxSentenceEncoder(MODEL_PATH) if use_onnx(MODEL_PATH) else SentenceTransformer(MODEL_PATH)
+
+# 各向量資料庫後端各自的增量索引清單、文字索引與中心向量索引（切換後端時新後端會完整建立索引）
+# Chroma 沿用 chroma_db 下的原路徑，其他後端放在各自的資料夾中
+def _backend_path(chroma_path, backend):
+    if backend == "chroma":
+        return chroma_path
+    return os.path.join(FLAT_INDEX_PATH, os.path.basename(chroma_path))
+
+def manifest_path_for(backend=VECTOR_BACKEND):
+    return _backend_path(MANIFEST_PATH, backend)
+
+def lexical_index_path_for(backend=VECTOR_BACKEND):
+    return _backend_path(LEXICAL_INDEX_PATH, backend)
+
+def centroid_index_path_for(backend=VECTOR_BACKEND):
+    return _backend_path(CENTROID_INDEX_PATH, backend)
+
+# 延遲載入 guardrail（BERT NER 模型），避免解析與編碼的子行程也載入模型
+def load_guardrails():
+    import ner_guardrails
+    return ner_guardrails
+
+# 為 chunk 計算去敏化內容，存入 metadata 供查詢時直接使用
+def redact_metadatas(documents, metadatas):
+    guardrails = load_guardrails()
+    version = guardrails.guardrail_fingerprint()
+    return [dict(metadata, redacted_content=redacted, guardrail_version=version)
+            for metadata, redacted in zip(metadatas, guardrails.redact_texts(documents))]
+
+# 批次嵌入寫入器：跨檔案累積 chunk，湊滿固定批次後自行編碼，再連同 embeddings 寫入集合
+class EmbeddingWriter:
+    def __init__(self, collection, model, batch_size=EMBED_BATCH_SIZE, encode_workers=ENCODE_WORKERS, redact=True,
+                 lexical_index=None, centroid_index=None):
+        self.collection = collection
+        self.model = model
+        self.lexical_index = lexical_index
+        self.centroid_index = centroid_index
+        self.batch_size = batch_size
+        self.redact = redact
+        self.pool = None
+        # ONNX Runtime 在單一行程內即以多執行緒推論，只有 SentenceTransformer 使用多行程池
+        if encode_workers > 1 and hasattr(model, "start_multi_process_pool"):
+            self.pool = model.start_multi_process_pool(target_devices=["cpu"] * encode_workers)
+        self.documents = []
+        self.metadatas = []
+        self.ids = []
+        self.total_chunks = 0
+        self.encode_seconds = 0.0
+        self.redact_seconds = 0.0
+        self.started_at = time.perf_counter()
+
+    def add(self, documents, metadatas, ids):
+        self.documents.extend(documents)
+        self.metadatas.extend(metadatas)
+        self.ids.extend(ids)
+        while len(self.documents) >= self.batch_size:
+            self._write(self.batch_size)
+
+    def encode(self, documents):
+        started = time.perf_counter()
+        if self.pool is not None:
+            embeddings = self.model.encode_multi_process(documents, self.pool, batch_size=self.batch_size)
+        else:
+            embeddings = self.model.encode(documents, batch_size=self.batch_size, show_progress_bar=False)
+        self.encode_seconds += time.perf_counter() - started
+        return embeddings.tolist()
+
+    def _write(self, size):
+        documents, self.documents = self.documents[:size], self.documents[size:]
+        metadatas, self.metadatas = self.metadatas[:size], self.metadatas[size:]
+        ids, self.ids = self.ids[:size], self.ids[size:]
+        if self.redact:
+            started = time.perf_counter()
+            metadatas = redact_metadatas(documents, metadatas)
+            self.redact_seconds += time.perf_counter() - started
+        # 傳入預先計算的 embeddings，Chroma 不會再呼叫嵌入函數
+        embeddings = self.encode(documents)
+        self.collection.upsert(
+            documents=documents,
+            metadatas=metadatas,
+            embeddings=embeddings,
+            ids=ids
+        )
+        if self.lexical_index is not None:
+            self.lexical_index.add(ids, documents, metadatas)
+        if self.centroid_index is not None:
+            self.centroid_index.add(ids, embeddings, metadatas)
+        self.total_chunks += len(ids)
+
+    def flush(self):
+        if self.documents:
+            self._write(len(self.documents))
+
+    # 捨棄指定 chunk：移除緩衝區中尚未寫入的部分，並刪除已寫入集合的部分
+    def discard(self, ids):
+        dropped = set(ids)
+        keep = [i for i, chunk_id in enumerate(self.ids) if chunk_id not in dropped]
+        self.documents = [self.documents[i] for i in keep]
+        self.metadatas = [self.metadatas[i] for i in keep]
+        self.ids = [self.ids[i] for i in keep]
+        delete_chunks(self.collection, list(ids), self.lexical_index, self.centroid_index)
+
+    def close(self):
+        self.flush()
+        if self.pool is not None:
+            self.model.stop_multi_process_pool(self.pool)
+            self.pool = None
+        elapsed = time.perf_counter() - self.started_at
+        rate = self.total_chunks / elapsed if elapsed > 0 else 0.0
+        print(f"共嵌入 {self.total_chunks} 個文本片段，耗時 {elapsed:.1f} 秒"
+              f"（編碼 {self.encode_seconds:.1f} 秒，去敏化 {self.redact_seconds:.1f} 秒），吞吐量 {rate:.1f} chunks/秒")
+        memory = peak_memory_mb()
+        if memory:
+            print(f"記憶體高水位：主行程 {memory['self']:.0f} MB，子行程 {memory['children']:.0f} MB")
+        return {"chunks": self.total_chunks, "seconds": elapsed, "encode_seconds": self.encode_seconds,
+                "redact_seconds": self.redact_seconds, "chunks_per_second": rate, "peak_memory_mb": memory}
+
+# 計算 PDF 頁數（只讀取頁面目錄，不解析內容）
+def count_pdf_pages(pdf_path):
+    return len(PdfReader(pdf_path).pages)
+
+# 逐頁產出 PDF 文字並清理，可指定頁碼範圍（讀取失敗時直接拋出例外）
+def iter_pdf_pages(pdf_path, first_page=1, last_page=None):
+    pages = PdfReader(pdf_path).pages
+    last_page = len(pages) if last_page is None else min(last_page, len(pages))
+    for page_num in range(first_page, last_page + 1):
+        text = pages[page_num - 1].extract_text() or ""
+        # 清理多餘換行和空白
+        text = " ".join(text.split())
+        if text:
+            yield {"page_num": page_num, "text": text}
+
+# 讀取 PDF 每頁文字並清理（讀取失敗時直接拋出例外）
+def read_pdf_pages(pdf_path):
+    return list(iter_pdf_pages(pdf_path))
+
+# 讀取 DOCX 每個段落並清理（讀取失敗時直接拋出例外）
+def read_docx_paragraphs(docx_path):
+    document = DocxReader(docx_path)
+    full_text = []
+    for paragraph in document.paragraphs:
+        text = paragraph.text.strip()
+        if text:
+            full_text.append({"text": text})
+    return full_text
+
 # 提取 PDF 文字並清理
 def extract_text_from_pdf(pdf_path):
     try:
-        reader = PdfReader(pdf_path)
-        text_by_page = []
-        for page_num, page in enumerate(reader.pages, 1):
-            text = page.extract_text() or ""
-            # 清理多餘換行和空白
-            text = " ".join(text.split())
-            if text:
-                text_by_page.append({"page_num": page_num, "text": text})
-        return text_by_page
+        return read_pdf_pages(pdf_path)
     except Exception as e:
         print(f"讀取PDF時發生錯誤: {e}")
         return []
@@ -36,146 +234,572 @@ def extract_text_from_pdf(pdf_path):
 # 提取 DOCX 文字並清理
 def extract_text_from_docx(docx_path):
     try:
-        document = DocxReader(docx_path)
-        full_text = []
-        for paragraph in document.paragraphs:
-            text = paragraph.text.strip()
-            if text:
-                full_text.append({"text": text})
-        return full_text
+        return read_docx_paragraphs(docx_path)
     except Exception as e:
         print(f"讀取DOCX時發生錯誤: {e}")
         return []
 
+# 一次掃描找出所有句子結束位置（回傳每個句子結尾的字元位移）
+def find_sentence_boundaries(text):
+    return [match.end() for match in SENTENCE_BOUNDARY_PATTERN.finditer(text)]
+
 # 分割文字（帶重疊）
 def split_text(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """
+    先找出句子邊界，再把完整句子裝進不超過 chunk_size 的 chunk，
+    下一個 chunk 從前一個 chunk 最後 overlap 字元內的句首開始。
+    單句超過 chunk_size 時改在空白處切，仍找不到空白才硬切。
+    邊界指標只會前進，整體為線性時間。
+    """
     if not text:
         return []
 
-    chunks = []
-    start = 0
     text_length = len(text)
+    bounds = find_sentence_boundaries(text)
+    if not bounds or bounds[-1] != text_length:
+        bounds.append(text_length)
 
+    chunks = []
+    start = 0
+    prev_end = 0
+    last_fit = 0  # 不超過目前上限的最後一個邊界
+    overlap_idx = 0  # 重疊區內第一個邊界
     while start < text_length:
-        end = min(start + chunk_size, text_length)
-        # 確保不切斷單詞
-        if end < text_length:
-            while end > start and text[end] not in " .!?":
-                end -= 1
-            if end == start:
-                end = min(start + chunk_size, text_length)
+        limit = min(start + chunk_size, text_length)
+        while last_fit + 1 < len(bounds) and bounds[last_fit + 1] <= limit:
+            last_fit += 1
+        floor = max(start, prev_end)  # 結尾必須超過前一個 chunk，確保前進
+        if floor < bounds[last_fit] <= limit:
+            end = bounds[last_fit]
+        else:
+            space = text.rfind(" ", floor + 1, limit)
+            end = space if space > floor else limit
 
         chunk = text[start:end].strip()
         if chunk:
             chunks.append(chunk)
-        start = end - overlap if end < text_length else text_length
+        if end >= text_length:
+            break
+
+        # 在重疊區內尋找句首；沒有句首時退回字元位移並對齊到空白
+        overlap_start = end - overlap
+        while overlap_idx < len(bounds) and bounds[overlap_idx] < overlap_start:
+            overlap_idx += 1
+        if overlap_idx < len(bounds) and bounds[overlap_idx] < end:
+            next_start = bounds[overlap_idx]
+        else:
+            space = text.find(" ", overlap_start, end)
+            next_start = space + 1 if space != -1 else overlap_start
+        prev_end = end
+        start = next_start if next_start > start else end
 
     return chunks
 
-# 處理並嵌入單個檔案 (PDF 或 DOCX)
-def process_file(file_path, collection):
-    file_name = os.path.basename(file_path)
-    print(f"處理檔案：{file_name}")
-    all_documents = []
-    all_metadatas = []
-    all_ids = []
-    total_chunks = 0
-
-    if file_path.lower().endswith(".pdf"):
-        pages = extract_text_from_pdf(file_path)
-        if not pages:
-            print(f"警告：{file_name} 無內容或讀取失敗，跳過")
-            return
-        for page in pages:
-            page_num = page["page_num"]
-            text = page["text"]
-            chunks = split_text(text, CHUNK_SIZE, CHUNK_OVERLAP)
-            for i, chunk in enumerate(chunks):
-                all_documents.append(f"**檔案名稱：{file_name}**\n\n內容：{chunk}") # 只儲存原始文本 chunk
-                all_metadatas.append({
+# 判斷檔案類型
+def file_kind(file_path):
+    return "pdf" if file_path.lower().endswith(".pdf") else "docx"
+
+# 逐一產出檔案的文字單位 (編號, 文字)：PDF 為頁碼，DOCX 為段落索引（DOCX 忽略頁碼範圍）
+def iter_source_units(file_path, first_page=1, last_page=None):
+    if file_kind(file_path) == "pdf":
+        for page in iter_pdf_pages(file_path, first_page, last_page):
+            yield page["page_num"], page["text"]
+    else:
+        for i, paragraph_data in enumerate(read_docx_paragraphs(file_path)):
+            yield i, paragraph_data["text"]
+
+# 將文字單位分割成 chunk，逐一產出 (document, metadata, chunk id)
+def iter_unit_chunks(file_name, kind, units):
+    for unit_num, text in units:
+        for i, chunk in enumerate(split_text(text, CHUNK_SIZE, CHUNK_OVERLAP)):
+            if kind == "pdf":
+                metadata = {
                     "source": file_name,
-                    "page_num": page_num,
+                    "page_num": unit_num,
                     "chunk_id": i,
                     "file_name": file_name
-                })
-                all_ids.append(f"{file_name}_page{page_num}_{i}")
-            total_chunks += len(chunks)
-            print(f"已分割 {file_name} 頁 {page_num}，共 {len(chunks)} 個片段")
-
-    elif file_path.lower().endswith(".docx"):
-        paragraphs = extract_text_from_docx(file_path)
-        if not paragraphs:
-            print(f"警告：{file_name} 無內容或讀取失敗，跳過")
-            return
-        for i, paragraph_data in enumerate(paragraphs):
-            text = paragraph_data["text"]
-            chunks = split_text(text, CHUNK_SIZE, CHUNK_OVERLAP)
-            for j, chunk in enumerate(chunks):
-                all_documents.append(f"檔案名稱：{file_name}\n內容：{chunk}") # 只儲存原始文本 chunk
-                all_metadatas.append({
+                }
+                yield f"**檔案名稱：{file_name}**\n\n內容：{chunk}", metadata, f"{file_name}_page{unit_num}_{i}"
+            else:
+                metadata = {
                     "source": file_name,
-                    "paragraph": i + 1,
-                    "chunk_id": j,
+                    "paragraph": unit_num + 1,
+                    "chunk_id": i,
                     "file_name": file_name
-                })
-                all_ids.append(f"{file_name}_para{i}_{j}")
-            total_chunks += len(chunks)
-            print(f"已分割 {file_name} 段落 {i+1}，共 {len(chunks)} 個片段")
-
-    # 批量嵌入
-    if all_documents:
-        collection.add(
-            documents=all_documents,
-            metadatas=all_metadatas,
-            ids=all_ids
-        )
-        print(f"已嵌入 {file_name}，共 {total_chunks} 個文本片段")
-    else:
-        print(f"{file_name} 無有效內容可嵌入")
+                }
+                yield f"檔案名稱：{file_name}\n內容：{chunk}", metadata, f"{file_name}_para{unit_num}_{i}"
+
+# 逐頁解析並分割檔案 (PDF 或 DOCX)，逐一產出 (document, metadata, chunk id)
+def iter_file_chunks(file_path, first_page=1, last_page=None):
+    yield from iter_unit_chunks(os.path.basename(file_path), file_kind(file_path),
+                                iter_source_units(file_path, first_page, last_page))
+
+# 將檔案拆成解析工作：PDF 每 pages_per_task 頁一個工作，DOCX 整份一個工作
+# 內容雜湊已在快取中的檔案改為從快取讀取文字，不再重新解析
+def plan_extraction_tasks(file_paths, pages_per_task=PAGES_PER_TASK, cache=None, file_hashes=None):
+    file_hashes = file_hashes or {}
+    for file_path in file_paths:
+        kind = file_kind(file_path)
+        task = {"file_path": file_path, "kind": kind, "cached": False, "last": True}
+        if cache is not None:
+            task["hash"] = file_hashes.get(os.path.basename(file_path)) or compute_file_hash(file_path)
+            cached = cache.lookup(task["hash"])
+            if cached is not None:
+                task.update(cached=True, cache_path=cache.path)
+                kind = cached["kind"]
+                unit_count = cached["unit_count"]
+        if kind == "docx":
+            yield dict(task, first_page=None, last_page=None)
+            continue
+        if not task["cached"]:
+            try:
+                unit_count = count_pdf_pages(file_path)
+            except Exception as e:
+                yield dict(task, error=f"{type(e).__name__}: {e}")
+                continue
+        task["unit_count"] = unit_count
+        if unit_count == 0:
+            yield dict(task, first_page=1, last_page=0)
+        for first_page in range(1, unit_count + 1, pages_per_task):
+            last_page = min(first_page + pages_per_task - 1, unit_count)
+            yield dict(task, first_page=first_page, last_page=last_page, last=last_page == unit_count)
+
+# 行程池中執行的工作：解析一段頁碼範圍，錯誤以結果回傳而不是拋出，避免中斷整批處理
+def extract_segment_worker(task):
+    result = {"file_name": os.path.basename(task["file_path"]), "last": task["last"], "kind": task["kind"],
+              "hash": task.get("hash"), "cached": task["cached"], "unit_count": task.get("unit_count"),
+              "units": [], "documents": [], "metadatas": [], "ids": [], "error": task.get("error")}
+    if result["error"]:
+        return result
+    try:
+        if task["cached"]:
+            cache = ExtractedTextCache(task["cache_path"], read_only=True)
+            try:
+                units = list(cache.iter_units(task["hash"], task["first_page"], task["last_page"]))
+            finally:
+                cache.close()
+        else:
+            # 新解析的文字一併回傳，由主行程寫入快取
+            units = list(iter_source_units(task["file_path"], task["first_page"], task["last_page"]))
+            if task.get("hash"):
+                result["units"] = units
+        for document, metadata, chunk_id in iter_unit_chunks(result["file_name"], task["kind"], units):
+            result["documents"].append(document)
+            result["metadatas"].append(metadata)
+            result["ids"].append(chunk_id)
+    except Exception as e:
+        result.update(units=[], documents=[], metadatas=[], ids=[], error=f"{type(e).__name__}: {e}")
+    return result
+
+# 以多個行程平行解析，並依輸入順序逐一產出結果（確保 chunk id 與寫入順序穩定）
+# 同時間最多只有 workers * MAX_PENDING_TASKS_PER_WORKER 個工作尚未被寫入端取走，記憶體用量與語料大小無關
+def iter_extracted_segments(tasks, workers=EXTRACT_WORKERS):
+    if workers <= 1:
+        for task in tasks:
+            yield extract_segment_worker(task)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(extract_segment_worker, task))
+            if len(pending) >= workers * MAX_PENDING_TASKS_PER_WORKER:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# 處理並嵌入單個檔案 (PDF 或 DOCX)
+def process_file(file_path, collection):
+    print(f"處理檔案：{os.path.basename(file_path)}")
+    writer = EmbeddingWriter(collection, load_sentence_model())
+    chunk_ids_by_file, _ = process_files([file_path], writer, workers=1)
+    writer.close()
+    return chunk_ids_by_file.get(os.path.basename(file_path), [])
+
+# 平行解析多個檔案，由目前行程的寫入器（唯一擁有集合的寫入端）依序寫入
+def process_files(file_paths, writer, workers=EXTRACT_WORKERS, cache=None, file_hashes=None):
+    """
+    解析、分割、嵌入與寫入以串流方式進行，每次只處理固定頁數，
+    寫入器的緩衝區也只保留一個批次，因此峰值記憶體不隨檔案或語料大小增加。
+    指定 cache 時，已解析過的內容直接從快取讀取，新解析的頁面則寫入快取。
+    Returns:
+        tuple: ({檔名: chunk id 列表}, {檔名: 錯誤訊息})，讀取失敗的檔案只會出現在後者。
+    """
+    chunk_ids_by_file = {}
+    failures = {}
+    cache_hits = 0
+    tasks = plan_extraction_tasks(file_paths, PAGES_PER_TASK, cache, file_hashes)
+    for segment in iter_extracted_segments(tasks, workers):
+        file_name = segment["file_name"]
+        if file_name in failures:
+            continue
+        if segment["error"]:
+            print(f"警告：{file_name} 讀取失敗，跳過（{segment['error']}）")
+            failures[file_name] = segment["error"]
+            # 同一檔案前面頁數已寫入的 chunk 與快取一併移除
+            written_ids = chunk_ids_by_file.pop(file_name, [])
+            if written_ids:
+                writer.discard(written_ids)
+            if cache is not None and segment["hash"] and not segment["cached"]:
+                cache.discard(segment["hash"])
+            continue
+        if cache is not None and segment["units"]:
+            cache.put_units(segment["hash"], segment["units"])
+        chunk_ids = chunk_ids_by_file.setdefault(file_name, [])
+        if segment["documents"]:
+            writer.add(segment["documents"], segment["metadatas"], segment["ids"])
+            chunk_ids.extend(segment["ids"])
+        if segment["last"]:
+            if segment["cached"]:
+                cache_hits += 1
+            elif cache is not None and segment["hash"]:
+                unit_count = segment["unit_count"] if segment["kind"] == "pdf" else len(segment["units"])
+                cache.commit_file(segment["hash"], segment["kind"], unit_count)
+            if chunk_ids:
+                print(f"已分割 {file_name}，共 {len(chunk_ids)} 個文本片段")
+            else:
+                print(f"{file_name} 無有效內容可嵌入")
+    writer.flush()
+    if cache is not None:
+        print(f"解析快取命中 {cache_hits} / {len(chunk_ids_by_file)} 個檔案")
+    if failures:
+        print(f"共 {len(failures)} 個檔案讀取失敗：{', '.join(failures)}")
+    return chunk_ids_by_file, failures
 
 # 處理 PDF 和 DOCX 檔案
-def process_pdfs_and_docx(pdf_dir, collection):
-    all_files = [f for f in os.listdir(pdf_dir) if f.lower().endswith((".pdf", ".docx"))]
+def process_pdfs_and_docx(pdf_dir, collection, workers=EXTRACT_WORKERS):
+    all_files = list_source_files(pdf_dir)
     if not all_files:
         print(f"警告：目錄 {pdf_dir} 中找不到 PDF 或 DOCX 檔案")
-        return
+        return {}
+
+    writer = EmbeddingWriter(collection, load_sentence_model())
+    chunk_ids_by_file, _ = process_files([os.path.join(pdf_dir, f) for f in all_files], writer, workers)
+    writer.close()
+    return chunk_ids_by_file
+
+# 列出目錄中支援的檔案（排序以確保處理順序穩定）
+def list_source_files(pdf_dir):
+    return sorted(f for f in os.listdir(pdf_dir) if f.lower().endswith(SUPPORTED_EXTENSIONS))
+
+# 計算檔案內容的 SHA-256 雜湊
+def compute_file_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# 目前的分割參數，記錄在清單中；參數改變時所有檔案都需要重新分割與嵌入
+def current_chunk_params():
+    return {"chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP}
+
+# 讀取增量索引清單：{"chunk_params": {...}, "files": {檔名: {size, mtime_ns, hash, chunk_ids}},
+#                    "failed": {檔名: {size, mtime_ns, hash, error}}}
+def load_manifest(manifest_path=MANIFEST_PATH):
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"files": {}, "failed": {}}
+    manifest.setdefault("files", {})
+    manifest.setdefault("failed", {})
+    return manifest
+
+# 寫入增量索引清單（先寫暫存檔再取代，避免中斷時留下損毀的清單）
+def save_manifest(manifest, manifest_path=MANIFEST_PATH):
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+# 比對目錄與清單，找出新增、修改、刪除與未變更的檔案
+def diff_manifest(manifest, pdf_dir):
+    """
+    先比較檔案大小與修改時間，只有兩者不同時才計算內容雜湊，
+    因此未變更的檔案不需要重新讀取內容。分割參數與清單記錄不同時，
+    所有既有檔案都視為已修改（文字會從解析快取讀取，只重新分割與嵌入）。
+    上次讀取失敗且內容未變的檔案列在 failed，不再重新解析；內容改變後視為新增，重新嘗試。
+    Returns:
+        dict: added / modified / removed / unchanged / failed 五個檔名列表，
+              stats（目前每個檔案的 size、mtime_ns、hash），
+              以及 redaction_stale（guardrail 模型或規則改變，既有的去敏化結果需要重新計算）。
+    """
+    known = manifest["files"]
+    failed = manifest.get("failed", {})
+    changes = {"added": [], "modified": [], "removed": [], "unchanged": [], "failed": [], "stats": {}}
+    current_files = list_source_files(pdf_dir)
+    rechunk = bool(known) and manifest.get("chunk_params") != current_chunk_params()
+
+    for file_name in current_files:
+        file_stat = os.stat(os.path.join(pdf_dir, file_name))
+        stat = {"size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns}
+        entry = known.get(file_name)
+        failure = failed.get(file_name) if entry is None else None
+        if entry and entry.get("size") == stat["size"] and entry.get("mtime_ns") == stat["mtime_ns"]:
+            stat["hash"] = entry.get("hash")
+            changes["unchanged"].append(file_name)
+        elif failure and failure.get("size") == stat["size"] and failure.get("mtime_ns") == stat["mtime_ns"]:
+            stat["hash"] = failure.get("hash")
+            changes["failed"].append(file_name)
+        else:
+            stat["hash"] = compute_file_hash(os.path.join(pdf_dir, file_name))
+            if failure and failure.get("hash") == stat["hash"]:
+                changes["failed"].append(file_name)
+            elif entry is None:
+                changes["added"].append(file_name)
+            elif entry.get("hash") == stat["hash"]:
+                # 僅修改時間改變（例如重新複製），內容相同不需重新嵌入
+                changes["unchanged"].append(file_name)
+            else:
+                changes["modified"].append(file_name)
+        changes["stats"][file_name] = stat
+
+    if rechunk:
+        changes["modified"] = sorted(changes["modified"] + changes["unchanged"])
+        changes["unchanged"] = []
+
+    current = set(current_files)
+    changes["removed"] = sorted(f for f in known if f not in current)
+    changes["redaction_stale"] = bool(known) and \
+        manifest.get("guardrail_version") != load_guardrails().guardrail_fingerprint()
+    return changes
+
+# 檢查目錄自上次建立索引後是否有變更（供 app.py 使用）
+# 未指定清單時使用 VECTOR_BACKEND 對應的清單（flat 後端的清單不在 MANIFEST_PATH）
+def detect_index_changes(pdf_dir=PDF_DIR, manifest_path=None):
+    return diff_manifest(load_manifest(manifest_path or manifest_path_for(VECTOR_BACKEND)), pdf_dir)
+
+# 語料版本：由清單中每個檔案的內容雜湊、分割參數與 guardrail 指紋計算，重新索引後即改變
+# 依清單檔的修改時間與大小記憶結果，查詢路徑上不必每次讀取清單
+_corpus_versions = {}
 
-    for file_name in all_files:
-        file_path = os.path.join(pdf_dir, file_name)
-        process_file(file_path, collection)
+def corpus_version(manifest_path=MANIFEST_PATH):
+    try:
+        manifest_stat = os.stat(manifest_path)
+        stat_key = (manifest_stat.st_mtime_ns, manifest_stat.st_size)
+    except FileNotFoundError:
+        stat_key = None
+    cached = _corpus_versions.get(manifest_path)
+    if cached is not None and cached[0] == stat_key:
+        return cached[1]
+    manifest = load_manifest(manifest_path)
+    state = {
+        "chunk_params": manifest.get("chunk_params"),
+        "guardrail_version": manifest.get("guardrail_version"),
+        "files": sorted((name, info.get("hash")) for name, info in manifest["files"].items()),
+    }
+    version = hashlib.sha256(json.dumps(state, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+    _corpus_versions[manifest_path] = (stat_key, version)
+    return version
+
+# 分批從集合（以及文字索引）中刪除 chunk
+def delete_chunks(collection, chunk_ids, lexical_index=None, centroid_index=None):
+    for start in range(0, len(chunk_ids), DELETE_BATCH_SIZE):
+        collection.delete(ids=chunk_ids[start:start + DELETE_BATCH_SIZE])
+    if lexical_index is not None:
+        lexical_index.delete(chunk_ids)
+    if centroid_index is not None:
+        centroid_index.delete(chunk_ids)
+
+# 由集合內容重建文字索引（索引不存在或與集合不一致時使用）
+def rebuild_lexical_index(collection, lexical_index, page_size=REDACT_PAGE_SIZE):
+    lexical_index.clear()
+    offset = 0
+    while True:
+        page = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        lexical_index.add(page["ids"], page["documents"], page["metadatas"])
+        offset += len(page["ids"])
+    lexical_index.commit()
+    print(f"已由集合重建文字索引，共 {offset} 個文本片段")
+
+# 由集合中儲存的向量重建檔案與頁面的中心向量（刪除過部分 chunk 或與集合不一致時使用）
+def rebuild_centroid_index(collection, centroid_index, page_size=REDACT_PAGE_SIZE):
+    centroid_index.clear()
+    offset = 0
+    while True:
+        page = collection.get(include=["embeddings", "metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        centroid_index.add(page["ids"], page["embeddings"], page["metadatas"])
+        offset += len(page["ids"])
+    print(f"已由集合重建中心向量索引，共 {offset} 個文本片段、{centroid_index.file_count()} 個檔案")
+
+# 重新計算過期的去敏化結果（只更新 metadata，不需要重新嵌入）
+def refresh_redactions(collection, page_size=REDACT_PAGE_SIZE):
+    version = load_guardrails().guardrail_fingerprint()
+    offset = 0
+    updated = 0
+    while True:
+        page = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        stale = [(chunk_id, document, metadata)
+                 for chunk_id, document, metadata in zip(page["ids"], page["documents"], page["metadatas"])
+                 if metadata.get("guardrail_version") != version]
+        if stale:
+            ids, documents, metadatas = (list(column) for column in zip(*stale))
+            collection.update(ids=ids, metadatas=redact_metadatas(documents, metadatas))
+            updated += len(ids)
+        offset += len(page["ids"])
+    print(f"已重新計算 {updated} 個文本片段的去敏化內容")
+    return updated
+
+# 增量更新：只嵌入新增或修改的檔案，並刪除已移除或修改檔案的舊 chunk
+def sync_index(collection, pdf_dir=PDF_DIR, manifest_path=MANIFEST_PATH, workers=EXTRACT_WORKERS, writer=None,
+               cache_path=TEXT_CACHE_PATH, cache_max_mb=TEXT_CACHE_MAX_MB, lexical_index_path=LEXICAL_INDEX_PATH,
+               centroid_index_path=CENTROID_INDEX_PATH):
+    manifest = load_manifest(manifest_path)
+    if manifest["files"] and collection.count() == 0:
+        # 集合已被重建但清單仍存在，清單已無效
+        print("集合為空但索引清單存在，將重新嵌入所有檔案")
+        manifest = {"files": {}, "failed": {}}
+
+    changes = diff_manifest(manifest, pdf_dir)
+    print(f"新增 {len(changes['added'])} 個、修改 {len(changes['modified'])} 個、"
+          f"刪除 {len(changes['removed'])} 個、未變更 {len(changes['unchanged'])} 個檔案")
+    if changes["failed"]:
+        print(f"略過 {len(changes['failed'])} 個先前讀取失敗且未變更的檔案：{', '.join(changes['failed'])}")
+
+    stale_ids = []
+    for file_name in changes["removed"] + changes["modified"]:
+        stale_ids.extend(manifest["files"][file_name].get("chunk_ids", []))
+    # 文字索引、中心向量索引與向量索引同步增量更新
+    lexical_index = LexicalIndex(lexical_index_path) if lexical_index_path else None
+    centroid_index = CentroidIndex(centroid_index_path) if centroid_index_path else None
+    if stale_ids:
+        delete_chunks(collection, stale_ids, lexical_index, centroid_index)
+        print(f"已刪除 {len(stale_ids)} 個過期的文本片段")
+    for file_name in changes["removed"]:
+        del manifest["files"][file_name]
+
+    for file_name in changes["unchanged"]:
+        # 更新修改時間，避免下次再計算雜湊
+        manifest["files"][file_name].update(changes["stats"][file_name])
+    # 只保留仍在目錄中且未變更的失敗記錄（內容改變的檔案本次重新嘗試）
+    manifest["failed"] = {file_name: dict(manifest["failed"][file_name], **changes["stats"][file_name])
+                          for file_name in changes["failed"]}
+
+    pending = changes["added"] + changes["modified"]
+    owns_writer = writer is None
+    if owns_writer:
+        writer = EmbeddingWriter(collection, load_sentence_model())
+    attach_lexical = writer.lexical_index is None
+    if attach_lexical:
+        writer.lexical_index = lexical_index
+    attach_centroid = writer.centroid_index is None
+    if attach_centroid:
+        writer.centroid_index = centroid_index
+    cache = ExtractedTextCache(cache_path) if cache_path else None
+    try:
+        file_hashes = {f: changes["stats"][f]["hash"] for f in pending}
+        chunk_ids_by_file, failures = process_files([os.path.join(pdf_dir, f) for f in pending], writer, workers,
+                                                    cache=cache, file_hashes=file_hashes)
+        if cache is not None:
+            evicted = cache.enforce_limit(cache_max_mb * 1024 * 1024)
+            if evicted:
+                print(f"解析快取超過 {cache_max_mb} MB，已移除 {evicted} 個最久未使用的檔案")
+    finally:
+        if cache is not None:
+            cache.close()
+        if attach_lexical:
+            writer.lexical_index = None
+        if attach_centroid:
+            writer.centroid_index = None
+    if owns_writer:
+        writer.close()
+    if lexical_index is not None:
+        try:
+            lexical_index.commit()
+            if lexical_index.count() != collection.count():
+                rebuild_lexical_index(collection, lexical_index)
+        finally:
+            lexical_index.close()
+    if centroid_index is not None:
+        try:
+            if centroid_index.count() != collection.count() or centroid_index.stale_count():
+                rebuild_centroid_index(collection, centroid_index)
+        finally:
+            centroid_index.close()
+    for file_name in pending:
+        if file_name in failures:
+            # 讀取失敗的檔案記錄在 failed，內容未變時下次不再重新解析，也不會被當成新增的檔案
+            manifest["files"].pop(file_name, None)
+            manifest["failed"][file_name] = dict(changes["stats"][file_name], error=failures[file_name])
+        else:
+            manifest["files"][file_name] = dict(changes["stats"][file_name], chunk_ids=chunk_ids_by_file[file_name])
+
+    if changes["redaction_stale"]:
+        print("guardrail 模型或規則已變更，重新計算去敏化內容")
+        refresh_redactions(collection)
+
+    manifest["chunk_params"] = current_chunk_params()
+    manifest["guardrail_version"] = load_guardrails().guardrail_fingerprint()
+    save_manifest(manifest, manifest_path)
+    return changes
+
+# 清理解析快取：移除清單中已不存在的檔案內容，並套用大小上限
+def clean_text_cache(cache_path=TEXT_CACHE_PATH, manifest_path=MANIFEST_PATH, cache_max_mb=TEXT_CACHE_MAX_MB):
+    cache = ExtractedTextCache(cache_path)
+    try:
+        keep_hashes = [entry.get("hash") for entry in load_manifest(manifest_path)["files"].values()]
+        pruned = cache.prune(keep_hashes)
+        evicted = cache.enforce_limit(cache_max_mb * 1024 * 1024)
+        print(f"解析快取已清理：移除 {pruned} 個不再使用、{evicted} 個超過大小上限的檔案，"
+              f"目前 {cache.total_bytes() / 1024 / 1024:.1f} MB")
+    finally:
+        cache.close()
 
 def main():
+    parser = argparse.ArgumentParser(description="將 KM_pool 中的 PDF/DOCX 嵌入至向量資料庫")
+    parser.add_argument("--rebuild", action="store_true", help="刪除整個 ChromaDB 後完整重建")
+    parser.add_argument("--backend", choices=VECTOR_BACKENDS, default=VECTOR_BACKEND, help="向量資料庫後端")
+    parser.add_argument("--workers", type=int, default=EXTRACT_WORKERS, help="平行解析檔案的行程數")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="每次編碼的 chunk 數")
+    parser.add_argument("--encode-workers", type=int, default=ENCODE_WORKERS, help="編碼用的行程數，大於 1 時啟用多行程池")
+    parser.add_argument("--no-cache", action="store_true", help="不使用解析文字快取")
+    parser.add_argument("--cache-max-mb", type=int, default=TEXT_CACHE_MAX_MB, help="解析文字快取大小上限 (MB)")
+    parser.add_argument("--clean-cache", action="store_true", help="清理解析文字快取後結束")
+    args = parser.parse_args()
+    manifest_path = manifest_path_for(args.backend)
+
+    if args.clean_cache:
+        clean_text_cache(TEXT_CACHE_PATH, manifest_path, args.cache_max_mb)
+        return
+
     # 檢查路徑
     if not os.path.exists(MODEL_PATH):
         raise FileNotFoundError(f"嵌入模型路徑 {MODEL_PATH} 不存在")
     if not os.path.exists(PDF_DIR):
         raise FileNotFoundError(f"PDF/DOCX 目錄 {PDF_DIR} 不存在")
 
-    # 清空並重建 Chroma 路徑
-    if os.path.exists(CHROMA_PATH):
+    # 僅在指定 --rebuild 時清空並重建 Chroma 路徑
+    if args.rebuild and os.path.exists(CHROMA_PATH):
         shutil.rmtree(CHROMA_PATH)
         print(f"已刪除舊的 ChromaDB 資料夾：{CHROMA_PATH}")
-    os.makedirs(CHROMA_PATH)
-    print(f"已創建新的 ChromaDB 資料夾：{CHROMA_PATH}")
+    os.makedirs(CHROMA_PATH, exist_ok=True)
 
-    # 初始化 Chroma 客戶端
-    client = chromadb.PersistentClient(path=CHROMA_PATH)
-    collection_name = "pdf_docx_collection"
-
-    # 創建新集合
+    # 載入或創建集合（Chroma 或記憶體映射的 flat 索引）
     embedding_function = init_embedding_function()
-    collection = client.create_collection(
-        name=collection_name,
-        embedding_function=embedding_function
-    )
-    print(f"已創建新的集合：{collection_name}")
+    collection = open_vector_store(args.backend, CHROMA_PATH, COLLECTION_NAME, embedding_function)
+    print(f"已載入集合：{COLLECTION_NAME}（{args.backend}）")
 
-    # 處理 PDF 和 DOCX 並建立向量資料庫
-    process_pdfs_and_docx(PDF_DIR, collection)
+    # 增量處理 PDF 和 DOCX 並更新向量資料庫
+    writer = EmbeddingWriter(collection, load_sentence_model(embedding_function),
+                             batch_size=args.batch_size, encode_workers=args.encode_workers)
+    try:
+        sync_index(collection, PDF_DIR, manifest_path, workers=args.workers, writer=writer,
+                   cache_path=None if args.no_cache else TEXT_CACHE_PATH, cache_max_mb=args.cache_max_mb,
+                   lexical_index_path=lexical_index_path_for(args.backend),
+                   centroid_index_path=centroid_index_path_for(args.backend))
+    finally:
+        writer.close()
 
     # 檢查集合狀態
-    print(f"集合 {collection_name} 現有 {collection.count()} 個嵌入向量")
-    print(f"向量資料庫已重建並儲存至 {CHROMA_PATH}")
+    print(f"集合 {COLLECTION_NAME} 現有 {collection.count()} 個嵌入向量")
+    print(f"向量資料庫已更新並儲存至 {CHROMA_PATH}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
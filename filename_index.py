@@ -0,0 +1,117 @@
+import os
+import threading
+import unicodedata
+from collections import deque
+
+# 設置參數
+SUPPORTED_EXTENSIONS = (".pdf", ".docx")
+
+# 正規化檔名與查詢：NFKC（全形轉半形）後轉小寫
+def normalize_name(text):
+    return unicodedata.normalize("NFKC", text).lower()
+
+# Aho–Corasick 自動機：一次掃描查詢即可找出所有出現的關鍵字
+class AhoCorasick:
+    def __init__(self, keywords):
+        """
+        Args:
+            keywords (dict): 關鍵字 → 對應的值列表（同一個檔名可能有 .pdf 與 .docx 兩個檔案）。
+        """
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        for keyword, values in keywords.items():
+            if not keyword:
+                continue
+            node = 0
+            for char in keyword:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][char] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                node = next_node
+            self.outputs[node].append((len(keyword), values))
+
+        # 以 BFS 建立失敗連結，並把失敗節點的輸出併入，查詢時不必沿著連結回溯
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+                queue.append(child)
+
+    # 產出 (起始位置, 關鍵字長度, 值列表)
+    def iter_matches(self, text):
+        node = 0
+        for end, char in enumerate(text, 1):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for length, values in self.outputs[node]:
+                yield end - length, length, values
+
+# 資料夾檔名索引：只在資料夾修改時間改變時重新列出檔案
+class FilenameIndex:
+    def __init__(self, directory, extensions=SUPPORTED_EXTENSIONS):
+        self.directory = directory
+        self.extensions = extensions
+        self.lock = threading.Lock()
+        self._mtime_ns = None
+        self._files = []
+        self._by_name = {}
+        self._automaton = AhoCorasick({})
+
+    def _refresh(self):
+        try:
+            mtime_ns = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+        if mtime_ns == self._mtime_ns and self._mtime_ns is not None:
+            return
+        files = []
+        if mtime_ns is not None:
+            files = sorted(f for f in os.listdir(self.directory) if f.lower().endswith(self.extensions))
+        base_names = {}
+        for file_name in files:
+            base_names.setdefault(normalize_name(os.path.splitext(file_name)[0]), []).append(file_name)
+        self._files = files
+        self._by_name = {normalize_name(file_name): file_name for file_name in files}
+        self._automaton = AhoCorasick(base_names)
+        self._mtime_ns = mtime_ns
+
+    # 目前資料夾中的檔案（已排序）
+    def files(self):
+        with self.lock:
+            self._refresh()
+            return list(self._files)
+
+    def find_mentions(self, query):
+        """
+        找出查詢中提到的所有檔案（比對不含副檔名的檔名）。
+        Returns:
+            list: 檔名列表，較長（較具體）的檔名在前，同長度時依在查詢中出現的位置排序。
+        """
+        with self.lock:
+            self._refresh()
+            automaton = self._automaton
+        matches = {}
+        for start, length, values in automaton.iter_matches(normalize_name(query)):
+            for file_name in values:
+                if file_name not in matches:
+                    matches[file_name] = (-length, start)
+        return sorted(matches, key=matches.get)
+
+    # 找出查詢最可能指定的檔案：先比對檔名出現在查詢中，再比對查詢是否就是完整檔名
+    def match(self, query):
+        mentions = self.find_mentions(query)
+        if mentions:
+            return mentions[0]
+        with self.lock:
+            return self._by_name.get(normalize_name(query.strip()))
@@ -0,0 +1,286 @@
+import os
+import re
+import math
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from vector_store import file_name_mask
+
+# 設置參數
+LEXICAL_INDEX_PATH = "./chroma_db/lexical_index.sqlite3"  # 放在 chroma_db 內，--rebuild 時一併刪除
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60  # reciprocal rank fusion 的平滑常數
+LEXICAL_FLUSH_POSTINGS = 2000000  # 記憶體中累積這麼多筆 posting 就寫入 SQLite
+COMPACT_STALE_RATIO = 0.2  # 已刪除文件的 posting 超過此比例時重寫索引
+
+_CJK_RANGES = "\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_TOKEN_PATTERN = re.compile(rf"[{_CJK_RANGES}]+|[a-z0-9]+")
+_MAX_TF = 65535
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    doc_num INTEGER PRIMARY KEY,
+    chunk_id TEXT UNIQUE NOT NULL,
+    file_name TEXT,
+    length INTEGER NOT NULL,
+    unique_terms INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS terms (
+    term TEXT PRIMARY KEY,
+    doc_nums BLOB NOT NULL,
+    tfs BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# 斷詞：中日韓文字取相鄰兩字（單字時取單字），英數字取整個單字
+def tokenize(text):
+    tokens = []
+    for run in _TOKEN_PATTERN.findall(unicodedata.normalize("NFKC", text).lower()):
+        if run[0].isascii() or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+# 合併多個排序結果：每個結果依名次給 1 / (rrf_k + 名次) 分，加總後排序
+# with_scores 為 True 時回傳 [(項目, 分數)]
+def reciprocal_rank_fusion(rankings, rrf_k=RRF_K, with_scores=False):
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, 1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (rrf_k + rank)
+    ordered = sorted(scores, key=scores.get, reverse=True)
+    return [(item, scores[item]) for item in ordered] if with_scores else ordered
+
+# BM25 倒排索引
+class LexicalIndex:
+    """
+    每個詞的 posting 以兩個定長陣列（uint32 文件編號、uint16 詞頻）存成 BLOB。
+    文件編號只增不減，新文件的 posting 直接接在陣列尾端；刪除的文件只從 docs 表移除，
+    其 posting 在查詢時略過，累積到 COMPACT_STALE_RATIO 時由 compact 重寫。
+    新增的 posting 先累積在記憶體中，commit 時才寫入，commit 前查詢不到。
+    """
+    def __init__(self, path=LEXICAL_INDEX_PATH, k1=BM25_K1, b=BM25_B):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        self.lock = threading.Lock()
+        self._pending = {}  # term -> (array 文件編號, array 詞頻)
+        self._pending_postings = 0
+        self._next_doc = (self.conn.execute("SELECT MAX(doc_num) FROM docs").fetchone()[0] or 0) + 1
+        self._next_doc = max(self._next_doc, self._meta("next_doc"))
+        self._data_version = None
+        self._lengths = None
+        self._file_nums = None
+        self._file_ids = {}
+
+    def _meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _add_meta(self, key, delta):
+        self.conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) "
+                          "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value", (key, delta))
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    # 新增（或取代同 id 的）文件
+    def add(self, ids, documents, metadatas):
+        with self.lock:
+            self._delete(ids)
+            pending = self._pending
+            rows = []
+            for chunk_id, document, metadata in zip(ids, documents, metadatas):
+                doc_num = self._next_doc
+                self._next_doc += 1
+                term_counts = Counter(tokenize(document))
+                for term, tf in term_counts.items():
+                    postings = pending.get(term)
+                    if postings is None:
+                        postings = pending[term] = (array("I"), array("H"))
+                    postings[0].append(doc_num)
+                    postings[1].append(tf if tf < _MAX_TF else _MAX_TF)
+                self._pending_postings += len(term_counts)
+                rows.append((doc_num, chunk_id, (metadata or {}).get("file_name"),
+                             sum(term_counts.values()), len(term_counts)))
+            with self.conn:
+                self.conn.executemany("INSERT INTO docs (doc_num, chunk_id, file_name, length, unique_terms) "
+                                      "VALUES (?, ?, ?, ?, ?)", rows)
+                self._set_meta("next_doc", self._next_doc)
+            self._lengths = None
+            if self._pending_postings >= LEXICAL_FLUSH_POSTINGS:
+                self._flush()
+
+    def delete(self, ids):
+        with self.lock:
+            self._delete(ids)
+
+    def _delete(self, ids):
+        removed = 0
+        with self.conn:
+            for start in range(0, len(ids), 500):
+                batch = list(ids[start:start + 500])
+                placeholders = ",".join("?" * len(batch))
+                removed += self.conn.execute(f"SELECT COALESCE(SUM(unique_terms), 0) FROM docs WHERE chunk_id IN ({placeholders})",
+                                             batch).fetchone()[0]
+                self.conn.execute(f"DELETE FROM docs WHERE chunk_id IN ({placeholders})", batch)
+            if removed:
+                self._add_meta("stale_postings", removed)
+        self._lengths = None  # 自己的寫入不會改變 data_version，需自行標記重新載入
+
+    # 把記憶體中的 posting 接到 SQLite 中既有陣列的尾端
+    def _flush(self):
+        if not self._pending:
+            return
+        terms = list(self._pending)
+        with self.conn:
+            existing = {}
+            for start in range(0, len(terms), 900):
+                batch = terms[start:start + 900]
+                placeholders = ",".join("?" * len(batch))
+                for term, doc_blob, tf_blob in self.conn.execute(
+                        f"SELECT term, doc_nums, tfs FROM terms WHERE term IN ({placeholders})", batch):
+                    existing[term] = (doc_blob, tf_blob)
+            rows = []
+            # 依詞排序後寫入，B-tree 依序插入比隨機插入快得多
+            for term in sorted(terms):
+                doc_nums, tfs = self._pending[term]
+                doc_blob, tf_blob = existing.get(term, (b"", b""))
+                rows.append((term, doc_blob + doc_nums.tobytes(), tf_blob + tfs.tobytes()))
+            self.conn.executemany("INSERT OR REPLACE INTO terms (term, doc_nums, tfs) VALUES (?, ?, ?)", rows)
+            self._add_meta("postings", self._pending_postings)
+        self._pending = {}
+        self._pending_postings = 0
+        self._lengths = None
+
+    def commit(self):
+        with self.lock:
+            self._flush()
+            total = self._meta("postings")
+            if total and self._meta("stale_postings") / total > COMPACT_STALE_RATIO:
+                self._compact()
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM docs")
+            self.conn.execute("DELETE FROM terms")
+            self.conn.execute("DELETE FROM meta WHERE key != 'next_doc'")
+            self._pending = {}
+            self._pending_postings = 0
+            self._lengths = None
+
+    # 移除已刪除文件的 posting
+    def _compact(self):
+        lengths = self._load_lengths()[0]
+        total = 0
+        with self.conn:
+            for term, doc_blob, tf_blob in self.conn.execute("SELECT term, doc_nums, tfs FROM terms").fetchall():
+                doc_nums = np.frombuffer(doc_blob, dtype=np.uint32)
+                tfs = np.frombuffer(tf_blob, dtype=np.uint16)
+                live = lengths[doc_nums] > 0
+                if live.all():
+                    total += len(doc_nums)
+                elif live.any():
+                    total += int(live.sum())
+                    self.conn.execute("UPDATE terms SET doc_nums = ?, tfs = ? WHERE term = ?",
+                                      (doc_nums[live].tobytes(), tfs[live].tobytes(), term))
+                else:
+                    self.conn.execute("DELETE FROM terms WHERE term = ?", (term,))
+            self.conn.execute("DELETE FROM meta WHERE key IN ('postings', 'stale_postings')")
+            self._add_meta("postings", total)
+        self.conn.execute("VACUUM")
+        print(f"文字索引已壓縮，目前 {total} 筆 posting")
+
+    def _load_lengths(self):
+        lengths = np.zeros(self._next_doc + 1, dtype=np.float32)
+        file_nums = np.full(self._next_doc + 1, -1, dtype=np.int32)
+        file_ids = {}
+        for doc_num, file_name, length in self.conn.execute("SELECT doc_num, file_name, length FROM docs"):
+            lengths[doc_num] = max(length, 1)
+            file_nums[doc_num] = file_ids.setdefault(file_name, len(file_ids))
+        return lengths, file_nums, file_ids
+
+    # 其他行程（例如 embedding.py）更新索引後，重新載入文件長度與檔名
+    def _refresh(self):
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._lengths is None or data_version != self._data_version:
+            self._next_doc = max(self._next_doc, self._meta("next_doc"))
+            self._lengths, self._file_nums, self._file_ids = self._load_lengths()
+            self._data_version = data_version
+
+    def _where_mask(self, where):
+        return file_name_mask(where, self._file_nums, self._file_ids)
+
+    def search(self, query, n, where=None):
+        """
+        以 BM25 搜尋。
+        Args:
+            query (str): 查詢文字。
+            n (int): 回傳筆數。
+            where (dict): 與 Chroma 相同格式的 file_name 條件（等於、$ne、$in）。
+        Returns:
+            list: [(chunk id, 分數)]，依分數由高到低排序。
+        """
+        terms = set(tokenize(query))
+        if not terms or n <= 0:
+            return []
+        with self.lock:
+            self._refresh()
+            lengths = self._lengths
+            live_count = int(np.count_nonzero(lengths))
+            if not live_count:
+                return []
+            average_length = float(lengths.sum()) / live_count
+            scores = np.zeros(len(lengths), dtype=np.float32)
+            for term in terms:
+                row = self.conn.execute("SELECT doc_nums, tfs FROM terms WHERE term = ?", (term,)).fetchone()
+                if row is None:
+                    continue
+                doc_nums = np.frombuffer(row[0], dtype=np.uint32)
+                doc_nums = doc_nums[doc_nums < len(lengths)]
+                tfs = np.frombuffer(row[1], dtype=np.uint16)[:len(doc_nums)].astype(np.float32)
+                doc_lengths = lengths[doc_nums]
+                live = doc_lengths > 0
+                doc_nums, tfs, doc_lengths = doc_nums[live], tfs[live], doc_lengths[live]
+                if not len(doc_nums):
+                    continue
+                idf = math.log(1.0 + (live_count - len(doc_nums) + 0.5) / (len(doc_nums) + 0.5))
+                norm = self.k1 * (1.0 - self.b + self.b * doc_lengths / average_length)
+                scores[doc_nums] += idf * tfs * (self.k1 + 1.0) / (tfs + norm)
+            mask = self._where_mask(where)
+            if mask is not None:
+                scores[~mask] = 0.0
+            candidates = np.flatnonzero(scores > 0)
+            if len(candidates) > n:
+                candidates = candidates[np.argpartition(-scores[candidates], n - 1)[:n]]
+            candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+            if not len(candidates):
+                return []
+            placeholders = ",".join("?" * len(candidates))
+            chunk_ids = dict(self.conn.execute(f"SELECT doc_num, chunk_id FROM docs WHERE doc_num IN ({placeholders})",
+                                               [int(doc_num) for doc_num in candidates]))
+        return [(chunk_ids[int(doc_num)], float(scores[doc_num])) for doc_num in candidates if int(doc_num) in chunk_ids]
+
+    def close(self):
+        with self.lock:
+            self._flush()
+        self.conn.close()
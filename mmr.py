@@ -0,0 +1,44 @@
+import numpy as np
+
+# 設置參數
+MMR_LAMBDA = 0.5  # 1.0 只看相關度（等同一般 top-k），越小越重視與已選結果的差異
+MMR_FETCH_K = 20  # 從向量資料庫取出、供 MMR 挑選的候選數
+
+# 將向量單位化（零向量保持為零）
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def maximal_marginal_relevance(query_embedding, embeddings, k, lambda_mult=MMR_LAMBDA, relevance=None):
+    """
+    以 maximal marginal relevance 從候選中挑出 k 個：每一步選 lambda * 相關度 - (1 - lambda) * 與已選結果的最大相似度最高者。
+    只使用候選既有的向量，不需要再呼叫模型；每一步只計算新選結果與所有候選的相似度。
+    Args:
+        query_embedding (list): 查詢向量。
+        embeddings (list): 候選的向量。
+        k (int): 挑選的數量。
+        lambda_mult (float): 相關度與多樣性的權衡，介於 0 與 1。
+        relevance (list): 各候選的相關度（例如混合檢索的融合分數）；未提供時使用與查詢向量的餘弦相似度。
+    Returns:
+        list: 被選中候選的索引，依選取順序排列。
+    """
+    if k <= 0 or len(embeddings) == 0:
+        return []
+    vectors = normalize_rows(embeddings)
+    if relevance is None:
+        relevance = vectors @ normalize_rows(query_embedding)
+    else:
+        relevance = np.asarray(relevance, dtype=np.float32)
+    k = min(k, len(vectors))
+    best = int(np.argmax(relevance))
+    selected = [best]
+    max_similarity = vectors @ vectors[best]
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * max_similarity
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        max_similarity = np.maximum(max_similarity, vectors @ vectors[best])
+    return selected
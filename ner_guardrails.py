@@ -1,66 +1,176 @@
+import os
 import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
 from transformers import BertTokenizerFast, AutoModelForTokenClassification
 from transformers import pipeline
+from onnx_inference import OnnxTokenClassificationPipeline, use_onnx
 
 # 定義本地模型路徑
 # NER模型
 local_model_path = "./bert-base-chinese-ner"
 
+# 需要去敏化的實體類別
+SENSITIVE_ENTITY_GROUPS = ['PERSON', 'ORG', 'PHONE', 'EMAIL', 'NORP']
+# 修改正則表達式或去敏化規則時遞增，使 ingest 時預先計算的去敏化結果失效
+GUARDRAIL_VERSION = 2
+# 批次 NER 參數
+NER_BATCH_SIZE = 16  # 每次送入模型的視窗數
+NER_MAX_TOKENS = 510  # 每個視窗的 token 上限（BERT 的 512 扣除 [CLS]、[SEP]）
+NER_WINDOW_OVERLAP = 64  # 長文本相鄰視窗重疊的 token 數，避免實體被視窗邊界切斷
+# 去敏化模式："ner" 使用 NER 模型加正則表達式；"regex" 只用正則表達式（快速模式，不載入 BERT）
+REDACTION_MODE = "ner"
+
+# 預先編譯的正則表達式
+PHONE_PATTERN = re.compile(r"(?:\+?886-?|0)?9\d{2}-?\d{3}-?\d{3}|(?:\+?886-?|0)?\d{2}-?\d{4}-?\d{4}|\d{2}-\d{7,8}|\d{4}-\d{7}")
+EMAIL_PATTERN = re.compile(r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}")
+# 合併成單一樣式，只需掃描文本一次；電子郵件放前面，使同一位置優先匹配較長的電子郵件
+REGEX_ENTITY_PATTERN = re.compile(f"(?P<EMAIL>{EMAIL_PATTERN.pattern})|(?P<PHONE>{PHONE_PATTERN.pattern})")
+REGEX_ENTITY_SCORES = {'PHONE': 0.95, 'EMAIL': 0.99}
+# 實體快取參數
+ENTITY_CACHE_MAX_ENTRIES = 10000  # 記憶體快取與磁碟快取各自的最大筆數
+ENTITY_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 記憶體快取與磁碟快取各自的最大位元組數（以序列化後的實體估計）
+ENTITY_CACHE_PATH = None  # 設定路徑（例如 "./ner_cache.sqlite3"）即啟用 SQLite 磁碟快取
+# 串流去敏化時保留在緩衝區、暫不輸出的字元數（讓跨片段的實體能完整辨識）
+STREAM_HOLDBACK_CHARS = 32
+# 可能構成電話或電子郵件的字元，串流輸出不會在這類字元組成的字串中間切開
+PII_TOKEN_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789@._%+-")
+
 # 載入模型和 tokenizer
-try:
-    tokenizer = BertTokenizerFast.from_pretrained(local_model_path)
-    model = AutoModelForTokenClassification.from_pretrained(local_model_path)
-    # 創建 NER 管道 (這部分在模組載入時執行一次)
-    ner_pipeline = pipeline("ner", model=model, tokenizer=tokenizer, aggregation_strategy="simple")
-except Exception as e:
-    print(f"載入模型或 tokenizer 時發生錯誤: {e}")
-    ner_pipeline = None
+tokenizer = None
+ner_pipeline = None
+if REDACTION_MODE != "regex":
+    try:
+        if use_onnx(local_model_path):
+            # ONNX Runtime 推論，輸出格式與下面的 NER 管道相同
+            ner_pipeline = OnnxTokenClassificationPipeline(local_model_path)
+            tokenizer = ner_pipeline.tokenizer
+        else:
+            tokenizer = BertTokenizerFast.from_pretrained(local_model_path)
+            model = AutoModelForTokenClassification.from_pretrained(local_model_path)
+            # 創建 NER 管道 (這部分在模組載入時執行一次)
+            ner_pipeline = pipeline("ner", model=model, tokenizer=tokenizer, aggregation_strategy="simple")
+    except Exception as e:
+        print(f"載入模型或 tokenizer 時發生錯誤: {e}")
+        ner_pipeline = None
 
-def extract_entities_with_regex(text):
+def _split_windows(text):
     """
-    使用 NER 模型和正則表達式提取文本中的實體 (包含組織、電話號碼、電子郵件)。
+    依 tokenizer 的字元位移把長文本切成不超過 NER_MAX_TOKENS 個 token 的視窗。
+    Args:
+        text (str): 原始文本。
+    Returns:
+        list: 每個視窗在原文中的 (起始位置, 結束位置)。
+    """
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    if len(offsets) <= NER_MAX_TOKENS:
+        return [(0, len(text))]
+    windows = []
+    step = NER_MAX_TOKENS - NER_WINDOW_OVERLAP
+    for first in range(0, len(offsets), step):
+        last = min(first + NER_MAX_TOKENS, len(offsets))
+        windows.append((offsets[first][0], offsets[last - 1][1]))
+        if last == len(offsets):
+            break
+    return windows
+
+def _regex_entities(text):
+    """
+    使用預先編譯的正則表達式單次掃描文本，提取電話號碼與電子郵件。
     Args:
         text (str): 需要提取實體的文本。
     Returns:
-        list: 包含識別出的實體列表，每個實體是一個字典。
+        list: 實體列表，格式與 NER 管道的輸出相同，位移為每次出現的實際位置。
     """
     ner_results = []
-    if ner_pipeline:
-        ner_results.extend(ner_pipeline(text))
-
-    # 使用正則表達式尋找電話號碼
-    phone_pattern = r"(?:\+?886-?|0)?9\d{2}-?\d{3}-?\d{3}|(?:\+?886-?|0)?\d{2}-?\d{4}-?\d{4}|\d{2}-\d{7,8}|\d{4}-\d{7}"
-    phones = re.findall(phone_pattern, text)
-    for phone in phones:
-        start_index = text.find(phone)
-        end_index = start_index + len(phone)
+    for match in REGEX_ENTITY_PATTERN.finditer(text):
+        group = match.lastgroup
         ner_results.append({
-            'entity': 'PHONE',
-            'score': 0.95,
+            'entity': group,
+            'score': REGEX_ENTITY_SCORES[group],
             'index': -1,
-            'word': phone,
-            'start': start_index,
-            'end': end_index,
-            'entity_group': 'PHONE'
+            'word': match.group(),
+            'start': match.start(),
+            'end': match.end(),
+            'entity_group': group
         })
+    return ner_results
 
-    # 使用正則表達式尋找電子郵件地址
-    email_pattern = r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}"
-    emails = re.findall(email_pattern, text)
-    for email in emails:
-        start_index = text.find(email)
-        end_index = start_index + len(email)
-        ner_results.append({
-            'entity': 'EMAIL',
-            'score': 0.99,
-            'index': -1,
-            'word': email,
-            'start': start_index,
-            'end': end_index,
-            'entity_group': 'EMAIL'
-        })
+def _extract_entities_uncached(texts, batch_size, use_ner):
+    """
+    批次提取多段文本中的實體。超過 BERT 長度上限的文本以重疊視窗切開，
+    所有視窗一起送入 NER 管道，實體位移再換算回原文。
+    Args:
+        texts (list): 需要提取實體的文本列表。
+        batch_size (int): 每次送入模型的視窗數。
+        use_ner (bool): 是否使用 NER 模型。
+    Returns:
+        list: 與 texts 等長，每個元素是該文本的實體列表。
+    """
+    results = [[] for _ in texts]
+    if use_ner and ner_pipeline:
+        segments = []
+        inputs = []
+        for idx, text in enumerate(texts):
+            if not text:
+                continue
+            windows = _split_windows(text)
+            for w, (start, end) in enumerate(windows):
+                # 重疊區以中點為界，各視窗只保留起點落在自己負責範圍內的實體，避免重複
+                own_start = 0 if w == 0 else (start + windows[w - 1][1]) // 2
+                own_end = len(text) if w == len(windows) - 1 else (windows[w + 1][0] + end) // 2
+                segments.append((idx, start, own_start, own_end))
+                inputs.append(text[start:end])
+        if inputs:
+            outputs = ner_pipeline(inputs, batch_size=batch_size)
+            for (idx, offset, own_start, own_end), entities in zip(segments, outputs):
+                for entity in entities:
+                    # 轉為 Python 原生型別，方便快取序列化
+                    entity = dict(entity, score=float(entity['score']),
+                                  start=int(entity['start']) + offset, end=int(entity['end']) + offset)
+                    if own_start <= entity['start'] < own_end:
+                        results[idx].append(entity)
 
-    return ner_results
+    for idx, text in enumerate(texts):
+        results[idx].extend(_regex_entities(text))
+    return results
+
+def extract_entities_batch(texts, batch_size=NER_BATCH_SIZE, use_ner=None):
+    """
+    批次提取多段文本中的實體，先查詢實體快取，只有未命中的文本才送入 NER 管道。
+    Args:
+        texts (list): 需要提取實體的文本列表。
+        batch_size (int): 每次送入模型的視窗數。
+        use_ner (bool): 是否使用 NER 模型，None 時依 REDACTION_MODE 決定。
+    Returns:
+        list: 與 texts 等長，每個元素是該文本的實體列表。
+    """
+    if use_ner is None:
+        use_ner = REDACTION_MODE != "regex"
+    keys = [entity_cache.make_key(text, use_ner) for text in texts]
+    results = [entity_cache.get(key) for key in keys]
+    missing = [idx for idx, entities in enumerate(results) if entities is None]
+    if missing:
+        computed = _extract_entities_uncached([texts[idx] for idx in missing], batch_size, use_ner)
+        for idx, entities in zip(missing, computed):
+            entity_cache.put(keys[idx], entities)
+            results[idx] = entities
+    return [[dict(entity) for entity in entities] for entities in results]
+
+def extract_entities_with_regex(text, use_ner=None):
+    """
+    使用 NER 模型和正則表達式提取文本中的實體 (包含組織、電話號碼、電子郵件)。
+    Args:
+        text (str): 需要提取實體的文本。
+        use_ner (bool): 是否使用 NER 模型，None 時依 REDACTION_MODE 決定。
+    Returns:
+        list: 包含識別出的實體列表，每個實體是一個字典。
+    """
+    return extract_entities_batch([text], use_ner=use_ner)[0]
 
 def desensitize_text_with_entities(text, ner_results):
     """
@@ -69,14 +179,269 @@ def desensitize_text_with_entities(text, ner_results):
         text (str): 需要去敏化的原始文本。
         ner_results (list): NER 模型識別出的實體列表。
     Returns:
-        str: 去敏化後的文本，敏感資訊已被 '[REDACTED]' 替換。
-    """
-    desensitized_text = text
-    # 從後向前替換，防止位置偏移
-    for entity in sorted(ner_results, key=lambda x: x['start'], reverse=True):
-        if entity['entity_group'] in ['PERSON', 'ORG', 'PHONE', 'EMAIL', 'NORP']:
-            desensitized_text = desensitized_text[:entity['start']] + '[REDACTED]' + desensitized_text[entity['end']:]
-    return desensitized_text
+        str: 去敏化後的文本，敏感資訊已被 '[REDACTED]' 替換，重疊的實體合併為一個。
+    """
+    spans = sorted((entity['start'], entity['end']) for entity in ner_results
+                   if entity['entity_group'] in SENSITIVE_ENTITY_GROUPS)
+    parts = []
+    cursor = 0
+    span_start = span_end = None
+    for start, end in spans:
+        if span_end is not None and start < span_end:
+            # 與目前的範圍重疊（例如 NER 與正則同時命中），延伸範圍
+            span_end = max(span_end, end)
+            continue
+        if span_end is not None:
+            parts.append(text[cursor:span_start])
+            parts.append('[REDACTED]')
+            cursor = span_end
+        span_start, span_end = start, end
+    if span_end is not None:
+        parts.append(text[cursor:span_start])
+        parts.append('[REDACTED]')
+        cursor = span_end
+    parts.append(text[cursor:])
+    return ''.join(parts)
+
+def redact_text(text, use_ner=None):
+    """
+    提取實體並去敏化文本。
+    Args:
+        text (str): 需要去敏化的原始文本。
+        use_ner (bool): 是否使用 NER 模型，False 時只用正則表達式（快速模式）。
+    Returns:
+        str: 去敏化後的文本。
+    """
+    return desensitize_text_with_entities(text, extract_entities_with_regex(text, use_ner))
+
+def redact_texts(texts, batch_size=NER_BATCH_SIZE, use_ner=None):
+    """
+    批次提取實體並去敏化多段文本。
+    Args:
+        texts (list): 需要去敏化的原始文本列表。
+        batch_size (int): 每次送入模型的視窗數。
+        use_ner (bool): 是否使用 NER 模型，False 時只用正則表達式（快速模式）。
+    Returns:
+        list: 去敏化後的文本列表。
+    """
+    return [desensitize_text_with_entities(text, entities)
+            for text, entities in zip(texts, extract_entities_batch(texts, batch_size, use_ner))]
+
+_fingerprint = None
+
+def guardrail_fingerprint():
+    """
+    計算目前 guardrail 設定的指紋 (模型檔案大小與修改時間、實體類別、規則版本)。
+    ingest 時與去敏化結果一起儲存，指紋不同代表結果已過期需要重新計算。
+    Returns:
+        str: 16 字元的十六進位指紋。
+    """
+    global _fingerprint
+    if _fingerprint is None:
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            "version": GUARDRAIL_VERSION,
+            "entities": SENSITIVE_ENTITY_GROUPS,
+            "ner_loaded": ner_pipeline is not None,
+            "inference": getattr(ner_pipeline, "backend", "torch"),
+            "mode": REDACTION_MODE,
+        }, sort_keys=True).encode("utf-8"))
+        if os.path.isdir(local_model_path):
+            for name in sorted(os.listdir(local_model_path)):
+                file_stat = os.stat(os.path.join(local_model_path, name))
+                digest.update(f"{name}:{file_stat.st_size}:{file_stat.st_mtime_ns}".encode("utf-8"))
+        _fingerprint = digest.hexdigest()[:16]
+    return _fingerprint
+
+class StreamingRedactor:
+    """
+    串流回答的增量去敏化：累積收到的片段，只輸出距離結尾超過 holdback 的部分，
+    且切點不會落在已辨識的實體或英數字串中間，避免部分個資在片段邊界外洩。
+    """
+    def __init__(self, holdback=STREAM_HOLDBACK_CHARS, use_ner=None):
+        self.holdback = holdback
+        self.use_ner = use_ner
+        self.buffer = ""
+
+    def feed(self, text):
+        """
+        加入新片段並回傳可以安全輸出的去敏化文字（可能為空字串）。
+        """
+        self.buffer += text
+        if len(self.buffer) <= self.holdback:
+            return ""
+        # 每個片段都會重新分析整個緩衝區，結果不會再被查詢，不寫入實體快取（只有 flush 的剩餘文字經過快取）
+        use_ner = self.use_ner if self.use_ner is not None else REDACTION_MODE != "regex"
+        entities = [entity for entity in _extract_entities_uncached([self.buffer], NER_BATCH_SIZE, use_ner)[0]
+                    if entity['entity_group'] in SENSITIVE_ENTITY_GROUPS]
+        cut = len(self.buffer) - self.holdback
+        moved = True
+        while moved and cut > 0:
+            moved = False
+            for entity in entities:
+                if entity['start'] < cut < entity['end']:
+                    cut = entity['start']
+                    moved = True
+            # 尚未完整出現的電話或電子郵件還無法被辨識，退回到該英數字串的開頭
+            while cut > 0 and self.buffer[cut - 1] in PII_TOKEN_CHARS and self.buffer[cut] in PII_TOKEN_CHARS:
+                cut -= 1
+                moved = True
+        if cut <= 0:
+            return ""
+        emitted = desensitize_text_with_entities(self.buffer[:cut], [e for e in entities if e['end'] <= cut])
+        self.buffer = self.buffer[cut:]
+        return emitted
+
+    def flush(self):
+        """
+        串流結束時去敏化並輸出緩衝區中剩餘的文字。
+        """
+        remaining, self.buffer = self.buffer, ""
+        return redact_text(remaining, self.use_ner) if remaining else ""
+
+class EntityCache:
+    """
+    以文本雜湊為鍵的實體快取：記憶體 LRU（依筆數與位元組數淘汰），可選 SQLite 磁碟層。
+    磁碟層套用相同的上限，依 last_used 淘汰最久未使用的資料，淘汰數一併計入 evictions。
+    鍵包含 guardrail 指紋，模型或規則改變後舊結果自然不會命中；磁碟層在開啟時也會刪除舊指紋的資料。
+    """
+    def __init__(self, max_entries=ENTITY_CACHE_MAX_ENTRIES, max_bytes=ENTITY_CACHE_MAX_BYTES, path=ENTITY_CACHE_PATH):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.conn = None
+        self.disk_entries = 0
+        self.disk_bytes = 0
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS entities "
+                              "(key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, value TEXT NOT NULL, created REAL NOT NULL)")
+            with self.conn:
+                # 舊版的資料表沒有 last_used，以建立時間代替
+                columns = {row[1] for row in self.conn.execute("PRAGMA table_info(entities)")}
+                if "last_used" not in columns:
+                    self.conn.execute("ALTER TABLE entities ADD COLUMN last_used REAL NOT NULL DEFAULT 0")
+                    self.conn.execute("UPDATE entities SET last_used = created")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS entities_last_used ON entities (last_used)")
+                self.conn.execute("DELETE FROM entities WHERE fingerprint != ?", (guardrail_fingerprint(),))
+                self._count_disk()
+                self._trim_disk()
+
+    def make_key(self, text, use_ner):
+        return hashlib.sha256(f"{guardrail_fingerprint()}|{int(bool(use_ner))}|{text}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value[0]
+            if self.conn is not None:
+                row = self.conn.execute("SELECT value FROM entities WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    with self.conn:
+                        self.conn.execute("UPDATE entities SET last_used = ? WHERE key = ?", (time.time(), key))
+                    self.disk_hits += 1
+                    entities = json.loads(row[0])
+                    self._remember(key, entities, len(row[0]))
+                    return entities
+            self.misses += 1
+            return None
+
+    def put(self, key, entities):
+        serialized = json.dumps(entities, ensure_ascii=False)
+        with self.lock:
+            self._remember(key, entities, len(serialized))
+            if self.conn is not None:
+                now = time.time()
+                with self.conn:
+                    previous = self.conn.execute("SELECT LENGTH(value) FROM entities WHERE key = ?", (key,)).fetchone()
+                    self.conn.execute("INSERT OR REPLACE INTO entities (key, fingerprint, value, created, last_used) "
+                                      "VALUES (?, ?, ?, ?, ?)", (key, guardrail_fingerprint(), serialized, now, now))
+                    if previous is None:
+                        self.disk_entries += 1
+                    else:
+                        self.disk_bytes -= previous[0]
+                    self.disk_bytes += len(serialized)
+                    self._trim_disk()
+
+    def _count_disk(self):
+        self.disk_entries, self.disk_bytes = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM entities").fetchone()
+
+    # 磁碟層超過上限時刪除最久未使用的資料（其他行程也可能寫入同一個檔案，刪除前重新計算總量）
+    def _trim_disk(self):
+        if self.disk_entries <= self.max_entries and self.disk_bytes <= self.max_bytes:
+            return
+        self._count_disk()
+        evicted = []
+        entries, size = self.disk_entries, self.disk_bytes
+        rows = self.conn.execute("SELECT key, LENGTH(value) FROM entities ORDER BY last_used")
+        while entries > self.max_entries or size > self.max_bytes:
+            row = rows.fetchone()
+            if row is None:
+                break
+            evicted.append((row[0],))
+            entries -= 1
+            size -= row[1]
+        rows.close()
+        self.conn.executemany("DELETE FROM entities WHERE key = ?", evicted)
+        self.disk_entries, self.disk_bytes = entries, size
+        self.evictions += len(evicted)
+
+    def _remember(self, key, entities, size):
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.bytes -= previous[1]
+        self.entries[key] = (entities, size)
+        self.bytes += size
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.execute("DELETE FROM entities")
+                self.disk_entries = self.disk_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "disk_entries": self.disk_entries,
+                "disk_bytes": self.disk_bytes,
+            }
+
+# 模組共用的實體快取
+entity_cache = EntityCache()
+
+def cache_stats():
+    """
+    取得實體快取的命中統計。
+    Returns:
+        dict: hits、disk_hits、misses、hit_rate、evictions、entries、bytes。
+    """
+    return entity_cache.stats()
 
 if __name__ == "__main__":
     # 範例使用
@@ -0,0 +1,328 @@
+import os
+import json
+import inspect
+import argparse
+import numpy as np
+
+# 設置參數
+INFERENCE_BACKEND = "torch"  # 嵌入模型與 NER 模型的推論後端："torch"（PyTorch）或 "onnx"（ONNX Runtime，需先匯出）
+INFERENCE_BACKENDS = ("torch", "onnx")
+ONNX_DIR = "./onnx_models"  # 匯出的 ONNX 模型目錄（每個模型一個子目錄）
+ONNX_QUANTIZED = False  # 使用動態 int8 量化的模型（匯出時需加上 --quantize）
+ONNX_THREADS = 0  # ONNX Runtime 每個模型使用的執行緒數，0 表示依 CPU 核心數
+ONNX_OPSET = 14
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_QUANTIZED_MODEL_FILE = "model.int8.onnx"
+SENTENCE_CONFIG_FILE = "sentence_config.json"  # 嵌入模型的 pooling、正規化與最大長度
+# 匯出後檢查一致性用的範例文本（含人名、組織、電話與電子郵件）
+PARITY_TEXTS = [
+    "王小明是台灣大學資訊工程學系的教授，電話 0912-345-678。",
+    "請聯絡鴻海精密工業的陳美玲經理，電子郵件 meiling.chen@example.com。",
+    "2023 年第三季營收較去年同期成長 12%，主要來自伺服器與電動車零組件。",
+    "本文件說明員工請假流程：請先於系統填寫申請單，再由部門主管林志強核准。",
+    "The quarterly report was reviewed by Alice Wang from the Taipei office.",
+    "中華民國憲法第七條規定，人民無分男女、宗教、種族、階級、黨派，在法律上一律平等。",
+]
+
+# 原始模型目錄對應的 ONNX 目錄，例如 ./bert-base-chinese-ner → ./onnx_models/bert-base-chinese-ner
+def onnx_model_dir(model_path):
+    return os.path.join(ONNX_DIR, os.path.basename(os.path.normpath(model_path)))
+
+def onnx_model_file(model_path, quantized=ONNX_QUANTIZED):
+    return os.path.join(onnx_model_dir(model_path), ONNX_QUANTIZED_MODEL_FILE if quantized else ONNX_MODEL_FILE)
+
+# 設定為 onnx 且模型已匯出時才使用 ONNX Runtime，否則沿用 PyTorch
+def use_onnx(model_path, backend=INFERENCE_BACKEND, quantized=ONNX_QUANTIZED):
+    if backend != "onnx":
+        return False
+    if os.path.exists(onnx_model_file(model_path, quantized)):
+        return True
+    print(f"找不到 {onnx_model_file(model_path, quantized)}，改用 PyTorch；"
+          f"請先執行 python onnx_inference.py{' --quantize' if quantized else ''}")
+    return False
+
+def create_session(path, threads=ONNX_THREADS):
+    import onnxruntime as ort  # 只在使用 ONNX 後端時載入
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        options.intra_op_num_threads = threads
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+# 只傳入模型需要的輸入（tokenizer 另外回傳的 offset_mapping 等欄位不送入模型）
+def _run(session, encoded):
+    feeds = {item.name: np.asarray(encoded[item.name], dtype=np.int64) for item in session.get_inputs()}
+    return session.run(None, feeds)[0]
+
+# 以 ONNX Runtime 執行匯出的 SentenceTransformer 模型
+class OnnxSentenceEncoder:
+    """
+    encode 的參數與回傳值與 SentenceTransformer.encode 相同，可直接交給 EmbeddingWriter 與 Chroma 嵌入函數使用。
+    pooling、正規化與最大長度依匯出時記錄的 sentence_config.json，與原模型的 SentenceTransformer 設定一致。
+    """
+    def __init__(self, model_path, quantized=ONNX_QUANTIZED, threads=ONNX_THREADS):
+        from transformers import AutoTokenizer
+        directory = onnx_model_dir(model_path)
+        self.tokenizer = AutoTokenizer.from_pretrained(directory)
+        with open(os.path.join(directory, SENTENCE_CONFIG_FILE), "r", encoding="utf-8") as f:
+            config = json.load(f)
+        self.pooling = config["pooling"]
+        self.normalize = config["normalize"]
+        self.max_length = config["max_length"]
+        self.session = create_session(onnx_model_file(model_path, quantized), threads)
+        self.backend = "onnx-int8" if quantized else "onnx"
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, convert_to_numpy=True,
+               normalize_embeddings=False, **kwargs):
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+        if not sentences:
+            return np.zeros((0, self.session.get_outputs()[0].shape[-1]), dtype=np.float32)
+        # 依長度排序後分批，減少補齊的 token
+        order = np.argsort([-len(sentence) for sentence in sentences], kind="stable")
+        pooled = []
+        for start in range(0, len(sentences), batch_size):
+            batch = [sentences[index] for index in order[start:start + batch_size]]
+            encoded = self.tokenizer(batch, padding=True, truncation=True, max_length=self.max_length, return_tensors="np")
+            hidden = _run(self.session, encoded)
+            if self.pooling == "cls":
+                pooled.append(hidden[:, 0])
+            else:
+                mask = encoded["attention_mask"][..., None].astype(np.float32)
+                pooled.append((hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+        embeddings = np.empty((len(sentences), pooled[0].shape[1]), dtype=np.float32)
+        embeddings[order] = np.concatenate(pooled)
+        if self.normalize or normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings[0] if single else embeddings
+
+# 以 ONNX Runtime 執行匯出的 token classification 模型
+class OnnxTokenClassificationPipeline:
+    """
+    呼叫方式與輸出與 transformers 的 pipeline("ner", aggregation_strategy="simple") 相同：
+    每段文本回傳實體列表（entity_group、score、word、start、end）。
+    """
+    def __init__(self, model_path, quantized=ONNX_QUANTIZED, threads=ONNX_THREADS):
+        from transformers import AutoConfig, AutoTokenizer
+        directory = onnx_model_dir(model_path)
+        self.tokenizer = AutoTokenizer.from_pretrained(directory)
+        self.id2label = {int(index): label for index, label in AutoConfig.from_pretrained(directory).id2label.items()}
+        self.session = create_session(onnx_model_file(model_path, quantized), threads)
+        self.backend = "onnx-int8" if quantized else "onnx"
+
+    def __call__(self, inputs, batch_size=16):
+        single = isinstance(inputs, str)
+        texts = [inputs] if single else list(inputs)
+        results = [None] * len(texts)
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        for start in range(0, len(texts), batch_size):
+            batch = order[start:start + batch_size]
+            encoded = self.tokenizer([texts[index] for index in batch], padding=True, return_tensors="np",
+                                     return_offsets_mapping=True, return_special_tokens_mask=True)
+            logits = _run(self.session, encoded)
+            for row, index in enumerate(batch):
+                results[index] = self._aggregate(texts[index], logits[row], encoded["input_ids"][row],
+                                                 encoded["offset_mapping"][row], encoded["special_tokens_mask"][row])
+        return results[0] if single else results
+
+    def _aggregate(self, text, logits, input_ids, offsets, special_tokens_mask):
+        """
+        與 transformers 的 "simple" 聚合相同：每個 token 取機率最高的標籤，
+        相同類別且不是 B- 開頭的相鄰 token 併入同一組，最後去掉 O。未知字元的 word 取原文。
+        """
+        shifted = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        scores = shifted / shifted.sum(axis=-1, keepdims=True)
+        groups = []
+        for index, token_id in enumerate(input_ids):
+            if special_tokens_mask[index]:
+                continue
+            label_id = int(scores[index].argmax())
+            start, end = int(offsets[index][0]), int(offsets[index][1])
+            word = text[start:end] if token_id == self.tokenizer.unk_token_id else self.tokenizer.convert_ids_to_tokens(int(token_id))
+            token = {"entity": self.id2label[label_id], "score": float(scores[index, label_id]),
+                     "word": word, "start": start, "end": end}
+            if groups:
+                prefix, tag = _split_label(token["entity"])
+                _, last_tag = _split_label(groups[-1][-1]["entity"])
+                if tag == last_tag and prefix != "B":
+                    groups[-1].append(token)
+                    continue
+            groups.append([token])
+        entities = []
+        for group in groups:
+            entity_group = group[0]["entity"].split("-", 1)[-1]
+            if entity_group == "O":
+                continue
+            entities.append({
+                "entity_group": entity_group,
+                "score": float(np.mean([token["score"] for token in group])),
+                "word": self.tokenizer.convert_tokens_to_string([token["word"] for token in group]),
+                "start": group[0]["start"],
+                "end": group[-1]["end"],
+            })
+        return entities
+
+def _split_label(label):
+    if label.startswith("B-") or label.startswith("I-"):
+        return label[0], label[2:]
+    return "I", label
+
+# 讀取 SentenceTransformer 模型目錄中的 pooling、正規化與最大長度設定
+def _sentence_config(model_path):
+    modules_path = os.path.join(model_path, "modules.json")
+    modules = []
+    if os.path.exists(modules_path):
+        with open(modules_path, "r", encoding="utf-8") as f:
+            modules = json.load(f)
+    pooling = "mean"
+    for module in modules:
+        if module["type"].endswith("Pooling"):
+            with open(os.path.join(model_path, module["path"], "config.json"), "r", encoding="utf-8") as f:
+                pooling_config = json.load(f)
+            if pooling_config.get("pooling_mode_cls_token"):
+                pooling = "cls"
+            elif not pooling_config.get("pooling_mode_mean_tokens", True):
+                raise ValueError(f"不支援的 pooling 設定：{pooling_config}")
+    max_length = 512
+    bert_config_path = os.path.join(model_path, "sentence_bert_config.json")
+    if os.path.exists(bert_config_path):
+        with open(bert_config_path, "r", encoding="utf-8") as f:
+            max_length = json.load(f).get("max_seq_length") or max_length
+    return {
+        "pooling": pooling,
+        "normalize": any(module["type"].endswith("Normalize") for module in modules),
+        "max_length": max_length,
+    }
+
+def _export(model, tokenizer, directory, output_name, opset):
+    import torch
+
+    # 只輸出第一個結果（last_hidden_state 或 logits）
+    class FirstOutput(torch.nn.Module):
+        def __init__(self, wrapped):
+            super().__init__()
+            self.wrapped = wrapped
+
+        def forward(self, *inputs):
+            return self.wrapped(*inputs)[0]
+
+    sample = tokenizer(["匯出 ONNX 模型用的範例輸入", "sample"], padding=True, return_tensors="pt")
+    # BERT 的 forward 參數依序為 input_ids、attention_mask、token_type_ids
+    names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    axes = {name: {0: "batch", 1: "sequence"} for name in names + [output_name]}
+    # 新版 torch 預設改用 dynamo 匯出器，這裡固定使用 TorchScript 匯出器
+    options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(FirstOutput(model.eval()), tuple(sample[name] for name in names),
+                          os.path.join(directory, ONNX_MODEL_FILE), input_names=names, output_names=[output_name],
+                          dynamic_axes=axes, opset_version=opset, **options)
+    tokenizer.save_pretrained(directory)
+
+def quantize_model(directory):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(os.path.join(directory, ONNX_MODEL_FILE), os.path.join(directory, ONNX_QUANTIZED_MODEL_FILE),
+                     weight_type=QuantType.QInt8)
+
+def export_sentence_model(model_path, quantize=False, opset=ONNX_OPSET):
+    """
+    把本地的 SentenceTransformer 模型匯出成 ONNX（只含 transformer，pooling 在 OnnxSentenceEncoder 以 numpy 計算）。
+    Args:
+        model_path (str): 本地模型目錄。
+        quantize (bool): 另外輸出動態 int8 量化的模型。
+        opset (int): ONNX opset 版本。
+    Returns:
+        str: 匯出的目錄。
+    """
+    from transformers import AutoModel, AutoTokenizer
+    directory = onnx_model_dir(model_path)
+    os.makedirs(directory, exist_ok=True)
+    _export(AutoModel.from_pretrained(model_path), AutoTokenizer.from_pretrained(model_path),
+            directory, "last_hidden_state", opset)
+    with open(os.path.join(directory, SENTENCE_CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump(_sentence_config(model_path), f)
+    if quantize:
+        quantize_model(directory)
+    return directory
+
+def export_token_classifier(model_path, quantize=False, opset=ONNX_OPSET):
+    """
+    把本地的 NER 模型匯出成 ONNX（輸出每個 token 的 logits，聚合在 OnnxTokenClassificationPipeline 計算）。
+    Args:
+        model_path (str): 本地模型目錄。
+        quantize (bool): 另外輸出動態 int8 量化的模型。
+        opset (int): ONNX opset 版本。
+    Returns:
+        str: 匯出的目錄。
+    """
+    from transformers import AutoModelForTokenClassification, AutoTokenizer
+    directory = onnx_model_dir(model_path)
+    os.makedirs(directory, exist_ok=True)
+    model = AutoModelForTokenClassification.from_pretrained(model_path)
+    _export(model, AutoTokenizer.from_pretrained(model_path), directory, "logits", opset)
+    model.config.save_pretrained(directory)
+    if quantize:
+        quantize_model(directory)
+    return directory
+
+def check_embedding_parity(model_path, texts=PARITY_TEXTS, quantized=ONNX_QUANTIZED):
+    """
+    比較 PyTorch 與 ONNX Runtime 的嵌入向量。
+    Returns:
+        dict: 每段文本 cosine 相似度的最小值與平均值。
+    """
+    from sentence_transformers import SentenceTransformer
+    expected = np.asarray(SentenceTransformer(model_path, device="cpu").encode(texts), dtype=np.float32)
+    actual = OnnxSentenceEncoder(model_path, quantized=quantized).encode(texts)
+    cosine = (expected * actual).sum(axis=1) / (np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1))
+    return {"min_cosine": float(cosine.min()), "mean_cosine": float(cosine.mean())}
+
+def check_ner_parity(model_path, texts=PARITY_TEXTS, quantized=ONNX_QUANTIZED):
+    """
+    比較 PyTorch 管道與 ONNX Runtime 辨識出的實體範圍（entity_group、start、end）。
+    Returns:
+        dict: 以 PyTorch 為準的 precision、recall，以及實體完全相同的文本比例。
+    """
+    from transformers import AutoModelForTokenClassification, AutoTokenizer, pipeline
+    torch_pipeline = pipeline("ner", model=AutoModelForTokenClassification.from_pretrained(model_path),
+                              tokenizer=AutoTokenizer.from_pretrained(model_path), aggregation_strategy="simple")
+    onnx_pipeline = OnnxTokenClassificationPipeline(model_path, quantized=quantized)
+    matched = expected_total = actual_total = identical = 0
+    for expected, actual in zip(torch_pipeline(list(texts)), onnx_pipeline(list(texts))):
+        expected = {(entity["entity_group"], int(entity["start"]), int(entity["end"])) for entity in expected}
+        actual = {(entity["entity_group"], entity["start"], entity["end"]) for entity in actual}
+        matched += len(expected & actual)
+        expected_total += len(expected)
+        actual_total += len(actual)
+        identical += expected == actual
+    return {
+        "precision": matched / actual_total if actual_total else 1.0,
+        "recall": matched / expected_total if expected_total else 1.0,
+        "identical_texts": identical / len(texts) if texts else 1.0,
+    }
+
+def main():
+    import embedding
+    import ner_guardrails
+
+    parser = argparse.ArgumentParser(description="把嵌入模型與 NER 模型匯出成 ONNX，並檢查與 PyTorch 的一致性")
+    parser.add_argument("--models", nargs="+", choices=("embedding", "ner"), default=["embedding", "ner"])
+    parser.add_argument("--quantize", action="store_true", help="另外輸出動態 int8 量化的模型")
+    parser.add_argument("--opset", type=int, default=ONNX_OPSET)
+    parser.add_argument("--skip-check", action="store_true", help="匯出後不檢查一致性")
+    args = parser.parse_args()
+
+    variants = [False, True] if args.quantize else [False]
+    if "embedding" in args.models:
+        print(f"匯出嵌入模型至 {export_sentence_model(embedding.MODEL_PATH, args.quantize, args.opset)}")
+        for quantized in variants if not args.skip_check else []:
+            result = check_embedding_parity(embedding.MODEL_PATH, quantized=quantized)
+            print(f"  {'int8' if quantized else 'float32'}：cosine 最小 {result['min_cosine']:.6f}，平均 {result['mean_cosine']:.6f}")
+    if "ner" in args.models:
+        print(f"匯出 NER 模型至 {export_token_classifier(ner_guardrails.local_model_path, args.quantize, args.opset)}")
+        for quantized in variants if not args.skip_check else []:
+            result = check_ner_parity(ner_guardrails.local_model_path, quantized=quantized)
+            print(f"  {'int8' if quantized else 'float32'}：實體 precision {result['precision']:.3f}，"
+                  f"recall {result['recall']:.3f}，完全相同的文本 {result['identical_texts']:.0%}")
+
+if __name__ == "__main__":
+    main()
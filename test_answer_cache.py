@@ -0,0 +1,29 @@
+import numpy as np
+
+from answer_cache import SemanticAnswerCache
+from filename_index import FilenameIndex
+
+# 依問題中的檔名以外的文字產生向量，模擬「A.pdf 的摘要」與「B.pdf 的摘要」幾乎相同的問題向量
+def embed(question):
+    text = question.replace("A", "").replace("B", "")
+    return np.array([len(text), text.count("摘要"), 1.0], dtype=np.float32)
+
+def make_cache(tmp_path):
+    for file_name in ("A.pdf", "B.pdf"):
+        (tmp_path / file_name).write_bytes(b"")
+    return SemanticAnswerCache(find_mentions=FilenameIndex(str(tmp_path)).find_mentions)
+
+def test_semantic_hit_requires_same_file(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store("A.pdf 的摘要", "v1", embed, "A 的摘要內容", [])
+    assert cache.lookup("B.pdf 的摘要", "v1", embed) is None
+    hit = cache.lookup("A 的摘要", "v1", embed)
+    assert hit is not None and hit["answer"] == "A 的摘要內容"
+
+def test_each_file_keeps_its_own_answer(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store("A.pdf 的摘要", "v1", embed, "A 的摘要內容", [])
+    cache.store("B.pdf 的摘要", "v1", embed, "B 的摘要內容", [])
+    assert cache.lookup("B 的摘要", "v1", embed)["answer"] == "B 的摘要內容"
+    assert cache.lookup("A 的摘要", "v1", embed)["answer"] == "A 的摘要內容"
+    assert cache.lookup("A 與 B 的摘要", "v1", embed) is None
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import chatbot
+from chatbot import GeminiAPI, RETRY_AFTER_MAX
+
+ANSWER = "這是測試回答。"
+
+# 本機模擬的 Gemini 伺服器：依序回傳 statuses 中的狀態碼（附上 Retry-After），用完後回傳正常回答
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, statuses=(), retry_after=None, latency=0.0):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.statuses = list(statuses)
+        self.retry_after = retry_after
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1beta/models/fake:generateContent"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with server.lock:
+            index = server.requests
+            server.requests += 1
+        time.sleep(server.latency)
+        if index < len(server.statuses):
+            status, body = server.statuses[index], b"{}"
+        else:
+            status = 200
+            body = json.dumps({"candidates": [{"content": {"parts": [{"text": ANSWER}]}}]}, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status != 200 and server.retry_after is not None:
+            self.send_header("Retry-After", server.retry_after)
+        self.end_headers()
+        self.wfile.write(body)
+
+# 記錄每次重試計算出的等待秒數，實際等待 0 秒讓測試保持快速
+@pytest.fixture
+def delays(monkeypatch):
+    recorded = []
+    retry_delay = chatbot.retry_delay
+
+    def recording_delay(attempt, retry_after=None):
+        recorded.append(retry_delay(attempt, retry_after))
+        return 0.0
+
+    monkeypatch.setattr(chatbot, "retry_delay", recording_delay)
+    return recorded
+
+# 以同步或非同步路徑呼叫一次 GeminiAPI
+def ask(llm, mode):
+    if mode == "sync":
+        return llm.invoke("測試問題")
+
+    async def run():
+        try:
+            return await llm.ainvoke("測試問題")
+        finally:
+            await llm.aclose()
+
+    return asyncio.run(run())
+
+def make_llm(server, max_retries=3):
+    return GeminiAPI(api_key="test", api_url=server.url, max_new_tokens=100, temperature=0.5, max_retries=max_retries)
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+@pytest.mark.parametrize("status", [429, 503])
+def test_retries_then_succeeds(delays, mode, status):
+    with StubServer(statuses=[status, status], retry_after="0.2") as server:
+        assert ask(make_llm(server), mode) == ANSWER
+        assert server.requests == 3
+    assert delays == [0.2, 0.2]
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_gives_up_after_max_retries(delays, mode):
+    with StubServer(statuses=[503] * 10, retry_after="0") as server:
+        assert ask(make_llm(server, max_retries=2), mode) == "無法生成回答"
+        assert server.requests == 3
+    assert len(delays) == 2
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+@pytest.mark.parametrize("retry_after", ["999", "Wed, 21 Oct 2099 07:28:00 GMT"])
+def test_retry_after_is_capped(delays, mode, retry_after):
+    with StubServer(statuses=[429], retry_after=retry_after) as server:
+        assert ask(make_llm(server), mode) == ANSWER
+    assert delays == [RETRY_AFTER_MAX]
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_without_retry_after_uses_backoff(delays, mode):
+    with StubServer(statuses=[503]) as server:
+        assert ask(make_llm(server), mode) == ANSWER
+    assert len(delays) == 1 and 0.0 <= delays[0] <= chatbot.BACKOFF_BASE
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_records_latency(mode):
+    with StubServer(latency=0.05) as server:
+        llm = make_llm(server)
+        assert llm.last_latency is None
+        assert ask(llm, mode) == ANSWER
+    assert 0.05 <= llm.last_latency < 5
@@ -0,0 +1,115 @@
+import os
+import time
+import zlib
+import sqlite3
+
+# 設置參數
+TEXT_CACHE_PATH = "./extract_cache.sqlite3"  # 解析文字快取（放在 chroma_db 旁，--rebuild 不會刪除）
+TEXT_CACHE_MAX_MB = 1024  # 快取大小上限（壓縮後）
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    hash TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    unit_count INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS units (
+    hash TEXT NOT NULL,
+    unit_num INTEGER NOT NULL,
+    text BLOB NOT NULL,
+    PRIMARY KEY (hash, unit_num)
+);
+"""
+
+# 以檔案內容雜湊為鍵的解析文字快取（PDF 每頁、DOCX 每段落一筆，zlib 壓縮後存入 SQLite）
+class ExtractedTextCache:
+    """
+    files 表的一筆紀錄代表該雜湊的所有頁面都已寫入；units 只寫了一半（解析中斷）的雜湊
+    不會被 lookup 命中，之後由 prune 清除。
+    """
+    def __init__(self, path=TEXT_CACHE_PATH, read_only=False):
+        self.path = path
+        if read_only:
+            # 解析行程只讀取快取，寫入統一由擁有集合的主行程負責
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(path)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(_SCHEMA)
+
+    def lookup(self, file_hash):
+        row = self.conn.execute("SELECT kind, unit_count FROM files WHERE hash = ?", (file_hash,)).fetchone()
+        if row is None:
+            return None
+        with self.conn:
+            self.conn.execute("UPDATE files SET last_used = ? WHERE hash = ?", (time.time(), file_hash))
+        return {"kind": row[0], "unit_count": row[1]}
+
+    # 依編號順序逐一產出 (編號, 文字)，可指定編號範圍
+    def iter_units(self, file_hash, first=None, last=None):
+        query = "SELECT unit_num, text FROM units WHERE hash = ?"
+        params = [file_hash]
+        if first is not None:
+            query += " AND unit_num >= ?"
+            params.append(first)
+        if last is not None:
+            query += " AND unit_num <= ?"
+            params.append(last)
+        for unit_num, blob in self.conn.execute(query + " ORDER BY unit_num", params):
+            yield unit_num, zlib.decompress(blob).decode("utf-8")
+
+    def put_units(self, file_hash, units):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO units (hash, unit_num, text) VALUES (?, ?, ?)",
+                [(file_hash, unit_num, zlib.compress(text.encode("utf-8"))) for unit_num, text in units]
+            )
+
+    # 所有頁面寫入後才登記檔案，lookup 才會命中
+    def commit_file(self, file_hash, kind, unit_count):
+        with self.conn:
+            size = self.conn.execute("SELECT COALESCE(SUM(LENGTH(text)), 0) FROM units WHERE hash = ?",
+                                     (file_hash,)).fetchone()[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (hash, kind, unit_count, bytes, last_used) VALUES (?, ?, ?, ?, ?)",
+                (file_hash, kind, unit_count, size, time.time())
+            )
+
+    def discard(self, file_hash):
+        with self.conn:
+            self.conn.execute("DELETE FROM files WHERE hash = ?", (file_hash,))
+            self.conn.execute("DELETE FROM units WHERE hash = ?", (file_hash,))
+
+    def total_bytes(self):
+        return self.conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM files").fetchone()[0]
+
+    # 超過大小上限時，從最久未使用的檔案開始刪除
+    def enforce_limit(self, max_bytes):
+        total = self.total_bytes()
+        evicted = 0
+        if total <= max_bytes:
+            return evicted
+        for file_hash, size in self.conn.execute("SELECT hash, bytes FROM files ORDER BY last_used").fetchall():
+            if total <= max_bytes:
+                break
+            self.discard(file_hash)
+            total -= size
+            evicted += 1
+        return evicted
+
+    # 刪除不在 keep_hashes 中的檔案，以及解析中斷留下的頁面
+    def prune(self, keep_hashes):
+        keep = set(keep_hashes)
+        stale = [h for (h,) in self.conn.execute("SELECT hash FROM files").fetchall() if h not in keep]
+        for file_hash in stale:
+            self.discard(file_hash)
+        with self.conn:
+            self.conn.execute("DELETE FROM units WHERE hash NOT IN (SELECT hash FROM files)")
+        self.conn.execute("VACUUM")
+        return len(stale)
+
+    def close(self):
+        self.conn.close()
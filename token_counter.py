@@ -0,0 +1,40 @@
+import re
+
+# 估算 token 數：中日韓文字每字一個 token，英數字串約每 4 個字元一個 token，其他符號各一個 token
+# 不需要載入 tokenizer，誤差對預算控制來說足夠
+_TOKEN_PATTERN = re.compile(r"[぀-ヿ㐀-鿿豈-﫿가-힯]|[A-Za-z0-9]+|[^\sA-Za-z0-9]")
+
+def estimate_tokens(text):
+    total = 0
+    for token in _TOKEN_PATTERN.findall(text):
+        if token.isascii() and token.isalnum():
+            total += (len(token) + 3) // 4
+        else:
+            total += 1
+    return total
+
+# 保留文本結尾不超過 max_tokens 的部分（截斷最舊的內容）
+def tail_within_tokens(text, max_tokens):
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high) // 2
+        if estimate_tokens(text[middle:]) <= max_tokens:
+            high = middle
+        else:
+            low = middle + 1
+    return text[low:]
+
+# 保留文本開頭不超過 max_tokens 的部分
+def head_within_tokens(text, max_tokens):
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
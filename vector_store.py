@@ -0,0 +1,472 @@
+import os
+import json
+import sqlite3
+import threading
+from typing import Protocol, runtime_checkable
+
+import numpy as np
+
+# 設置參數
+VECTOR_BACKEND = "chroma"  # 向量資料庫後端："chroma"（ChromaDB）或 "flat"（記憶體映射的 float16 / int8 矩陣）
+VECTOR_BACKENDS = ("chroma", "flat")
+FLAT_INDEX_PATH = "./chroma_db/flat_index"  # 放在 chroma_db 內，--rebuild 時一併刪除
+FLAT_FLOAT32_CACHE_MB = 512  # float16 矩陣還原成 float32 後不超過此大小時常駐記憶體，否則每次查詢逐塊還原
+FLAT_INT8_FLOAT32_CACHE_MB = 0  # int8 矩陣的 float32 快取上限：快取是 int8 矩陣的 4 倍大，預設不建立，才真正省下記憶體
+FLAT_SEARCH_BLOCK_ROWS = 65536  # 逐塊轉換與重寫向量檔時每塊的列數
+FLAT_COMPACT_STALE_RATIO = 0.2  # 已刪除的列超過此比例時重寫向量檔
+FLAT_SUBSET_RATIO = 0.25  # 條件篩選後的列數低於此比例時，只計算這些列的分數
+FLAT_QUANTIZATION = "float16"  # 搜尋用矩陣的格式："float16"，或 "int8"（每列一個縮放係數，大小約為 float16 的一半）
+FLAT_QUANTIZATIONS = ("float16", "int8")
+FLAT_FULL_PRECISION = False  # 另存 float32 副本，用來重新計算候選的距離（只讀取候選的列，不需常駐記憶體）
+FLAT_RESCORE_FACTOR = 4  # 有 float32 副本時，先以壓縮矩陣取 n * 此倍數個候選再重新排序
+_SQL_BATCH = 900  # SQLite 單一查詢的參數上限以內
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    row INTEGER PRIMARY KEY,
+    chunk_id TEXT NOT NULL UNIQUE,
+    file_name TEXT,
+    document TEXT,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+def file_name_mask(where, file_codes, file_ids):
+    """
+    將 Chroma 格式的 file_name 條件轉成布林遮罩。
+    Args:
+        where (dict): {"file_name": 值}、{"file_name": {"$eq" | "$ne" | "$in" | "$nin": 值}} 或 None。
+        file_codes (np.ndarray): 每一列的檔名編號，已刪除的列為 -1。
+        file_ids (dict): 檔名 → 編號。
+    Returns:
+        np.ndarray | None: 符合條件的列（不含已刪除的列）；沒有條件時為 None。
+    """
+    if not where:
+        return None
+    if set(where) != {"file_name"}:
+        raise ValueError(f"只支援 file_name 條件：{where}")
+    condition = where["file_name"]
+    if not isinstance(condition, dict):
+        condition = {"$eq": condition}
+    (operator, value), = condition.items()
+    if operator == "$eq":
+        return file_codes == file_ids.get(value, -2)
+    if operator == "$ne":
+        return (file_codes != file_ids.get(value, -2)) & (file_codes >= 0)
+    if operator == "$in":
+        return np.isin(file_codes, [file_ids[v] for v in value if v in file_ids])
+    if operator == "$nin":
+        return ~np.isin(file_codes, [file_ids[v] for v in value if v in file_ids]) & (file_codes >= 0)
+    raise ValueError(f"不支援的條件：{operator}")
+
+def _row_norms(vectors):
+    return np.clip(np.sqrt(np.einsum("ij,ij->i", vectors, vectors)), 1e-12, None)
+
+def _normalize(vectors):
+    return vectors / _row_norms(vectors)[:, None]
+
+# 向量資料庫介面
+@runtime_checkable
+class VectorStore(Protocol):
+    """
+    採用 Chroma collection 的方法子集，chromadb 的 collection 不需繼承即符合此介面（結構型別），
+    EmbeddingWriter、sync_index 與 ChromaRetriever 只透過這些方法存取向量資料庫。
+    """
+    name: str
+
+    def upsert(self, ids, documents=None, metadatas=None, embeddings=None): ...
+
+    def update(self, ids, metadatas=None, documents=None): ...
+
+    def delete(self, ids): ...
+
+    def get(self, ids=None, limit=None, offset=None, include=("metadatas", "documents")): ...
+
+    def query(self, query_embeddings, n_results=10, where=None, include=("metadatas", "documents", "distances")): ...
+
+    def count(self): ...
+
+# 記憶體映射的向量矩陣（float16 或 int8）+ SQLite metadata 表，以矩陣乘法做 top-k
+class FlatVectorStore(VectorStore):
+    """
+    向量依寫入順序存成無標頭的矩陣檔，查詢時以 np.memmap 映射，不需要像 Chroma 一樣在啟動時載入 HNSW 索引；
+    新增的向量直接接在檔案尾端。搜尋用的矩陣依 quantization 存成 float16（vectors-<generation>.f16），
+    或 int8 加上每列的縮放係數（vectors-<generation>.i8、scales-<generation>.f32）。
+    full_precision 時另存 float32 副本（full-<generation>.f32）：先以壓縮矩陣取出 n * rescore_factor 個候選，
+    再只讀取這些列的 float32 向量重新計算距離。
+    chunk id、檔名、內容與 metadata 存在 SQLite，查詢只需要常駐每一列的檔名編號（int32）。
+    刪除的列先留在矩陣中（檔名編號為 -1），超過 FLAT_COMPACT_STALE_RATIO 時重寫成新的 generation，
+    其他行程仍映射舊檔案，直到在下次查詢時發現 generation 改變。
+    與 Chroma（SentenceTransformerEmbeddingFunction 預設的 cosine 空間）相同以 cosine 排序，距離為 1 - cosine：
+    寫入前把向量正規化，分數再除以還原後向量的長度，抵銷量化造成的長度誤差。
+    """
+    def __init__(self, path=FLAT_INDEX_PATH, name=None, float32_cache_mb=None,
+                 quantization=FLAT_QUANTIZATION, full_precision=FLAT_FULL_PRECISION, rescore_factor=FLAT_RESCORE_FACTOR):
+        if quantization not in FLAT_QUANTIZATIONS:
+            raise ValueError(f"未知的向量格式：{quantization}，可用格式：{', '.join(FLAT_QUANTIZATIONS)}")
+        self.path = path
+        self.name = name or os.path.basename(os.path.normpath(path))
+        self.rescore_factor = rescore_factor
+        os.makedirs(path, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(path, "chunks.sqlite3"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        with self.conn:
+            if self._meta("rows"):
+                # 已有資料時沿用建立時的格式
+                stored = (FLAT_QUANTIZATIONS[self._meta("quantization")], bool(self._meta("full_precision")))
+                if stored != (quantization, bool(full_precision)):
+                    print(f"flat 索引以 {stored[0]}（float32 副本：{'有' if stored[1] else '無'}）建立，"
+                          f"沿用原格式；改變格式需要重建索引（embedding.py --rebuild）")
+                quantization, full_precision = stored
+            else:
+                self._set_meta("quantization", FLAT_QUANTIZATIONS.index(quantization))
+                self._set_meta("full_precision", int(bool(full_precision)))
+        self.quantization = quantization
+        self.full_precision = bool(full_precision)
+        if float32_cache_mb is None:
+            float32_cache_mb = FLAT_INT8_FLOAT32_CACHE_MB if quantization == "int8" else FLAT_FLOAT32_CACHE_MB
+        self.float32_cache_mb = float32_cache_mb
+        self.lock = threading.RLock()
+        self._data_version = None
+        self._loaded = False
+        self._generation = 0
+        self._rows = 0
+        self._dim = 0
+        self._file_codes = np.zeros(0, dtype=np.int32)
+        self._file_ids = {}
+        self._arrays = None
+        self._float32 = None
+        self._norms = None
+
+    def _meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    # 每一代的資料檔：(名稱, 路徑, dtype, 每列的元素數)
+    def _columns(self, generation, dim):
+        if self.quantization == "int8":
+            columns = [("vectors", f"vectors-{generation}.i8", np.int8, dim), ("scales", f"scales-{generation}.f32", np.float32, 1)]
+        else:
+            columns = [("vectors", f"vectors-{generation}.f16", np.float16, dim)]
+        if self.full_precision:
+            columns.append(("full", f"full-{generation}.f32", np.float32, dim))
+        return [(name, os.path.join(self.path, file_name), dtype, width) for name, file_name, dtype, width in columns]
+
+    # int8：每列除以 max|x| / 127 後四捨五入，還原時乘回縮放係數
+    def _encode(self, vectors):
+        encoded = {}
+        if self.quantization == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            encoded["vectors"] = np.round(vectors / scales[:, None]).astype(np.int8)
+            encoded["scales"] = scales.astype(np.float32)
+        else:
+            encoded["vectors"] = vectors.astype(np.float16)
+        if self.full_precision:
+            encoded["full"] = vectors
+        return encoded
+
+    def _open_arrays(self, generation, rows, dim):
+        arrays = {}
+        for name, path, dtype, width in self._columns(generation, dim):
+            shape = (rows, width) if width > 1 else (rows,)
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r", shape=shape) if rows else np.zeros(shape, dtype=dtype)
+        return arrays
+
+    # 把壓縮矩陣的部分列（切片或列編號）還原成 float32
+    @staticmethod
+    def _dequantize(arrays, rows):
+        block = np.asarray(arrays["vectors"][rows], dtype=np.float32)
+        if "scales" in arrays:
+            block *= arrays["scales"][rows][:, None]
+        return block
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
+        if embeddings is None:
+            raise ValueError("FlatVectorStore 需要提供 embeddings")
+        ids = list(ids)
+        if not ids:
+            return
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1))
+        documents = documents if documents is not None else [None] * len(ids)
+        metadatas = metadatas if metadatas is not None else [{}] * len(ids)
+        with self.lock:
+            with self.conn:
+                self._delete_rows(ids)
+                dim = self._meta("dim") or vectors.shape[1]
+                if vectors.shape[1] != dim:
+                    raise ValueError(f"向量維度 {vectors.shape[1]} 與索引的維度 {dim} 不同")
+                rows = self._meta("rows")
+                encoded = self._encode(vectors)
+                # 從目前的列數寫入並截斷，上次寫入一半中斷留下的資料會被覆蓋
+                for name, path, dtype, width in self._columns(self._meta("generation"), dim):
+                    with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                        f.seek(rows * width * np.dtype(dtype).itemsize)
+                        f.write(np.ascontiguousarray(encoded[name], dtype=dtype).tobytes())
+                        f.truncate()
+                self.conn.executemany(
+                    "INSERT INTO chunks (row, chunk_id, file_name, document, metadata) VALUES (?, ?, ?, ?, ?)",
+                    [(rows + offset, chunk_id, (metadata or {}).get("file_name"), document,
+                      json.dumps(metadata or {}, ensure_ascii=False))
+                     for offset, (chunk_id, document, metadata) in enumerate(zip(ids, documents, metadatas))])
+                self._set_meta("rows", rows + len(ids))
+                self._set_meta("dim", dim)
+            self._loaded = False
+            self._maybe_compact()
+
+    def update(self, ids, metadatas=None, documents=None):
+        with self.lock:
+            with self.conn:
+                if metadatas is not None:
+                    self.conn.executemany("UPDATE chunks SET metadata = ?, file_name = ? WHERE chunk_id = ?",
+                                          [(json.dumps(metadata, ensure_ascii=False), metadata.get("file_name"), chunk_id)
+                                           for chunk_id, metadata in zip(ids, metadatas)])
+                if documents is not None:
+                    self.conn.executemany("UPDATE chunks SET document = ? WHERE chunk_id = ?",
+                                          list(zip(documents, ids)))
+            self._loaded = False
+
+    def delete(self, ids):
+        with self.lock:
+            with self.conn:
+                self._delete_rows(list(ids))
+            self._loaded = False
+            self._maybe_compact()
+
+    def _delete_rows(self, ids):
+        removed = 0
+        for start in range(0, len(ids), _SQL_BATCH):
+            batch = ids[start:start + _SQL_BATCH]
+            removed += self.conn.execute(f"DELETE FROM chunks WHERE chunk_id IN ({','.join('?' * len(batch))})",
+                                         batch).rowcount
+        if removed:
+            self._set_meta("stale", self._meta("stale") + removed)
+
+    def _maybe_compact(self):
+        rows = self._meta("rows")
+        if rows and self._meta("stale") / rows > FLAT_COMPACT_STALE_RATIO:
+            self.compact()
+
+    # 只保留未刪除的列，寫成新 generation 的資料檔，並依序重新編號
+    def compact(self):
+        with self.lock:
+            generation, rows, dim = self._meta("generation"), self._meta("rows"), self._meta("dim")
+            live = np.array([row for row, in self.conn.execute("SELECT row FROM chunks ORDER BY row")], dtype=np.int64)
+            old_arrays = self._open_arrays(generation, rows, dim)
+            for name, path, dtype, width in self._columns(generation + 1, dim):
+                with open(path, "wb") as f:
+                    for start in range(0, len(live), FLAT_SEARCH_BLOCK_ROWS):
+                        f.write(np.ascontiguousarray(old_arrays[name][live[start:start + FLAT_SEARCH_BLOCK_ROWS]]).tobytes())
+            del old_arrays
+            with self.conn:
+                # 新編號不大於舊編號，依序更新不會與尚未更新的列衝突
+                self.conn.executemany("UPDATE chunks SET row = ? WHERE row = ?",
+                                      [(new, int(old)) for new, old in enumerate(live) if new != old])
+                self._set_meta("rows", len(live))
+                self._set_meta("stale", 0)
+                self._set_meta("generation", generation + 1)
+            for _, path, _, _ in self._columns(generation, dim):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._loaded = False
+            print(f"向量檔已壓縮，移除 {rows - len(live)} 個已刪除的向量，目前 {len(live)} 個")
+
+    # 其他行程（例如 embedding.py）更新後，重新載入列數、檔名編號與向量檔
+    def _refresh(self):
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._loaded and data_version == self._data_version:
+            return
+        self.conn.execute("BEGIN")  # 在同一個讀取交易中取得一致的 meta 與 chunks
+        try:
+            generation, rows, dim = self._meta("generation"), self._meta("rows"), self._meta("dim")
+            file_codes = np.full(rows, -1, dtype=np.int32)
+            file_ids = {}
+            for row, file_name in self.conn.execute("SELECT row, file_name FROM chunks"):
+                file_codes[row] = file_ids.setdefault(file_name, len(file_ids))
+        finally:
+            self.conn.execute("COMMIT")
+        # 只有向量檔改變時才重新映射並捨棄 float32 快取（只更新 metadata 時不必）
+        if (generation, rows, dim) != (self._generation, self._rows, self._dim) or self._arrays is None:
+            self._arrays = self._open_arrays(generation, rows, dim)
+            self._float32 = None
+            self._norms = None
+        self._generation, self._rows, self._dim = generation, rows, dim
+        self._file_codes = file_codes
+        self._file_ids = file_ids
+        self._data_version = data_version
+        self._loaded = True
+
+    # 每一列與查詢的 cosine 相似度（越大越近）
+    def _scores(self, queries, rows=None):
+        """
+        以壓縮矩陣還原的向量計算分數。
+        Args:
+            queries (np.ndarray): 已正規化的查詢向量（float32）。
+            rows (np.ndarray): 只計算這些列；None 表示全部。
+        Returns:
+            np.ndarray: (查詢數, 列數) 的分數。
+        """
+        arrays = self._arrays
+        total = len(arrays["vectors"])
+        if self._float32 is None and total * self._dim * 4 <= self.float32_cache_mb * 1024 * 1024:
+            self._float32 = self._dequantize(arrays, slice(None))
+            self._norms = _row_norms(self._float32)
+        if rows is not None:
+            block = self._float32[rows] if self._float32 is not None else self._dequantize(arrays, rows)
+            return (queries @ block.T) / _row_norms(block)
+        if self._float32 is not None:
+            return (queries @ self._float32.T) / self._norms
+        # 矩陣太大時逐塊還原成 float32 再做 BLAS 矩陣乘法，第一次查詢時一併計算各列長度
+        compute_norms = self._norms is None
+        if compute_norms:
+            self._norms = np.empty(total, dtype=np.float32)
+        scores = np.empty((len(queries), total), dtype=np.float32)
+        for start in range(0, total, FLAT_SEARCH_BLOCK_ROWS):
+            block = self._dequantize(arrays, slice(start, start + FLAT_SEARCH_BLOCK_ROWS))
+            if compute_norms:
+                self._norms[start:start + len(block)] = _row_norms(block)
+            scores[:, start:start + len(block)] = (queries @ block.T) / self._norms[start:start + len(block)]
+        return scores
+
+    # 讀取候選的 float32 向量，重新計算精確分數
+    def _rescore(self, query, rows):
+        full = np.asarray(self._arrays["full"][rows], dtype=np.float32)
+        return (full @ query) / _row_norms(full)
+
+    def _fetch_rows(self, rows):
+        """
+        Returns:
+            dict: row → (chunk id, 內容, metadata)。
+        """
+        found = {}
+        for start in range(0, len(rows), _SQL_BATCH):
+            batch = [int(row) for row in rows[start:start + _SQL_BATCH]]
+            for row, chunk_id, document, metadata in self.conn.execute(
+                    f"SELECT row, chunk_id, document, metadata FROM chunks WHERE row IN ({','.join('?' * len(batch))})",
+                    batch):
+                found[row] = (chunk_id, document, json.loads(metadata) if metadata else {})
+        return found
+
+    def _pack(self, rows, found, include, distances=None):
+        rows = [int(row) for row in rows if int(row) in found]
+        result = {"ids": [found[row][0] for row in rows]}
+        if "documents" in include:
+            result["documents"] = [found[row][1] for row in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [found[row][2] for row in rows]
+        if "embeddings" in include:
+            if not rows:
+                result["embeddings"] = np.zeros((0, self._dim), dtype=np.float32)
+            elif "full" in self._arrays:
+                result["embeddings"] = np.asarray(self._arrays["full"][rows], dtype=np.float32)
+            else:
+                result["embeddings"] = self._dequantize(self._arrays, rows)
+        if distances is not None:
+            result["distances"] = [distances[row] for row in rows]
+        return result
+
+    def get(self, ids=None, limit=None, offset=None, include=("metadatas", "documents")):
+        with self.lock:
+            self._refresh()
+            if ids is not None:
+                ids = list(ids)
+                row_of = {}
+                for start in range(0, len(ids), _SQL_BATCH):
+                    batch = ids[start:start + _SQL_BATCH]
+                    row_of.update((chunk_id, row) for chunk_id, row in self.conn.execute(
+                        f"SELECT chunk_id, row FROM chunks WHERE chunk_id IN ({','.join('?' * len(batch))})", batch))
+                rows = [row_of[chunk_id] for chunk_id in ids if chunk_id in row_of]
+            else:
+                rows = [row for row, in self.conn.execute("SELECT row FROM chunks ORDER BY row LIMIT ? OFFSET ?",
+                                                          (limit if limit is not None else -1, offset or 0))]
+            return self._pack(rows, self._fetch_rows(rows), include)
+
+    def query(self, query_embeddings, n_results=10, where=None, include=("metadatas", "documents", "distances")):
+        """
+        top-k 查詢，回傳格式與 Chroma collection.query 相同（每個查詢向量一個列表）。
+        有 float32 副本時，壓縮矩陣只用來挑選 n_results * rescore_factor 個候選，最後的排序與距離以 float32 計算。
+        Args:
+            query_embeddings (list): 查詢向量列表。
+            n_results (int): 每個查詢回傳的筆數。
+            where (dict): file_name 條件（等於、$ne、$in）。
+            include (list): "documents"、"metadatas"、"embeddings"、"distances"。
+        Returns:
+            dict: ids、以及 include 中指定的欄位。
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries = _normalize(queries.reshape(len(queries), -1))
+        keys = ["ids"] + [key for key in ("documents", "metadatas", "embeddings", "distances") if key in include]
+        results = {key: [] for key in keys}
+        with self.lock:
+            self._refresh()
+            mask = file_name_mask(where, self._file_codes, self._file_ids)
+            if mask is None:
+                mask = self._file_codes >= 0
+            allowed = np.flatnonzero(mask)
+            scores = None
+            if len(allowed) and n_results > 0:
+                # 篩選後只剩少數列（例如指定檔案）時只計算這些列，否則整個矩陣一起計算再套用遮罩
+                if len(allowed) < FLAT_SUBSET_RATIO * len(mask):
+                    scores = self._scores(queries, allowed)
+                else:
+                    scores = self._scores(queries)[:, allowed]
+            rescore = "full" in self._arrays
+            for index, query in enumerate(queries):
+                if scores is None:
+                    for key in keys:
+                        results[key].append([])
+                    continue
+                candidate_scores = scores[index]
+                n = min(n_results, len(allowed))
+                pool = min(len(allowed), n * max(1, self.rescore_factor)) if rescore else n
+                top = np.argpartition(-candidate_scores, pool - 1)[:pool] if pool < len(allowed) else np.arange(len(allowed))
+                rows = allowed[top]
+                top_scores = self._rescore(query, rows) if rescore else candidate_scores[top]
+                order = np.argsort(-top_scores, kind="stable")[:n]
+                rows, top_scores = rows[order], top_scores[order]
+                distances = {int(row): 1.0 - float(score) for row, score in zip(rows, top_scores)}
+                packed = self._pack(rows, self._fetch_rows(rows), include, distances)
+                for key in keys:
+                    results[key].append(packed[key])
+        return results
+
+    def close(self):
+        with self.lock:
+            self._arrays = None
+            self._float32 = None
+            self.conn.close()
+
+def open_vector_store(backend=VECTOR_BACKEND, chroma_path="./chroma_db", collection_name="pdf_docx_collection",
+                      embedding_function=None, flat_path=FLAT_INDEX_PATH) -> VectorStore:
+    """
+    依設定開啟（不存在時建立）向量資料庫。
+    Args:
+        backend (str): "chroma" 或 "flat"。
+        chroma_path (str): Chroma 的儲存路徑。
+        collection_name (str): 集合名稱。
+        embedding_function: Chroma 集合使用的嵌入函數。
+        flat_path (str): FlatVectorStore 的儲存路徑。
+    Returns:
+        VectorStore: Chroma collection 或 FlatVectorStore。
+    """
+    if backend == "chroma":
+        import chromadb  # 只在使用 Chroma 後端時載入
+        client = chromadb.PersistentClient(path=chroma_path)
+        return client.get_or_create_collection(name=collection_name, embedding_function=embedding_function)
+    if backend == "flat":
+        return FlatVectorStore(flat_path, name=collection_name)
+    raise ValueError(f"未知的向量資料庫後端：{backend}，可用後端：{', '.join(VECTOR_BACKENDS)}")